@@ -0,0 +1,156 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+import socketserver
+
+import requests
+
+from yu.network import httpclient
+
+
+PAYLOAD = bytes(bytearray(range(256))) * 1024
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Requests received by the server, as (method, path, Range header) tuples
+    requests_seen = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _record(self):
+        self.requests_seen.append((self.command, self.path, self.headers.get('Range')))
+
+    def _send_payload(self, body_length=None):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        if body_length is not None:
+            self.wfile.write(PAYLOAD[:body_length])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(PAYLOAD)
+
+    def do_HEAD(self):
+        self._record()
+        if self.path == "/no-head":
+            self.send_error(405)
+        elif self.path == "/head-not-implemented":
+            self.send_error(501)
+        elif self.path == "/slow":
+            time.sleep(1)
+            self.send_response(200)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(PAYLOAD)))
+            self.end_headers()
+
+    def do_GET(self):
+        self._record()
+        if self.path in ("/no-head", "/head-not-implemented"):
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes 0-0/" + str(len(PAYLOAD)))
+            self.send_header("Content-Length", "1")
+            self.end_headers()
+            self.wfile.write(PAYLOAD[:1])
+        elif self.path == "/payload":
+            self._send_payload()
+        elif self.path == "/truncated":
+            self._send_payload(body_length=len(PAYLOAD) // 2)
+        elif self.path == "/slow":
+            time.sleep(1)
+            self._send_payload()
+        else:
+            self.send_error(404)
+
+
+class HttpClientTest(unittest.TestCase):
+    def setUp(self):
+        self.requests_seen = []
+        self.directory = tempfile.mkdtemp()
+        self.servers = []
+
+    def tearDown(self):
+        httpclient.close_session()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.directory)
+
+    def _serve(self):
+        handler = type("_TestHandler", (_Handler,), {'requests_seen': self.requests_seen})
+        server = _ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return "http://127.0.0.1:" + str(server.server_address[1])
+
+    def test_probe_uses_head(self):
+        address = self._serve()
+        self.assertEqual(httpclient.probe(address + "/payload"), 200)
+        self.assertEqual(self.requests_seen, [("HEAD", "/payload", None)])
+
+    def test_probe_falls_back_to_ranged_get_on_405(self):
+        address = self._serve()
+        self.assertEqual(httpclient.probe(address + "/no-head"), 206)
+        self.assertEqual(self.requests_seen, [("HEAD", "/no-head", None), ("GET", "/no-head", "bytes=0-0")])
+
+    def test_probe_falls_back_to_ranged_get_on_501(self):
+        address = self._serve()
+        self.assertEqual(httpclient.probe(address + "/head-not-implemented"), 206)
+        self.assertEqual(self.requests_seen, [("HEAD", "/head-not-implemented", None),
+                                              ("GET", "/head-not-implemented", "bytes=0-0")])
+
+    def test_probe_times_out(self):
+        address = self._serve()
+        start = time.time()
+        self.assertRaises(requests.Timeout, httpclient.probe, address + "/slow", timeout=(1, 0.2))
+        self.assertLess(time.time() - start, 1)
+
+    def test_download_streams_in_chunks_and_renames_into_place(self):
+        address = self._serve()
+        destination_path = os.path.join(self.directory, "payload.bin")
+        self.assertEqual(httpclient.download(address + "/payload", destination_path, chunk_size=1000),
+                         destination_path)
+        with open(destination_path, 'rb') as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertEqual(os.listdir(self.directory), ["payload.bin"])
+
+    def test_download_times_out(self):
+        address = self._serve()
+        destination_path = os.path.join(self.directory, "payload.bin")
+        self.assertRaises(requests.Timeout, httpclient.download, address + "/slow", destination_path,
+                          timeout=(1, 0.2))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_download_error_status_leaves_nothing_behind(self):
+        address = self._serve()
+        destination_path = os.path.join(self.directory, "missing.bin")
+        self.assertRaises(requests.HTTPError, httpclient.download, address + "/missing", destination_path)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_download_interrupted_removes_part_file_and_keeps_existing_file(self):
+        address = self._serve()
+        destination_path = os.path.join(self.directory, "payload.bin")
+        with open(destination_path, 'wb') as f:
+            f.write(b"previous")
+        self.assertRaises(requests.RequestException, httpclient.download, address + "/truncated",
+                          destination_path, chunk_size=1000)
+        self.assertEqual(os.listdir(self.directory), ["payload.bin"])
+        with open(destination_path, 'rb') as f:
+            self.assertEqual(f.read(), b"previous")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+import os
+import stat
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+import urllib.request
+from unittest import mock
+
+from yu.packageManagement import mirror
+from yu.packageManagement import yum
+
+
+_CREATEREPO_STUB = """#!/bin/sh
+for repo_dir; do :; done
+mkdir -p "$repo_dir/repodata"
+ls "$repo_dir" | grep '\\.rpm$' > "$repo_dir/repodata/repomd.xml"
+"""
+
+
+class _Location(object):
+    address = "stand-in"
+
+    def is_local(self):
+        return False
+
+
+class _StandInNode(object):
+    """
+    Acts as a remote node by running its commands on this node, and forwards ports by handing back the local port
+    """
+    def __init__(self):
+        self.location = _Location()
+        self.pushed = []
+        self.forwards = []
+
+    def get_location(self):
+        return self.location
+
+    def get_host_to_connect_to(self):
+        return self.location.address
+
+    def command(self, command, timeout=None):
+        return self.command_with_input(command, None)
+
+    def command_with_input(self, command, input_data):
+        process = subprocess.Popen(["/bin/sh", "-c", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output, _ = process.communicate(input_data)
+        return process.returncode, output.decode('utf-8', 'replace')
+
+    def push_and_extract(self, local_source, destination_dir=None, compression=None, timeout=None):
+        self.pushed.extend(os.path.basename(source) for source in local_source)
+        archive_path = os.path.join(destination_dir, ".push.tar")
+        with tarfile.open(archive_path, 'w') as archive:
+            for source in local_source:
+                archive.add(source, os.path.basename(source))
+        with tarfile.open(archive_path, 'r') as archive:
+            archive.extractall(destination_dir)
+        os.remove(archive_path)
+
+    def start_reverse_forward(self, remote_port, local_port):
+        self.forwards.append(local_port)
+        return local_port
+
+    def stop_reverse_forward(self, remote_port):
+        self.forwards.remove(remote_port)
+
+
+class YumMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.repo_dir = os.path.join(self.directory, "mirror")
+        self.remote_dir = os.path.join(self.directory, "remote")
+        repos_dir = os.path.join(self.directory, "yum.repos.d")
+        bin_dir = os.path.join(self.directory, "bin")
+        for directory in (repos_dir, bin_dir):
+            os.makedirs(directory)
+
+        createrepo_path = os.path.join(bin_dir, "createrepo_c")
+        with open(createrepo_path, 'w') as f:
+            f.write(_CREATEREPO_STUB)
+        os.chmod(createrepo_path, os.stat(createrepo_path).st_mode | stat.S_IEXEC)
+
+        patches = [mock.patch.dict(os.environ, {'PATH': bin_dir + os.pathsep + os.environ.get('PATH', "")}),
+                   mock.patch.object(yum, "YUM_REPO_DIR", repos_dir),
+                   mock.patch.object(yum, "download_packages", side_effect=self._download_packages)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.repo_file = os.path.join(repos_dir, mirror.DEFAULT_REPO_ID + ".repo")
+        self.node = _StandInNode()
+        self.mirror = mirror.YumMirror(self.repo_dir)
+        self.addCleanup(self.mirror.close)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _download_packages(self, package_list, download_dir, all_dependencies=False):
+        # Stands in for yum: each package depends on a "base" package the controller already has installed
+        paths = []
+        for package in list(package_list) + ["base"]:
+            path = os.path.join(download_dir, package + "-1.0-1.x86_64.rpm")
+            with open(path, 'w') as f:
+                f.write(package)
+            paths.append(path)
+        if not all_dependencies:
+            os.remove(paths[-1])
+        return paths[:-1]
+
+    def test_populate_downloads_the_full_dependency_closure(self):
+        paths = self.mirror.populate(["gcc", "cmake"])
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ["gcc-1.0-1.x86_64.rpm", "cmake-1.0-1.x86_64.rpm"])
+        self.assertEqual(self.mirror.get_packages(),
+                         ["base-1.0-1.x86_64.rpm", "cmake-1.0-1.x86_64.rpm", "gcc-1.0-1.x86_64.rpm"])
+        self.assertTrue(os.path.isfile(os.path.join(self.repo_dir, "repodata", "repomd.xml")))
+
+    def test_attach_by_sync_only_sends_changed_packages(self):
+        self.mirror.populate(["gcc"])
+        self.assertEqual(self.mirror.attach(self.node, mirror.ATTACH_SYNC, remote_dir=self.remote_dir),
+                         "file://" + self.remote_dir)
+        self.assertEqual(sorted(self.node.pushed), ["base-1.0-1.x86_64.rpm", "gcc-1.0-1.x86_64.rpm", "repodata"])
+        with open(self.repo_file) as f:
+            self.assertIn("baseurl=file://" + self.remote_dir + "\n", f.read())
+
+        os.remove(os.path.join(self.repo_dir, "gcc-1.0-1.x86_64.rpm"))
+        self.mirror.populate(["cmake"])
+        del self.node.pushed[:]
+        self.mirror.sync_to(self.node, self.remote_dir)
+        self.assertEqual(sorted(self.node.pushed), ["cmake-1.0-1.x86_64.rpm", "repodata"])
+        self.assertEqual(sorted(os.listdir(self.remote_dir)),
+                         ["base-1.0-1.x86_64.rpm", "cmake-1.0-1.x86_64.rpm", "repodata"])
+
+        self.mirror.detach(self.node)
+        self.assertFalse(os.path.exists(self.repo_file))
+        self.assertTrue(os.path.isdir(self.remote_dir))
+
+    def test_attach_by_forward_serves_the_repo(self):
+        self.mirror.populate(["gcc"])
+        base_url = self.mirror.attach(self.node)
+        self.assertEqual(len(self.node.forwards), 1)
+        with open(self.repo_file) as f:
+            self.assertIn("baseurl=" + base_url + "\n", f.read())
+
+        response = urllib.request.urlopen(base_url + "gcc-1.0-1.x86_64.rpm", timeout=5)
+        try:
+            self.assertEqual(response.read(), b"gcc")
+        finally:
+            response.close()
+        response = urllib.request.urlopen(base_url + "repodata/repomd.xml", timeout=5)
+        try:
+            self.assertIn(b"base-1.0-1.x86_64.rpm", response.read())
+        finally:
+            response.close()
+
+        self.mirror.detach(self.node)
+        self.assertEqual(self.node.forwards, [])
+        self.assertFalse(os.path.exists(self.repo_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
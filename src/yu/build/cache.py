@@ -0,0 +1,265 @@
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import threading
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".yu", "build-cache")
+DEFAULT_MAX_SIZE_BYTES = 20 * 1024 * 1024 * 1024
+
+_ARCHIVE_SUFFIX = ".tar.gz"
+
+# Everything that decides what the compiler produces on a node; the output is hashed into the toolchain fingerprint
+_TOOLCHAIN_COMMAND = ("uname -m; cat /etc/os-release 2>/dev/null; cmake --version 2>&1 | head -n 1; "
+                      "cc --version 2>&1 | head -n 1; c++ --version 2>&1 | head -n 1; "
+                      "make --version 2>&1 | head -n 1; ninja --version 2>&1; true")
+
+
+def build_key(commit, cmake_arguments, make_arguments, toolchain_fingerprint):
+    """
+    Work out the cache key for a build
+
+    :param commit: the revision of the source being built
+    :param cmake_arguments: the arguments passed to cmake, excluding the source directory
+    :param make_arguments: the arguments passed to make, excluding the -j value
+    :param toolchain_fingerprint: the fingerprint of the node's toolchain, see BuildCache.toolchain_fingerprint
+    :return: the key as a hex string
+    """
+    description = json.dumps([commit, [str(argument) for argument in cmake_arguments],
+                              [str(argument) for argument in make_arguments], toolchain_fingerprint])
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+class BuildCache(object):
+    """
+    A local store of build outputs keyed on the source revision, the cmake and make arguments and the node's
+    toolchain, so a configuration that has already been built on one BuildNode doesn't have to be built again on
+    another.
+
+    Each entry is a gzipped tarball of the build's artifacts, paths relative to the build directory. Entries are
+    evicted least recently used first once the store grows beyond max_size_bytes.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        """
+        :param cache_dir: the local directory to keep the cache in (optional) default = ~/.yu/build-cache
+        :param max_size_bytes: the size the cache is trimmed back to after each store (optional) default = 20GiB
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+
+        self.m_lock = threading.Lock()
+        self.m_fingerprints = {}
+        self.m_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _archive_path(self, key):
+        return os.path.join(self.cache_dir, key + _ARCHIVE_SUFFIX)
+
+    def toolchain_fingerprint(self, node):
+        """
+        Fingerprint the compiler, cmake, make and OS versions on the node. The result is remembered for each node
+
+        :param node: the BuildNode
+        :return: the fingerprint as a hex string
+        :raises RuntimeError if the toolchain couldn't be queried
+        """
+        with self.m_lock:
+            if node in self.m_fingerprints:
+                return self.m_fingerprints[node]
+
+        result_code, result_string = node.command(_TOOLCHAIN_COMMAND)
+        if result_code != 0:
+            raise RuntimeError("Failed to query the toolchain on " + node.get_host_to_connect_to() + ": " +
+                               result_string)
+        fingerprint = hashlib.sha256(result_string.encode("utf-8")).hexdigest()
+        with self.m_lock:
+            self.m_fingerprints[node] = fingerprint
+        return fingerprint
+
+    @staticmethod
+    def source_revision(node, source_dir):
+        """
+        Identify the state of a git checkout on a node: the HEAD commit plus a hash of any changes to tracked files,
+        so builds of a working tree pushed with BuildNode.push_working_tree are only shared with identical trees.
+        Untracked files are not taken into account.
+
+        :param node: the BuildNode
+        :param source_dir: the path of the checkout on the node
+        :return: the revision as a string
+        :raises RuntimeError if source_dir isn't a git checkout
+        """
+        result_code, result_string = node.command("cd " + source_dir + " && git rev-parse HEAD && "
+                                                  "git diff HEAD | sha256sum")
+        fields = result_string.split()
+        if result_code != 0 or len(fields) < 2:
+            raise RuntimeError("Failed to read the revision of " + source_dir + ": " + result_string)
+        return fields[0] + ":" + fields[1]
+
+    def key_for(self, node, source_dir, cmake_arguments, make_arguments):
+        """
+        Work out the cache key for building the checkout at source_dir on the node
+
+        :return: the key as a hex string
+        """
+        return build_key(self.source_revision(node, source_dir), cmake_arguments, make_arguments,
+                         self.toolchain_fingerprint(node))
+
+    def contains(self, key):
+        """
+        Check whether the cache holds an entry, recording a hit or a miss. A hit marks the entry as recently used
+
+        :param key: the key from build_key or key_for
+        :return: True if the entry is in the cache
+        """
+        archive_path = self._archive_path(key)
+        try:
+            os.utime(archive_path, None)
+            hit = True
+        except OSError:
+            hit = False
+        with self.m_lock:
+            self.m_stats['hits' if hit else 'misses'] += 1
+        return hit
+
+    def store(self, node, key, remote_directory, artifacts):
+        """
+        Stream the artifacts of a build from the node into the cache. The archive is written by `tar -cz` on the
+        node and received as it is produced, so it is never held in memory or written to disk on the node.
+
+        :param node: the BuildNode the build ran on
+        :param key: the key from build_key or key_for
+        :param remote_directory: the build directory on the node the artifact paths are relative to
+        :param artifacts: the paths of the files or directories to store, relative to remote_directory
+        :raises RuntimeError if the artifacts couldn't be archived
+        """
+        archive_path = self._archive_path(key)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".partial")
+        try:
+            with os.fdopen(file_descriptor, 'wb') as f:
+                # stderr is combined with the output stream so it has to be kept out of the archive
+                result_code = node.command_streamed("tar -cz -C " + remote_directory + " " +
+                                                    " ".join(str(artifact) for artifact in artifacts) +
+                                                    " 2>/dev/null", f.write)
+            if result_code != 0 or not tarfile.is_tarfile(temporary_path):
+                raise RuntimeError("Failed to archive the artifacts in " + remote_directory + " on " +
+                                   node.get_host_to_connect_to() + " (code " + str(result_code) + ")")
+            os.replace(temporary_path, archive_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        with self.m_lock:
+            self.m_stats['stores'] += 1
+        self.evict()
+
+    def fetch(self, node, key, remote_directory):
+        """
+        Stream a cached entry to a node and extract it into remote_directory with BuildNode.push_and_extract
+
+        :param node: the BuildNode to put the artifacts on
+        :param key: the key from build_key or key_for
+        :param remote_directory: the directory to extract the artifacts into; it is created if it doesn't exist
+        :raises IOError if the entry isn't in the cache
+        :raises RuntimeError if the transfer fails
+        """
+        archive_path = self._archive_path(key)
+        if not os.path.isfile(archive_path):
+            raise IOError("No build cache entry for " + key)
+        node.push_and_extract(archive_path, remote_directory)
+
+    def extract(self, key, destination_dir, flatten=False):
+        """
+        Extract a cached entry locally
+
+        :param key: the key from build_key or key_for
+        :param destination_dir: the local directory to extract into; it is created if it doesn't exist
+        :param flatten: set to True to extract each file straight into destination_dir under its basename rather
+                        than at its path relative to the build directory (optional) default = False
+        :return: the paths of the extracted files
+        :raises IOError if the entry isn't in the cache
+        """
+        archive_path = self._archive_path(key)
+        if not os.path.isfile(archive_path):
+            raise IOError("No build cache entry for " + key)
+        if not os.path.isdir(destination_dir):
+            os.makedirs(destination_dir)
+
+        extracted = []
+        with tarfile.open(archive_path, 'r:gz') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                relative_path = os.path.basename(member.name) if flatten else os.path.normpath(member.name)
+                if relative_path.startswith("..") or os.path.isabs(relative_path):
+                    raise IOError("Build cache entry " + key + " contains an unsafe path: " + member.name)
+                path = os.path.join(destination_dir, relative_path)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                source = tar.extractfile(member)
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(source, f)
+                os.chmod(path, member.mode & 0o777)
+                extracted.append(path)
+        return extracted
+
+    def _entries(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(_ARCHIVE_SUFFIX):
+                continue
+            try:
+                file_stat = os.stat(os.path.join(self.cache_dir, filename))
+            except OSError:
+                continue
+            entries.append((file_stat.st_mtime, file_stat.st_size, filename))
+        return entries
+
+    def evict(self, max_size_bytes=None):
+        """
+        Remove the least recently used entries until the cache fits within max_size_bytes
+
+        :param max_size_bytes: the size to trim the cache to (optional) default = the cache's max_size_bytes
+        :return: the number of entries removed
+        """
+        if max_size_bytes is None:
+            max_size_bytes = self.max_size_bytes
+
+        entries = sorted(self._entries(), reverse=True)
+        total = 0
+        removed = 0
+        for _, size, filename in entries:
+            total += size
+            if total > max_size_bytes:
+                try:
+                    os.remove(os.path.join(self.cache_dir, filename))
+                    removed += 1
+                except OSError:
+                    pass
+        with self.m_lock:
+            self.m_stats['evictions'] += removed
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry from the cache
+        """
+        self.evict(0)
+
+    def get_stats(self):
+        """
+        :return: a dictionary of the hits, misses, stores and evictions since the cache was created, the hit_rate
+                 (None before the first lookup) and the number of entries and total size in bytes of the cache
+        """
+        entries = self._entries()
+        with self.m_lock:
+            stats = dict(self.m_stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else None
+        stats['entries'] = len(entries)
+        stats['size_bytes'] = sum(size for _, size, _ in entries)
+        return stats
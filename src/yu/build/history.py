@@ -0,0 +1,230 @@
+import os
+import time
+import sqlite3
+import threading
+
+
+BUILD_HISTORY_FILE = os.path.join(os.path.expanduser("~"), ".yu", "build_history.sqlite3")
+
+DEFAULT_BASELINE_WINDOW = 10
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+DEFAULT_MIN_BASELINE_SAMPLES = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS phases (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    node TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    configuration TEXT NOT NULL,
+    commit_id TEXT,
+    duration REAL NOT NULL,
+    output_bytes INTEGER,
+    succeeded INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_by_group ON phases (node, phase, configuration, time);
+"""
+
+_COLUMNS = ("time", "node", "phase", "configuration", "commit_id", "duration", "output_bytes", "succeeded")
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class BuildHistory(object):
+    """
+    A local SQLite store of how long each build phase (clone, configure and build) took on each node, for each
+    configuration and commit, along with the number of bytes of output the phase produced.
+
+    Attach it to BuildNodes with BuildNode.enable_build_history to have every phase recorded, then use
+    find_regressions or report to spot builds that got slower than the rolling baseline of earlier builds of the
+    same configuration on the same node.
+    """
+    def __init__(self, path=BUILD_HISTORY_FILE):
+        """
+        :param path: the SQLite database file; it is created if it doesn't exist
+                     (optional) default = ~/.yu/build_history.sqlite3
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.m_lock = threading.Lock()
+        # BuildNodes record from the scheduler's worker threads, so the connection is shared behind m_lock
+        self.m_connection = sqlite3.connect(path, check_same_thread=False)
+        self.m_connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self.m_lock:
+            self.m_connection.close()
+
+    def record(self, node, phase, duration, configuration="", commit=None, output_bytes=None, succeeded=True,
+               timestamp=None):
+        """
+        Record one run of a build phase
+
+        :param node: the address of the node the phase ran on
+        :param phase: the phase, one of yu.build.remote.PHASE_CLONE, PHASE_CONFIGURE or PHASE_BUILD
+        :param duration: the number of seconds the phase took
+        :param configuration: what was built, e.g. the cmake arguments (optional)
+        :param commit: the commit that was built (optional)
+        :param output_bytes: the number of bytes of output the phase produced (optional)
+        :param succeeded: whether the phase succeeded (optional) default = True
+        :param timestamp: when the phase finished (optional) default = now
+        """
+        with self.m_lock, self.m_connection:
+            self.m_connection.execute("INSERT INTO phases (" + ", ".join(_COLUMNS) + ") VALUES (" +
+                                      ", ".join("?" * len(_COLUMNS)) + ")",
+                                      (time.time() if timestamp is None else timestamp, node, phase,
+                                       configuration or "", commit, duration, output_bytes, int(bool(succeeded))))
+
+    def get_records(self, node=None, phase=None, configuration=None, commit=None, since=None, succeeded=None,
+                    limit=None):
+        """
+        Get recorded phases, oldest first, optionally filtered
+
+        :param node: only return phases that ran on this node (optional)
+        :param phase: only return this phase (optional)
+        :param configuration: only return phases of this configuration (optional)
+        :param commit: only return phases that built this commit (optional)
+        :param since: only return phases recorded at or after this time (optional)
+        :param succeeded: only return phases that succeeded (True) or failed (False) (optional)
+        :param limit: only return the most recent limit records (optional)
+        :return: a list of dictionaries with time, node, phase, configuration, commit, duration, output_bytes and
+                 succeeded keys
+        """
+        conditions = []
+        parameters = []
+        for column, value in (("node", node), ("phase", phase), ("configuration", configuration),
+                              ("commit_id", commit)):
+            if value is not None:
+                conditions.append(column + " = ?")
+                parameters.append(value)
+        if since is not None:
+            conditions.append("time >= ?")
+            parameters.append(since)
+        if succeeded is not None:
+            conditions.append("succeeded = ?")
+            parameters.append(int(bool(succeeded)))
+
+        query = "SELECT " + ", ".join(_COLUMNS) + " FROM phases"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY time DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT " + str(int(limit))
+
+        with self.m_lock:
+            rows = self.m_connection.execute(query, parameters).fetchall()
+
+        records = []
+        for row in reversed(rows):
+            record = dict(zip(_COLUMNS, row))
+            record['commit'] = record.pop('commit_id')
+            record['succeeded'] = bool(record['succeeded'])
+            records.append(record)
+        return records
+
+    def get_baseline(self, node, phase, configuration="", window=DEFAULT_BASELINE_WINDOW, before=None):
+        """
+        Get the rolling baseline duration of a phase: the median of its last window successful runs
+
+        :param node: the address of the node
+        :param phase: the phase
+        :param configuration: the configuration (optional)
+        :param window: the number of runs the baseline covers (optional) default = 10
+        :param before: only consider runs recorded before this time (optional) default = all runs
+        :return: the baseline duration in seconds; None if there are no successful runs
+        """
+        query = "SELECT duration FROM phases WHERE node = ? AND phase = ? AND configuration = ? AND succeeded = 1"
+        parameters = [node, phase, configuration or ""]
+        if before is not None:
+            query += " AND time < ?"
+            parameters.append(before)
+        query += " ORDER BY time DESC, id DESC LIMIT " + str(int(window))
+
+        with self.m_lock:
+            durations = [row[0] for row in self.m_connection.execute(query, parameters)]
+        return _median(durations) if durations else None
+
+    def find_regressions(self, threshold=DEFAULT_REGRESSION_THRESHOLD, window=DEFAULT_BASELINE_WINDOW, since=None,
+                         node=None, phase=None, configuration=None, min_samples=DEFAULT_MIN_BASELINE_SAMPLES):
+        """
+        Find successful phases that took more than threshold longer than the baseline of the window runs of the same
+        phase and configuration on the same node before them
+
+        :param threshold: the fraction slower than the baseline a run has to be to count as a regression
+                          (optional) default = 0.2
+        :param window: the number of earlier runs each baseline covers (optional) default = 10
+        :param since: only check runs recorded at or after this time (optional) default = all runs
+        :param node: only check runs on this node (optional)
+        :param phase: only check this phase (optional)
+        :param configuration: only check this configuration (optional)
+        :param min_samples: the number of earlier runs needed before a baseline is trusted (optional) default = 3
+        :return: a list of the regressed records, oldest first, each with baseline (seconds) and slowdown
+                 (duration / baseline - 1) keys added
+        """
+        records = self.get_records(node=node, phase=phase, configuration=configuration, succeeded=True)
+
+        regressions = []
+        earlier_durations = {}
+        for record in records:
+            group = (record['node'], record['phase'], record['configuration'])
+            durations = earlier_durations.setdefault(group, [])
+            baseline_durations = durations[-window:]
+            if (since is None or record['time'] >= since) and len(baseline_durations) >= max(1, min_samples):
+                baseline = _median(baseline_durations)
+                if baseline > 0 and record['duration'] > baseline * (1 + threshold):
+                    regression = dict(record)
+                    regression['baseline'] = baseline
+                    regression['slowdown'] = record['duration'] / baseline - 1
+                    regressions.append(regression)
+            durations.append(record['duration'])
+            del durations[:-window]
+        return regressions
+
+    def report(self, threshold=DEFAULT_REGRESSION_THRESHOLD, window=DEFAULT_BASELINE_WINDOW, since=None, node=None,
+               min_samples=DEFAULT_MIN_BASELINE_SAMPLES):
+        """
+        Summarise the history: the latest run and baseline of each phase per node and configuration, followed by any
+        regressions
+
+        :param threshold: see find_regressions (optional) default = 0.2
+        :param window: see find_regressions (optional) default = 10
+        :param since: only report regressions recorded at or after this time (optional) default = all runs
+        :param node: only report on this node (optional)
+        :param min_samples: see find_regressions (optional) default = 3
+        :return: the report as a string
+        """
+        latest = {}
+        for record in self.get_records(node=node, succeeded=True):
+            latest[(record['node'], record['configuration'], record['phase'])] = record
+
+        lines = ["Node / configuration / phase: latest (baseline of last " + str(window) + ")"]
+        for group in sorted(latest):
+            record = latest[group]
+            baseline = self.get_baseline(record['node'], record['phase'], record['configuration'], window,
+                                         before=record['time'])
+            line = "  " + " / ".join(group) + ": " + str(round(record['duration'], 1)) + "s"
+            if baseline is not None:
+                line += " (" + str(round(baseline, 1)) + "s)"
+            if record['commit']:
+                line += " at " + record['commit'][:12]
+            lines.append(line)
+
+        regressions = self.find_regressions(threshold, window, since, node=node, min_samples=min_samples)
+        lines.append("Regressions over " + str(int(threshold * 100)) + "%: " + str(len(regressions)))
+        for regression in regressions:
+            lines.append("  " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(regression['time'])) + " " +
+                         regression['node'] + " / " + regression['configuration'] + " / " + regression['phase'] +
+                         ": " + str(round(regression['duration'], 1)) + "s vs " +
+                         str(round(regression['baseline'], 1)) + "s (+" +
+                         str(int(round(regression['slowdown'] * 100))) + "%)" +
+                         (" at " + regression['commit'][:12] if regression['commit'] else ""))
+        return "\n".join(lines)
@@ -1,8 +1,35 @@
 import os
+import re
+import time
+import uuid
+import tarfile
+import collections
+import tempfile
+import subprocess
 
 from yu.network.RemoteNode import RemoteNode
 
 
+PUSH_REF = "refs/yu/push"
+
+PHASE_CLONE = "clone"
+PHASE_CONFIGURE = "configure"
+PHASE_BUILD = "build"
+
+# The number of lines of output kept in memory for error messages when a command fails
+LOG_TAIL_LINES = 200
+
+# The memory assumed to be needed by each compile job when picking the parallelism of a build
+DEFAULT_MEMORY_PER_JOB = 1024 * 1024 * 1024
+
+# The ccache --print-stats counters that make up compiler cache hits and misses
+_CCACHE_HIT_COUNTERS = ("direct_cache_hit", "preprocessed_cache_hit", "cache_hit_direct", "cache_hit_preprocessed")
+_CCACHE_MISS_COUNTERS = ("cache_miss",)
+
+_MAKE_PROGRESS_PATTERN = re.compile(r"^\[\s*(\d+)%\]")
+_NINJA_PROGRESS_PATTERN = re.compile(r"^\[(\d+)/(\d+)\]")
+
+
 class GitException(Exception):
     pass
 
@@ -15,9 +42,150 @@ class MakeException(Exception):
     pass
 
 
+def _project_name(repo_address):
+    return repo_address.rstrip('/').rsplit('/', 1)[-1].rsplit('.', 1)[0]
+
+
+class _BuildProgress(object):
+    def __init__(self, phase, percent, completed=None, total=None, line=None):
+        self.phase = phase
+        self.percent = percent
+        self.completed = completed
+        self.total = total
+        self.line = line
+
+    def __repr__(self):
+        return "<" + self.phase + " " + str(self.percent) + "%>"
+
+
+def _parse_progress(phase, line):
+    match = _MAKE_PROGRESS_PATTERN.match(line)
+    if match:
+        return _BuildProgress(phase, int(match.group(1)), line=line)
+    match = _NINJA_PROGRESS_PATTERN.match(line)
+    if match:
+        completed, total = int(match.group(1)), int(match.group(2))
+        return _BuildProgress(phase, 100 * completed // max(1, total), completed, total, line)
+    return None
+
+
+def _make_configuration(arguments_list):
+    # -j and -l only change how fast a build runs, and are picked per run from the node's load and memory, so they're
+    # left out of the configuration builds are compared under
+    configuration = []
+    skip_value = False
+    for arg in (str(arg) for arg in arguments_list):
+        if skip_value:
+            skip_value = False
+            if arg.replace(".", "", 1).isdigit():
+                continue
+        if arg in ("-j", "-l", "--jobs", "--load-average", "--max-load"):
+            skip_value = True
+            continue
+        if arg.startswith(("-j", "-l", "--jobs=", "--load-average=", "--max-load=")):
+            continue
+        configuration.append(arg)
+    return " ".join(configuration)
+
+
+def _run_local_git(repo_path, args_list, input_data=None):
+    try:
+        process = subprocess.Popen(["git", "-C", repo_path] + args_list, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate(input_data)
+    except OSError as e:
+        raise GitException("Couldn't run git: " + str(e))
+    if process.returncode != 0:
+        raise GitException("git " + " ".join(args_list) + " failed in " + repo_path + ": " +
+                           error.decode('utf-8', 'replace'))
+    return output
+
+
+def _relative_tar_writer(root, relative_paths):
+    def write_tar(stream):
+        with tarfile.open(fileobj=stream, mode="w|") as tar:
+            for relative_path in relative_paths:
+                tar.add(os.path.join(root, relative_path), arcname=relative_path, recursive=False)
+    return write_tar
+
+
 class BuildNode(RemoteNode):
     def __init__(self, hostname):
         super(BuildNode, self).__init__(hostname)
+        # The number of seconds the most recent run of each phase (clone, configure and build) took
+        self.phase_timings = {}
+        # The compiler cache launcher and its directory, set by enable_compiler_cache
+        self.compiler_launcher = None
+        self.compiler_cache_dir = None
+        # The compiler cache hits, misses and hit_ratio of the most recent run_make, when the cache is enabled
+        self.compiler_cache_stats = None
+        # The yu.build.history.BuildHistory each phase is recorded in, set by enable_build_history
+        self.build_history = None
+        self.m_build_configurations = {}
+
+    def enable_build_history(self, history):
+        """
+        Record the duration, output size, configuration and commit of every clone, configure and build phase run on
+        this node. Recording costs one extra `git rev-parse` per phase to find the commit being built
+
+        :param history: the yu.build.history.BuildHistory to record in
+        """
+        self.build_history = history
+
+    def disable_build_history(self):
+        self.build_history = None
+
+    def _record_phase(self, phase, duration, directory, configuration, output_bytes, succeeded):
+        if self.build_history is None:
+            return
+        result_code, result_string = self.command("cd " + directory + " && git rev-parse HEAD")
+        commit = result_string.strip() if result_code == 0 and result_string.strip() else None
+        self.build_history.record(self.location.address, phase, duration, configuration, commit, output_bytes,
+                                  succeeded)
+
+    def _run_phase(self, phase, command, output_callback=None, progress_callback=None, directory=None,
+                   configuration=""):
+        """
+        Run a command, streaming its output line by line to output_callback and parsing make and ninja progress
+        lines ("[ 42%]" or "[12/345]") into progress events for progress_callback.
+        Only the last LOG_TAIL_LINES lines of output are kept in memory.
+        The phase is recorded in the build history, if enabled, under configuration and the commit in directory.
+
+        :return: a tuple of the result code, the tail of the output and the total number of bytes of output
+        """
+        tail = collections.deque(maxlen=LOG_TAIL_LINES)
+        state = {'partial': b'', 'bytes': 0}
+
+        def handle_line(raw_line):
+            line = raw_line.decode('utf-8', 'replace').rstrip("\r")
+            tail.append(line)
+            if output_callback is not None:
+                output_callback(line)
+            if progress_callback is not None:
+                progress = _parse_progress(phase, line)
+                if progress is not None:
+                    progress_callback(progress)
+
+        def handle_output(data):
+            state['bytes'] += len(data)
+            lines = (state['partial'] + data).split(b'\n')
+            state['partial'] = lines.pop()
+            for raw_line in lines:
+                handle_line(raw_line)
+
+        start = time.time()
+        try:
+            result_code = self.command_streamed(command, handle_output)
+            if state['partial']:
+                handle_line(state['partial'])
+        finally:
+            # Several jobs can run on a node at once, so phase_timings only mirrors the duration that is recorded
+            duration = time.time() - start
+            self.phase_timings[phase] = duration
+        if directory is not None:
+            self._record_phase(phase, duration, directory, configuration, state['bytes'],
+                               result_code == 0)
+        return result_code, "\n".join(tail), state['bytes']
 
     def git_clone(self, repo_address, checkout_location="/tmp"):
         """
@@ -36,19 +204,201 @@ class BuildNode(RemoteNode):
         git_clone_command = "cd " + checkout_location + "; "
         git_clone_command += "git clone --recurse-submodules " + repo_address
 
+        checkout_path = os.path.join(checkout_location, _project_name(repo_address))
+        start = time.time()
         result_code, result_string = self.command(git_clone_command)
+        duration = time.time() - start
+        self.phase_timings[PHASE_CLONE] = duration
+        self._record_phase(PHASE_CLONE, duration, checkout_path, repo_address, len(result_string), result_code == 0)
         if result_code != 0:
             raise GitException("Failed to clone " + repo_address + ": " + result_string)
 
-        project_name = repo_address.rsplit('/', 1)[-1].rsplit('.', 1)[0]
-        return os.path.join(checkout_location, project_name)
+        return checkout_path
+
+    def ensure_checkout(self, repo_address, checkout_location="/tmp", ref=None, depth=None, blobless=False,
+                        reference_repo=None, submodules=True, clean=False):
+        """
+        Make sure an up to date checkout of ref from the git repo provided exists on this node in the checkout location.
+        If a clone already exists there it is fetched and reset to ref, so only new objects are transferred;
+        otherwise a new clone is made.
 
-    def run_cmake(self, remote_directory, arguments_list):
+        :param repo_address: the git repo to check out
+        :param checkout_location: the directory the repo is (or will be) cloned into
+        :param ref: the branch, tag or commit to check out (optional) default = the remote's HEAD
+        :param depth: only fetch this many commits of history (a shallow clone) (optional) default = full history
+        :param blobless: set to True to make a partial clone that fetches file contents on demand
+                         (optional) default = False
+        :param reference_repo: the path of a local mirror of the repo on this node to borrow objects from; it is
+                               ignored if it doesn't exist (optional)
+        :param submodules: whether to update submodules to match the checked out commit (optional) default = True
+        :param clean: set to True to also remove untracked and ignored files from the checkout
+                      (optional) default = False
+        :return: the remote path that the git repo is checked out into
+        :raises: IOError if the checkout_location provided does not exist
+        :raises: GitException if any of the git commands failed
         """
-        Run cmake in a directory on the node
+        if not self.is_dir(checkout_location):
+            raise IOError("Cannot perform git checkout as the checkout directory (" + checkout_location +
+                          ") does not exist")
+
+        start = time.time()
+        project_name = _project_name(repo_address)
+        checkout_path = os.path.join(checkout_location, project_name)
+        history_options = ""
+        if depth is not None:
+            history_options += " --depth " + str(int(depth))
+        if blobless:
+            history_options += " --filter=blob:none"
+
+        if not self.exists(os.path.join(checkout_path, ".git")):
+            git_clone_command = "cd " + checkout_location + "; "
+            git_clone_command += "git clone --no-checkout" + history_options
+            if reference_repo is not None:
+                git_clone_command += " --reference-if-able " + reference_repo
+            git_clone_command += " " + repo_address + " " + project_name
+
+            result_code, result_string = self.command(git_clone_command)
+            if result_code != 0:
+                raise GitException("Failed to clone " + repo_address + ": " + result_string)
+
+        git_update_command = "cd " + checkout_path + " && "
+        git_update_command += "git remote set-url origin " + repo_address + " && "
+        git_update_command += "git fetch --force" + history_options + " origin " + (ref or "HEAD") + " && "
+        git_update_command += "git checkout --force --detach FETCH_HEAD"
+        if clean:
+            git_update_command += " && git clean -ffdx"
+        if submodules:
+            git_update_command += " && git submodule sync --recursive"
+            git_update_command += " && git submodule update --init --recursive --force"
+            if depth is not None:
+                git_update_command += " --depth " + str(int(depth))
+
+        result_code, result_string = self.command(git_update_command)
+        duration = time.time() - start
+        self.phase_timings[PHASE_CLONE] = duration
+        self._record_phase(PHASE_CLONE, duration, checkout_path, repo_address, len(result_string), result_code == 0)
+        if result_code != 0:
+            raise GitException("Failed to update " + checkout_path + " to " + (ref or "HEAD") + " of " + repo_address +
+                               ": " + result_string)
+        return checkout_path
+
+    def push_repository(self, local_repo, remote_path, ref="HEAD"):
+        """
+        Ship a commit of a local git repo to a repo on this node and check it out, without needing a git server.
+        Only the commits this node's repo doesn't already have are sent, as a git bundle streamed over the SSH
+        connection, so the upload is proportional to what has changed rather than the size of the repo.
+        The repo on this node is created if it doesn't exist.
+
+        :param local_repo: the path of the local git repo
+        :param remote_path: the path of the repo on this node
+        :param ref: the local branch, tag or commit to push (optional) default = HEAD
+        :return: the hash of the commit that was checked out
+        :raises: GitException if any of the git commands failed
+        """
+        commit = _run_local_git(local_repo, ["rev-parse", "--verify", ref + "^{commit}"]).decode().strip()
+
+        git_state_command = "mkdir -p " + remote_path + " && cd " + remote_path + " && "
+        git_state_command += "{ git rev-parse --git-dir > /dev/null 2>&1 || git init -q; } && "
+        git_state_command += "git for-each-ref --format='%(objectname)' && "
+        git_state_command += "{ git cat-file -e " + commit + "^{commit} 2> /dev/null && echo HAVE-" + commit
+        git_state_command += " || true; }"
+        result_code, result_string = self.command(git_state_command)
+        if result_code != 0:
+            raise GitException("Failed to inspect the git repo at " + remote_path + ": " + result_string)
+
+        if "HAVE-" + commit not in result_string.split():
+            remote_tips = [line.strip() for line in result_string.split() if len(line.strip()) == len(commit)]
+            self._push_bundle(local_repo, remote_path, commit, remote_tips)
+
+        git_checkout_command = "cd " + remote_path + " && git checkout --force --detach " + commit
+        result_code, result_string = self.command(git_checkout_command)
+        if result_code != 0:
+            raise GitException("Failed to check out " + commit + " in " + remote_path + ": " + result_string)
+        return commit
+
+    def _push_bundle(self, local_repo, remote_path, commit, remote_tips):
+        known_bases = []
+        if remote_tips:
+            batch_check = _run_local_git(local_repo, ["cat-file", "--batch-check"],
+                                         ("\n".join(remote_tips) + "\n").encode())
+            for line in batch_check.decode().splitlines():
+                fields = line.split()
+                if len(fields) == 3 and fields[1] == "commit":
+                    known_bases.append(fields[0])
+
+        bundle_file, bundle_path = tempfile.mkstemp(suffix=".bundle")
+        os.close(bundle_file)
+        # Pushes of the same repo to several nodes can run at once, so each bundles its own ref
+        local_ref = PUSH_REF + "-" + uuid.uuid4().hex
+        try:
+            _run_local_git(local_repo, ["update-ref", local_ref, commit])
+            bundle_args = ["bundle", "create", bundle_path, local_ref]
+            if known_bases:
+                bundle_args += ["--not"] + known_bases
+            _run_local_git(local_repo, bundle_args)
+
+            remote_bundle = os.path.join(remote_path, ".git", "yu-push.bundle")
+            git_fetch_command = "cd " + remote_path + " && cat > " + remote_bundle + " && "
+            git_fetch_command += "git fetch -q " + remote_bundle + " +" + local_ref + ":" + PUSH_REF + "; "
+            git_fetch_command += "result=$?; rm -f " + remote_bundle + "; exit $result"
+            with open(bundle_path, 'rb') as bundle:
+                result_code, result_string = self.command_with_input(git_fetch_command, bundle)
+            if result_code != 0:
+                raise GitException("Failed to fetch the pushed commits into " + remote_path + ": " + result_string)
+        finally:
+            os.remove(bundle_path)
+            _run_local_git(local_repo, ["update-ref", "-d", local_ref])
+
+    def push_working_tree(self, local_repo, remote_path, clean=False):
+        """
+        Make the repo at remote_path on this node match the local working tree, including uncommitted changes.
+        The HEAD commit is pushed with push_repository, then the local changes to tracked files are sent as a
+        binary diff and untracked (but not ignored) files are streamed across in a tar, so only what differs
+        from HEAD is transferred.
+
+        :param local_repo: the path of the local git repo
+        :param remote_path: the path of the repo on this node
+        :param clean: set to True to remove untracked files from the remote checkout before syncing, including
+                      files left by earlier pushes and build outputs (optional) default = False
+        :return: the hash of the HEAD commit the working tree is based on
+        :raises: GitException if any of the git commands failed
+        """
+        repo_root = _run_local_git(local_repo, ["rev-parse", "--show-toplevel"]).decode().strip()
+        commit = self.push_repository(repo_root, remote_path, "HEAD")
+        if clean:
+            result_code, result_string = self.command("cd " + remote_path + " && git clean -ffdx")
+            if result_code != 0:
+                raise GitException("Failed to clean " + remote_path + ": " + result_string)
+
+        diff = _run_local_git(repo_root, ["diff", "--binary", "HEAD"])
+        if diff:
+            git_apply_command = "cd " + remote_path + " && git apply --whitespace=nowarn -"
+            result_code, result_string = self.command_with_input(git_apply_command, diff)
+            if result_code != 0:
+                raise GitException("Failed to apply local changes in " + remote_path + ": " + result_string)
+
+        untracked = _run_local_git(repo_root, ["ls-files", "--others", "--exclude-standard", "-z"])
+        untracked_paths = [path.decode() for path in untracked.split(b'\x00') if path]
+        if untracked_paths:
+            result_code, result_string = self.command_with_input("tar -xf - -C " + remote_path,
+                                                                 _relative_tar_writer(repo_root, untracked_paths))
+            if result_code != 0:
+                raise GitException("Failed to copy untracked files to " + remote_path + ": " + result_string)
+        return commit
+
+    def run_cmake(self, remote_directory, arguments_list, output_callback=None, progress_callback=None):
+        """
+        Run cmake in a directory on the node.
+        The output is streamed as it is produced; only its tail is kept in memory and included in any error.
+        If the compiler cache is enabled the C and C++ compiler launchers are set to it, unless arguments_list
+        already sets them.
 
         :param remote_directory: the directory to run the cmake command in
         :param arguments_list: a list containing the arguments which should be passed to the cmake command
+        :param output_callback: a callable passed each line of output as it arrives (optional)
+        :param progress_callback: a callable passed a progress event (with phase, percent, completed and total
+                                  attributes) for each progress line in the output (optional)
+        :return: the last LOG_TAIL_LINES lines of the output of the cmake command
         :raises: IOError if the remote_directory provided does not exist
         :raises: CMakeException if the cmake command fails
         """
@@ -56,22 +406,46 @@ class BuildNode(RemoteNode):
             raise IOError("Cannot perform cmake command as the remote directory (" + remote_directory +
                           ") does not exist")
 
+        arguments_list = list(arguments_list)
+        # Keyed on the caller's arguments so builds with and without the compiler cache launcher are compared together
+        configuration = " ".join(str(arg) for arg in arguments_list)
+        if self.compiler_launcher is not None:
+            for language in ("C", "CXX"):
+                launcher_option = "-DCMAKE_" + language + "_COMPILER_LAUNCHER"
+                if not any(str(arg).startswith(launcher_option) for arg in arguments_list):
+                    arguments_list.insert(0, launcher_option + "=" + self.compiler_launcher)
+
         cmake_command = "cd " + remote_directory + "; "
         cmake_command += "cmake "
         for arg in arguments_list:
             cmake_command += str(arg) + " "
 
-        result_code, result_string = self.command(cmake_command)
+        self.m_build_configurations[remote_directory] = configuration
+        result_code, output_tail, _ = self._run_phase(PHASE_CONFIGURE, cmake_command, output_callback,
+                                                      progress_callback, remote_directory, configuration)
         if result_code != 0:
-            raise CMakeException("cmake command failed with code " + result_code + ": " + result_string)
+            raise CMakeException("cmake command failed with code " + str(result_code) + ": " + output_tail)
+        return output_tail
 
-    def run_make(self, remote_directory, arguments_list):
+    def run_make(self, remote_directory, arguments_list, output_callback=None, progress_callback=None,
+                 optimized=False, memory_per_job=DEFAULT_MEMORY_PER_JOB):
         """
-        Run make with in the remote directory with the arguments provided
+        Run make with in the remote directory with the arguments provided.
+        The output is streamed as it is produced; only its tail is kept in memory and included in any error.
+        If the compiler cache is enabled its hit ratio for the build is stored in compiler_cache_stats and reported
+        as the last line of the output.
 
         :param remote_directory: the remote directory to run the make command in
         :param arguments_list: the arguments to pass to the make command.
                                Each item in the list will be separated by a space.
+        :param output_callback: a callable passed each line of output as it arrives (optional)
+        :param progress_callback: a callable passed a progress event (with phase, percent, completed and total
+                                  attributes) for each "[ 42%]" progress line in the output (optional)
+        :param optimized: set to True to add -j and -l values picked by get_parallelism when arguments_list
+                          doesn't give them (optional) default = False
+        :param memory_per_job: the memory each compile job is expected to need, in bytes, when optimized is set
+                               (optional) default = 1GiB
+        :return: the last LOG_TAIL_LINES lines of the output of the make command
         :raises: IOError if the remote_directory provided does not exist
         :raises: MakeException if the make command fails
         """
@@ -79,11 +453,161 @@ class BuildNode(RemoteNode):
             raise IOError("Cannot perform make command as the remote directory (" + remote_directory +
                           ") does not exist")
 
+        arguments_list = list(arguments_list)
+        # Builds are grouped under the cmake configuration of their directory plus the make arguments
+        configuration = self.m_build_configurations.get(remote_directory, "") + " && make " + \
+            _make_configuration(arguments_list)
+        if optimized:
+            jobs, load_limit = self.get_parallelism(memory_per_job)
+            if not any(str(arg).startswith(("-l", "--load-average")) for arg in arguments_list):
+                arguments_list.insert(0, "-l" + str(load_limit))
+            if not any(str(arg).startswith(("-j", "--jobs")) for arg in arguments_list):
+                arguments_list.insert(0, "-j" + str(jobs))
+
         make_command = "cd " + remote_directory + "; "
+        if self.compiler_cache_dir is not None:
+            make_command += "export CCACHE_DIR=" + self.compiler_cache_dir + "; "
         make_command += "make "
         for arg in arguments_list:
             make_command += str(arg) + " "
 
-        result_code, result_string = self.command(make_command)
+        cache_counters = self._get_compiler_cache_counters() if self.compiler_launcher is not None else None
+        result_code, output_tail, _ = self._run_phase(PHASE_BUILD, make_command, output_callback, progress_callback,
+                                                      remote_directory, configuration)
+        if cache_counters is not None:
+            self.compiler_cache_stats = self._compiler_cache_stats_since(cache_counters)
+            if self.compiler_cache_stats is not None:
+                summary = "Compiler cache: " + str(self.compiler_cache_stats['hits']) + " hits, " + \
+                          str(self.compiler_cache_stats['misses']) + " misses"
+                if self.compiler_cache_stats['hit_ratio'] is not None:
+                    summary += " (" + str(round(self.compiler_cache_stats['hit_ratio'] * 100, 1)) + "% hit ratio)"
+                if output_callback is not None:
+                    output_callback(summary)
+                output_tail += "\n" + summary
         if result_code != 0:
-            raise MakeException("make command failed with code " + result_code + ": " + result_string)
+            raise MakeException("make command failed with code " + str(result_code) + ": " + output_tail)
+        return output_tail
+
+    def enable_compiler_cache(self, cache_dir=None, max_size=None):
+        """
+        Have builds on this node go through ccache.
+        run_cmake sets ccache as the C and C++ compiler launcher, so unchanged translation units are taken from the
+        cache rather than recompiled, and run_make reports the cache hit ratio of each build.
+        The cache persists on the node between builds and checkouts.
+
+        :param cache_dir: the directory on the node to keep the cache in (optional) default = ccache's default
+        :param max_size: the maximum size of the cache, in ccache's format e.g. "20G" (optional)
+                         default = leave the cache's limit as it is
+        :raises: RuntimeError if ccache isn't installed on the node or couldn't be configured
+        """
+        result_code, result_string = self.command("command -v ccache")
+        if result_code != 0 or not result_string.strip():
+            raise RuntimeError("ccache is not installed on " + self.location.address)
+        launcher = result_string.strip().splitlines()[0]
+
+        if max_size is not None:
+            ccache_command = "ccache -M " + str(max_size)
+            if cache_dir is not None:
+                ccache_command = "mkdir -p " + cache_dir + " && CCACHE_DIR=" + cache_dir + " " + ccache_command
+            result_code, result_string = self.command(ccache_command)
+            if result_code != 0:
+                raise RuntimeError("Failed to configure ccache on " + self.location.address + ": " + result_string)
+
+        self.compiler_launcher = launcher
+        self.compiler_cache_dir = cache_dir
+
+    def disable_compiler_cache(self):
+        """
+        Stop setting the compiler launcher in run_cmake. Build directories already configured with the launcher
+        keep using it until they are reconfigured
+        """
+        self.compiler_launcher = None
+        self.compiler_cache_dir = None
+        self.compiler_cache_stats = None
+
+    def _get_compiler_cache_counters(self):
+        ccache_command = "ccache --print-stats"
+        if self.compiler_cache_dir is not None:
+            ccache_command = "CCACHE_DIR=" + self.compiler_cache_dir + " " + ccache_command
+        result_code, result_string = self.command(ccache_command)
+        if result_code != 0:
+            # Older ccache versions can't print machine readable stats
+            return None
+        counters = {}
+        for line in result_string.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1].isdigit():
+                counters[fields[0]] = int(fields[1])
+        return counters
+
+    def _compiler_cache_stats_since(self, counters_before):
+        # The counters are compared rather than zeroed so builds running alongside each other don't reset each
+        # other's stats, though their hits and misses will be mixed
+        counters_after = self._get_compiler_cache_counters()
+        if counters_after is None:
+            return None
+
+        def change(names):
+            return sum(counters_after.get(name, 0) - counters_before.get(name, 0) for name in names)
+
+        hits = change(_CCACHE_HIT_COUNTERS)
+        misses = change(_CCACHE_MISS_COUNTERS)
+        return {'hits': hits, 'misses': misses,
+                'hit_ratio': float(hits) / (hits + misses) if hits + misses else None}
+
+    def get_cpu_count(self):
+        """
+        Get the number of CPUs available on this node
+
+        :return: the number of CPUs
+        :raises: RuntimeError if the CPU count could not be read
+        """
+        result_code, result_string = self.command("nproc")
+        if result_code != 0:
+            raise RuntimeError("Failed to get the CPU count of " + self.location.address + ": " + result_string)
+        return int(result_string.strip())
+
+    def get_load_average(self):
+        """
+        Get the one minute load average of this node
+
+        :return: the load average
+        :raises: RuntimeError if the load average could not be read
+        """
+        result_code, result_string = self.command("cat /proc/loadavg")
+        if result_code != 0:
+            raise RuntimeError("Failed to get the load average of " + self.location.address + ": " + result_string)
+        return float(result_string.split()[0])
+
+    def get_memory_available(self):
+        """
+        Get the memory available for new processes on this node, without swapping
+
+        :return: the available memory in bytes
+        :raises: RuntimeError if the memory could not be read
+        """
+        result_code, result_string = self.command("cat /proc/meminfo")
+        if result_code != 0:
+            raise RuntimeError("Failed to get the memory of " + self.location.address + ": " + result_string)
+        meminfo = {}
+        for line in result_string.splitlines():
+            fields = line.replace(":", " ").split()
+            if len(fields) >= 2 and fields[1].isdigit():
+                meminfo[fields[0]] = int(fields[1]) * 1024
+        if 'MemAvailable' in meminfo:
+            return meminfo['MemAvailable']
+        # Kernels older than 3.14 don't report MemAvailable
+        return meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+
+    def get_parallelism(self, memory_per_job=DEFAULT_MEMORY_PER_JOB):
+        """
+        Pick the make -j and -l values for this node: one job per CPU, fewer if the available memory can't hold
+        that many jobs, and a load limit of the CPU count so make holds back new jobs when the node is busy.
+
+        :param memory_per_job: the memory each compile job is expected to need, in bytes (optional) default = 1GiB
+        :return: a tuple of the number of jobs and the load limit
+        :raises: RuntimeError if the CPU count or memory could not be read
+        """
+        cpus = self.get_cpu_count()
+        jobs = min(cpus, self.get_memory_available() // max(1, memory_per_job))
+        return max(1, int(jobs)), cpus
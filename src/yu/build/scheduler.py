@@ -0,0 +1,284 @@
+import os
+import time
+import threading
+import collections
+
+from yu.build.remote import GitException, CMakeException, MakeException
+
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+DEFAULT_CPUS_PER_JOB = 4
+
+
+class ArtifactException(Exception):
+    pass
+
+
+class BuildJob(object):
+    """
+    A single configuration of a build: the cmake arguments to configure it with and the make arguments (e.g. the
+    target) to build it with, plus the files it produces that should be collected.
+    """
+    def __init__(self, name, cmake_arguments=None, make_arguments=None, artifacts=None):
+        """
+        :param name: a unique name for the job; it is used for the build directory and the local output directory
+        :param cmake_arguments: the arguments to pass to cmake (optional)
+        :param make_arguments: the arguments to pass to make, e.g. the target to build (optional)
+        :param artifacts: paths, relative to the job's build directory, of files to copy back when the job
+                          succeeds (optional)
+        """
+        self.name = name
+        self.cmake_arguments = list(cmake_arguments or [])
+        self.make_arguments = list(make_arguments or [])
+        self.artifacts = list(artifacts or [])
+
+        self.status = JOB_PENDING
+        self.attempts = 0
+        self.node = None
+        self.log_path = None
+        self.artifact_paths = []
+        self.error = None
+        self.duration = None
+        self.cached = False
+
+    def __repr__(self):
+        return "<BuildJob " + self.name + " " + self.status + ">"
+
+
+def build_matrix(cmake_argument_sets, make_argument_sets, artifacts=None):
+    """
+    Create a job for every combination of cmake arguments and make arguments
+
+    :param cmake_argument_sets: a dictionary of configuration name to cmake argument list
+    :param make_argument_sets: a dictionary of target name to make argument list
+    :param artifacts: a function taking (configuration name, target name) and returning the artifacts to collect
+                      for that job (optional)
+    :return: a list of BuildJob objects named "<configuration>-<target>"
+    """
+    jobs = []
+    for configuration in sorted(cmake_argument_sets):
+        for target in sorted(make_argument_sets):
+            job_artifacts = artifacts(configuration, target) if artifacts is not None else None
+            jobs.append(BuildJob(configuration + "-" + target, cmake_argument_sets[configuration],
+                                 make_argument_sets[target], job_artifacts))
+    return jobs
+
+
+class BuildScheduler(object):
+    """
+    Runs a set of BuildJobs concurrently across a pool of yu.build.remote.BuildNodes.
+
+    Each node is given a number of job slots based on its CPU count and current load, and idle slots take the next
+    job from a shared queue so faster nodes naturally take more of the work. A job that fails because of a build
+    error or an artifact that couldn't be collected is reported as failed; a job that fails because its node stopped
+    working is retried on another node and the node is taken out of the pool.
+    """
+    def __init__(self, nodes, prepare_source, output_dir="build-output", cpus_per_job=DEFAULT_CPUS_PER_JOB,
+                 max_retries=2, build_cache=None):
+        """
+        :param nodes: the BuildNodes to run jobs on; they must already be connected
+        :param prepare_source: a function taking a node and returning the path of the source tree on that node,
+                               e.g. lambda node: node.ensure_checkout(repo_address, ref=commit)
+                               It is called once per node before the node runs its first job
+        :param output_dir: the local directory that each job's log and artifacts are collected under
+                           (optional) default = build-output
+        :param cpus_per_job: the number of CPUs each job is expected to keep busy; used to work out how many jobs
+                             each node runs at once and the -j value passed to make (optional) default = 4
+        :param max_retries: the number of times a job is retried after a node failure (optional) default = 2
+        :param build_cache: a yu.build.cache.BuildCache; jobs with artifacts whose source revision, arguments and
+                            toolchain match an earlier build take their artifacts from the cache instead of
+                            building (optional)
+        """
+        self.nodes = list(nodes)
+        self.prepare_source = prepare_source
+        self.output_dir = output_dir
+        self.cpus_per_job = cpus_per_job
+        self.max_retries = max_retries
+        self.build_cache = build_cache
+
+        self.m_lock = threading.Condition()
+        self.m_queue = collections.deque()
+        self.m_outstanding = 0
+        self.m_live_nodes = 0
+        self.m_failed_nodes = set()
+        self.m_source_dirs = {}
+        self.m_prepare_locks = {}
+
+    def get_node_slots(self, node):
+        """
+        Work out how many jobs the node should run at once from its CPU count and current load
+
+        :param node: the BuildNode
+        :return: a tuple of the number of slots and the -j value each job's make should use
+        """
+        cpus = node.get_cpu_count()
+        idle_cpus = max(1.0, cpus - node.get_load_average())
+        slots = max(1, int(idle_cpus // self.cpus_per_job))
+        return slots, max(1, cpus // slots)
+
+    def run(self, jobs):
+        """
+        Run the jobs and wait for them all to finish
+
+        :param jobs: the BuildJob objects to run
+        :return: the jobs, with their status, node, log_path, artifact_paths, error and duration filled in
+        """
+        with self.m_lock:
+            self.m_queue.extend(jobs)
+            self.m_outstanding = len(jobs)
+
+        threads = []
+        for node in self.nodes:
+            try:
+                slots, make_parallelism = self.get_node_slots(node)
+            except Exception:
+                self.m_failed_nodes.add(node)
+                continue
+            self.m_prepare_locks[node] = threading.Lock()
+            for _ in range(slots):
+                thread = threading.Thread(target=self._worker, args=(node, make_parallelism))
+                thread.daemon = True
+                threads.append(thread)
+
+        with self.m_lock:
+            self.m_live_nodes = len(self.m_prepare_locks)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for job in jobs:
+            if job.status in (JOB_PENDING, JOB_RUNNING):
+                job.status = JOB_FAILED
+                job.error = job.error or "No working build nodes were left to run the job"
+        return jobs
+
+    def _next_job(self, node):
+        with self.m_lock:
+            while True:
+                if node in self.m_failed_nodes or self.m_outstanding == 0:
+                    return None
+                if self.m_queue:
+                    job = self.m_queue.popleft()
+                    job.status = JOB_RUNNING
+                    job.attempts += 1
+                    job.node = node
+                    return job
+                # Jobs are still running elsewhere and may be requeued if their node fails
+                self.m_lock.wait()
+
+    def _finish_job(self, job, status, error=None):
+        with self.m_lock:
+            job.status = status
+            job.error = error
+            self.m_outstanding -= 1
+            self.m_lock.notify_all()
+
+    def _fail_node(self, node, job, error):
+        with self.m_lock:
+            if node not in self.m_failed_nodes:
+                self.m_failed_nodes.add(node)
+                self.m_live_nodes -= 1
+            job.error = error
+            if job.attempts <= self.max_retries and self.m_live_nodes > 0:
+                job.status = JOB_PENDING
+                self.m_queue.append(job)
+            else:
+                job.status = JOB_FAILED
+                self.m_outstanding -= 1
+            if self.m_live_nodes == 0:
+                # Nobody is left to run what is still queued
+                for queued_job in self.m_queue:
+                    queued_job.status = JOB_FAILED
+                    queued_job.error = "No working build nodes were left to run the job"
+                self.m_outstanding -= len(self.m_queue)
+                self.m_queue.clear()
+            self.m_lock.notify_all()
+
+    def _source_dir(self, node):
+        with self.m_prepare_locks[node]:
+            if node not in self.m_source_dirs:
+                self.m_source_dirs[node] = self.prepare_source(node)
+            return self.m_source_dirs[node]
+
+    def _worker(self, node, make_parallelism):
+        while True:
+            job = self._next_job(node)
+            if job is None:
+                return
+
+            job_output_dir = os.path.join(self.output_dir, job.name)
+            if not os.path.isdir(job_output_dir):
+                os.makedirs(job_output_dir)
+            job.log_path = os.path.join(job_output_dir, "build.log")
+
+            start = time.time()
+            with open(job.log_path, 'w') as log:
+                log.write("Building " + job.name + " on " + node.get_host_to_connect_to() + " (attempt " +
+                          str(job.attempts) + ")\n")
+                try:
+                    self._build(node, job, make_parallelism, log)
+                    job.duration = time.time() - start
+                    self._finish_job(job, JOB_SUCCEEDED)
+                except (GitException, CMakeException, MakeException, ArtifactException) as e:
+                    job.duration = time.time() - start
+                    log.write(str(e) + "\n")
+                    if node.is_connected():
+                        self._finish_job(job, JOB_FAILED, str(e))
+                    else:
+                        self._fail_node(node, job, str(e))
+                        return
+                except Exception as e:
+                    job.duration = time.time() - start
+                    log.write("Build node failure: " + str(e) + "\n")
+                    self._fail_node(node, job, "Build node " + node.get_host_to_connect_to() + " failed: " + str(e))
+                    return
+
+    def _build(self, node, job, make_parallelism, log):
+        try:
+            source_dir = self._source_dir(node)
+        except Exception as e:
+            # A node that can't get the source can't run any job, so treat this as a node failure
+            raise RuntimeError("Couldn't prepare the source: " + str(e))
+        job_output_dir = os.path.dirname(job.log_path)
+        cache_key = None
+        if self.build_cache is not None and job.artifacts:
+            cache_key = self.build_cache.key_for(node, source_dir, job.cmake_arguments, job.make_arguments)
+            if self.build_cache.contains(cache_key):
+                log.write("Using cached build " + cache_key + "\n")
+                job.artifact_paths = self.build_cache.extract(cache_key, job_output_dir, flatten=True)
+                job.cached = True
+                return
+
+        build_dir = os.path.join(source_dir, "build-" + job.name)
+        result_code, result_string = node.command("mkdir -p " + build_dir)
+        if result_code != 0:
+            raise RuntimeError("Couldn't create " + build_dir + ": " + result_string)
+
+        def write_line(line):
+            log.write(line + "\n")
+
+        node.run_cmake(build_dir, job.cmake_arguments + [source_dir], output_callback=write_line)
+        make_arguments = list(job.make_arguments)
+        if not any(str(argument).startswith("-j") for argument in make_arguments):
+            make_arguments.insert(0, "-j" + str(make_parallelism))
+        node.run_make(build_dir, make_arguments, output_callback=write_line)
+
+        # A missing or misnamed artifact fails the job, not the node
+        try:
+            if cache_key is not None:
+                # Collect the artifacts through the cache so they are only transferred once
+                self.build_cache.store(node, cache_key, build_dir, job.artifacts)
+                job.artifact_paths = self.build_cache.extract(cache_key, job_output_dir, flatten=True)
+                return
+
+            job.artifact_paths = []
+            for artifact in job.artifacts:
+                node.copy_file_from(os.path.join(build_dir, artifact), destination_dir=job_output_dir)
+                job.artifact_paths.append(os.path.join(job_output_dir, os.path.basename(artifact)))
+        except (IOError, RuntimeError) as e:
+            raise ArtifactException("Couldn't collect the artifacts of " + job.name + ": " + str(e))
@@ -0,0 +1,142 @@
+import os
+import ntpath
+import hashlib
+import posixpath
+
+
+DEFAULT_REMOTE_CACHE_DIR = "/var/tmp/yu-artifact-cache"
+DEFAULT_MAX_SIZE_BYTES = 10 * 1024 * 1024 * 1024
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+_PARTIAL_SUFFIX = ".partial"
+
+
+class ArtifactCache(object):
+    """
+    A content-addressed store of files held on a RemoteNode.
+
+    Every file copied through the cache is stored in cache_dir under the sha256 of its contents. When a node already
+    holds a file's content the transfer is skipped and the destination is copied from the cache instead, as a
+    copy-on-write reflink where the filesystem supports it. Destinations never share an inode with a cache entry, so
+    rewriting one in place can't change the content stored under its hash. Which hashes the node already holds is
+    checked in a single remote command per batch of copies.
+    The cache is kept under max_size_bytes by evicting the least recently used entries after each batch.
+    """
+    def __init__(self, node, cache_dir=DEFAULT_REMOTE_CACHE_DIR, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        self.node = node
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.m_local_hashes = {}
+
+    def file_hash(self, local_path):
+        """
+        Get the sha256 of a local file. Hashes are remembered until the file's size or modification time changes
+
+        :param local_path: the file to hash
+        :return: the hex digest of the file's contents
+        """
+        stat_info = os.stat(local_path)
+        key = os.path.abspath(local_path)
+        cached = self.m_local_hashes.get(key)
+        if cached is not None and cached[0] == stat_info.st_size and cached[1] == stat_info.st_mtime:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        self.m_local_hashes[key] = (stat_info.st_size, stat_info.st_mtime, digest.hexdigest())
+        return digest.hexdigest()
+
+    def lookup(self, digests):
+        """
+        Check which of the provided hashes are already held in the cache on the node.
+        Entries that are found are marked as recently used.
+
+        :param digests: the hex digests to check
+        :return: a set of the digests that the node already holds
+        :raises RuntimeError if the check could not be performed
+        """
+        digests = sorted(set(digests))
+        if not digests:
+            return set()
+
+        lookup_command = ("mkdir -p " + self.cache_dir + " && cd " + self.cache_dir + " && for h in " +
+                          " ".join(digests) + "; do if [ -f $h ]; then touch $h; echo $h; fi; done")
+        result_code, result_string = self.node.command(lookup_command)
+        if result_code != 0:
+            raise RuntimeError("Failed to query the artifact cache on " + self.node.get_host_to_connect_to() + ": " +
+                               str(result_string))
+        return set(result_string.split()) & set(digests)
+
+    def copy_files_to(self, local_paths, destination_dir=None, destination_filenames=None):
+        """
+        Copy files to the node through the cache, only transferring content the node doesn't already hold
+
+        :param local_paths: the local files to copy
+        :param destination_dir: the destination on the remote node to copy to (Optional)
+                                Will default the home dir of the user if omitted
+        :param destination_filenames: the names to give each file on the remote node (Optional)
+                                      Will default to the original filenames
+        :return: a list of the local paths whose content was already cached on the node
+        :raises RuntimeError if the copy fails
+        """
+        if destination_filenames is None:
+            destination_filenames = [ntpath.basename(path) for path in local_paths]
+        if len(destination_filenames) != len(local_paths):
+            raise RuntimeError("A destination filename must be provided for every file being copied")
+        if not destination_dir:
+            destination_dir = "."
+
+        digests = [self.file_hash(path) for path in local_paths]
+        cached = self.lookup(digests)
+
+        uploaded = set()
+        for path, digest in zip(local_paths, digests):
+            if digest in cached or digest in uploaded:
+                continue
+            self.node.copy_file_to(path, digest + _PARTIAL_SUFFIX, self.cache_dir, use_artifact_cache=False)
+            uploaded.add(digest)
+
+        commands = []
+        for digest in sorted(uploaded):
+            cache_path = posixpath.join(self.cache_dir, digest)
+            commands.append("mv -f " + cache_path + _PARTIAL_SUFFIX + " " + cache_path)
+        for filename, digest in zip(destination_filenames, digests):
+            cache_path = posixpath.join(self.cache_dir, digest)
+            destination = posixpath.join(destination_dir, filename)
+            # cp without --reflink is the fallback for systems whose cp doesn't support it
+            commands.append("{ cp --reflink=auto -pf " + cache_path + " " + destination + " 2> /dev/null || cp -pf " +
+                            cache_path + " " + destination + "; }")
+        commands.append(self._evict_command())
+
+        result_code, result_string = self.node.command(" && ".join(commands))
+        if result_code != 0:
+            raise RuntimeError("Failed to copy files out of the artifact cache on " +
+                               self.node.get_host_to_connect_to() + ": " + str(result_string))
+
+        return [path for path, digest in zip(local_paths, digests) if digest in cached]
+
+    def evict(self):
+        """
+        Remove the least recently used entries from the cache on the node until it is within max_size_bytes
+
+        :raises RuntimeError if the eviction fails
+        """
+        result_code, result_string = self.node.command(self._evict_command())
+        if result_code != 0:
+            raise RuntimeError("Failed to evict from the artifact cache on " + self.node.get_host_to_connect_to() +
+                               ": " + str(result_string))
+
+    def clear(self):
+        """
+        Remove every entry from the cache on the node
+        """
+        self.node.delete_dir(self.cache_dir, contents_only=True)
+
+    def _evict_command(self):
+        # Walk the entries most recently used first, keeping each one that still fits under the size cap
+        max_size = str(int(self.max_size_bytes))
+        return ("( cd " + self.cache_dir + " && total=0 && for f in $(ls -t | grep -v '\\" + _PARTIAL_SUFFIX +
+                "$'); do size=$(stat -c %s $f); if [ $((total + size)) -gt " + max_size + " ]; then rm -f $f; " +
+                "else total=$((total + size)); fi; done )")
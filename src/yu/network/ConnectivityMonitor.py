@@ -0,0 +1,255 @@
+import os
+import json
+import math
+import time
+import threading
+import collections
+
+from yu.network import connectivity
+
+
+# Latencies are counted in logarithmically sized buckets so each histogram is a few dozen integers no matter how
+# many samples it holds; reported percentiles are accurate to within one bucket (~10%)
+_BUCKET_GROWTH = 1.1
+_SMALLEST_BUCKET = 0.0001
+_BUCKET_COUNT = int(math.ceil(math.log(120.0 / _SMALLEST_BUCKET) / math.log(_BUCKET_GROWTH))) + 1
+
+
+def _bucket_for(latency):
+    if latency <= _SMALLEST_BUCKET:
+        return 0
+    return min(_BUCKET_COUNT - 1, int(math.ceil(math.log(latency / _SMALLEST_BUCKET) / math.log(_BUCKET_GROWTH))))
+
+
+def _bucket_upper_bound(bucket):
+    return _SMALLEST_BUCKET * _BUCKET_GROWTH ** bucket
+
+
+class _RollingHistogram(object):
+    """
+    A latency histogram over a rolling time window.
+    The window is divided into a fixed number of slots and whole slots are dropped as they age out, so memory use is
+    bounded by slot_count * bucket count regardless of the sampling rate.
+    """
+    def __init__(self, window_seconds, slot_count=12):
+        self.slot_seconds = float(window_seconds) / slot_count
+        self.slots = collections.deque(maxlen=slot_count)
+
+    def _current_slot(self, now):
+        slot_id = int(now // self.slot_seconds)
+        if not self.slots or self.slots[-1][0] != slot_id:
+            # [slot id, latency bucket counts, successful samples, lost samples]
+            self.slots.append([slot_id, {}, 0, 0])
+        return self.slots[-1]
+
+    def record(self, latency, now=None):
+        """
+        :param latency: the latency of the sample in seconds; None if the probe failed
+        :param now: the time of the sample (optional) default = now
+        """
+        slot = self._current_slot(time.time() if now is None else now)
+        if latency is None:
+            slot[3] += 1
+            return
+        bucket = _bucket_for(latency)
+        slot[1][bucket] = slot[1].get(bucket, 0) + 1
+        slot[2] += 1
+
+    def stats(self, now=None):
+        oldest_slot_id = int((time.time() if now is None else now) // self.slot_seconds) - self.slots.maxlen + 1
+        counts = {}
+        successes = 0
+        losses = 0
+        for slot_id, slot_counts, slot_successes, slot_losses in self.slots:
+            if slot_id < oldest_slot_id:
+                continue
+            for bucket, count in slot_counts.items():
+                counts[bucket] = counts.get(bucket, 0) + count
+            successes += slot_successes
+            losses += slot_losses
+
+        total = successes + losses
+        stats = {'samples': total, 'losses': losses, 'loss_rate': float(losses) / total if total else None}
+        for name, quantile in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats[name] = self._percentile(counts, successes, quantile)
+        return stats
+
+    @staticmethod
+    def _percentile(counts, total, quantile):
+        if total == 0:
+            return None
+        rank = quantile * total
+        seen = 0
+        for bucket in sorted(counts):
+            seen += counts[bucket]
+            if seen >= rank:
+                return _bucket_upper_bound(bucket)
+        return _bucket_upper_bound(max(counts))
+
+
+class ConnectivityMonitor(object):
+    """
+    Periodically samples reachability, DNS resolution latency and HTTP latency in a background thread using the
+    probes in yu.network.connectivity, keeping rolling latency histograms and loss rates for each probe.
+
+    Metrics are named "reachability:<host>", "dns:<server>" and "http:<address>". Use get_stats to query them and
+    provide snapshot_file to have the stats written out as JSON every snapshot_interval seconds. Errors sampling or
+    writing snapshots in the background thread don't stop it; the most recent one is kept in last_error.
+    """
+    def __init__(self, interval=30.0, window=3600.0, reachability_hosts=("8.8.8.8",), dns_servers=None,
+                 dns_address="google.com", web_address="http://www.google.com", probe_timeout=5.0,
+                 snapshot_file=None, snapshot_interval=300.0):
+        """
+        :param interval: the number of seconds between samples (optional) default = 30
+        :param window: the number of seconds of history the stats cover (optional) default = 3600
+        :param reachability_hosts: the hosts to probe for reachability (optional) default = 8.8.8.8
+        :param dns_servers: the DNS servers to query (optional) default = the servers in /etc/resolv.conf,
+                            re-read each sample
+        :param dns_address: the address to resolve (optional) default = google.com
+        :param web_address: the web address to fetch; None to skip the HTTP probe
+                            (optional) default = http://www.google.com
+        :param probe_timeout: the number of seconds to wait for each probe (optional) default = 5
+        :param snapshot_file: the path to write periodic JSON snapshots of the stats to (optional)
+        :param snapshot_interval: the number of seconds between snapshots (optional) default = 300
+        """
+        self.interval = interval
+        self.window = window
+        self.reachability_hosts = list(reachability_hosts)
+        self.dns_servers = dns_servers
+        self.dns_address = dns_address
+        self.web_address = web_address
+        self.probe_timeout = probe_timeout
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        # The most recent exception raised sampling or writing a snapshot in the background thread
+        self.last_error = None
+
+        self.m_histograms = {}
+        self.m_lock = threading.Lock()
+        self.m_stop_event = threading.Event()
+        self.m_thread = None
+        self.m_last_snapshot = None
+
+    def start(self):
+        """
+        Start sampling in a background thread
+
+        :raises RuntimeError if the monitor is already running
+        """
+        if self.is_running():
+            raise RuntimeError("The connectivity monitor is already running")
+        self.m_stop_event.clear()
+        self.m_thread = threading.Thread(target=self._run, name="yu-connectivity-monitor")
+        self.m_thread.daemon = True
+        self.m_thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop sampling and wait for the background thread to finish. A final snapshot is written if configured
+
+        :param timeout: the maximum number of seconds to wait for the thread (optional)
+        """
+        self.m_stop_event.set()
+        if self.m_thread is not None:
+            self.m_thread.join(timeout)
+            self.m_thread = None
+        if self.snapshot_file is not None:
+            self.write_snapshot()
+
+    def is_running(self):
+        return self.m_thread is not None and self.m_thread.is_alive()
+
+    def sample(self):
+        """
+        Run every probe once and record the results
+        """
+        now = time.time()
+        reachability = connectivity.probe_hosts(self.reachability_hosts, probe_timeout=self.probe_timeout)
+        for host, result in reachability.items():
+            self._record("reachability:" + host, result.latency if result.reachable else None, now)
+
+        try:
+            dns_results = connectivity.check_dns_servers(self.dns_address, self.dns_servers, self.probe_timeout)
+        except IOError:
+            dns_results = {}
+        for server, result in dns_results.items():
+            self._record("dns:" + server, result.latency if result.resolved else None, now)
+
+        if self.web_address is not None:
+            start = time.time()
+            reachable = connectivity.can_access_web_address(self.web_address,
+                                                            proxy=connectivity.GLOBAL_WORKING_EXTERNAL_PROXY,
+                                                            timeout=self.probe_timeout)
+            self._record("http:" + self.web_address, time.time() - start if reachable else None, now)
+
+    def get_metric_names(self):
+        with self.m_lock:
+            return sorted(self.m_histograms)
+
+    def get_stats(self, metric=None):
+        """
+        Get the stats over the monitoring window
+
+        :param metric: the metric to get the stats for (optional) default = all metrics
+        :return: a dictionary with samples, losses, loss_rate and p50/p95/p99 latencies in seconds
+                 (None when there are no successful samples).
+                 If no metric is provided a dictionary of these keyed on metric name is returned
+        :raises KeyError if the metric has never been sampled
+        """
+        now = time.time()
+        with self.m_lock:
+            if metric is not None:
+                return self.m_histograms[metric].stats(now)
+            return dict((name, histogram.stats(now)) for name, histogram in self.m_histograms.items())
+
+    def write_snapshot(self, path=None):
+        """
+        Write the current stats to a JSON file. The file is replaced atomically so readers never see a partial file
+
+        :param path: the file to write to (optional) default = snapshot_file
+        :raises RuntimeError if no path is provided and no snapshot_file is configured
+        :raises IOError if the file couldn't be written
+        """
+        if path is None:
+            path = self.snapshot_file
+        if path is None:
+            raise RuntimeError("No snapshot file provided")
+
+        snapshot = {'time': time.time(), 'window': self.window, 'interval': self.interval,
+                    'metrics': self.get_stats()}
+        temporary_path = path + ".tmp"
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump(snapshot, f, indent=2, sort_keys=True)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self.m_last_snapshot = snapshot['time']
+
+    def _record(self, metric, latency, now):
+        with self.m_lock:
+            histogram = self.m_histograms.get(metric)
+            if histogram is None:
+                histogram = _RollingHistogram(self.window)
+                self.m_histograms[metric] = histogram
+            histogram.record(latency, now)
+
+    def _run(self):
+        while not self.m_stop_event.is_set():
+            started = time.time()
+            try:
+                self.sample()
+            except Exception as e:
+                # A broken probe shouldn't stop the monitoring; the gap shows up as missing samples
+                self.last_error = e
+
+            if self.snapshot_file is not None and \
+                    (self.m_last_snapshot is None or time.time() - self.m_last_snapshot >= self.snapshot_interval):
+                try:
+                    self.write_snapshot()
+                except Exception as e:
+                    # Nor should an unwritable snapshot file; the write is retried on the next sample
+                    self.last_error = e
+
+            self.m_stop_event.wait(max(0.0, self.interval - (time.time() - started)))
@@ -1,10 +1,64 @@
 import os
+import json
 import errno
 import stat
 import socket
+import tarfile
+import time
 
 import yu.ssh.ssh as ssh
 from yu.network.Location import Location
+from yu.network.ArtifactCache import ArtifactCache, DEFAULT_REMOTE_CACHE_DIR, DEFAULT_MAX_SIZE_BYTES
+
+
+_TAR_COMPRESSION_FLAGS = {None: "", 'gz': "z", 'bz2': "j", 'xz': "J"}
+
+LINK_BENCHMARK_HISTORY_FILE = os.path.join(os.path.expanduser("~"), ".yu", "link_benchmarks.jsonl")
+TRANSFER_MODE_EXEC = "exec"
+TRANSFER_MODE_SFTP = "sftp"
+
+
+class _SyntheticData(object):
+    """
+    A file-like object producing size bytes of zeros without holding them in memory
+    """
+    _BLOCK = b'\x00' * (1024 * 1024)
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining
+        size = min(size, self.remaining, len(self._BLOCK))
+        self.remaining -= size
+        return self._BLOCK[:size]
+
+
+class _ByteCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+
+    def __call__(self, data):
+        self.write(data)
+
+
+def _tar_compression_from_name(filename):
+    for extensions, compression in (((".gz", ".tgz"), 'gz'), ((".bz2", ".tbz2"), 'bz2'), ((".xz", ".txz"), 'xz')):
+        if filename.endswith(extensions):
+            return compression
+    return None
+
+
+def _tar_writer(paths, compression=None):
+    def write_tar(stream):
+        with tarfile.open(fileobj=stream, mode="w|" + (compression or "")) as tar:
+            for path in paths:
+                tar.add(path, arcname=os.path.basename(os.path.normpath(path)))
+    return write_tar
 
 
 class RemoteNode(object):
@@ -18,6 +72,7 @@ class RemoteNode(object):
         self.ssh_key = None
         self.configured_hostname = None
         self.connectivity_status = None
+        self.artifact_cache = None
 
     def set_ssh_key(self, ssh_key_path):
         if not os.path.isfile(ssh_key_path):
@@ -83,23 +138,96 @@ class RemoteNode(object):
             except:
                 return 1, "Node session to " + self.location.address + " not connected (attempted one retry)"
 
-    def copy_file_to(self, path_to_file_to_copy, destination_filename=None, destination_dir=None):
+    def command_streamed(self, command, output_callback, timeout=None):
+        """
+        Performs a command on this node, passing its output to output_callback as it arrives instead of buffering it
+
+        :param command: the command, as a string, to perform on the remote node
+        :param output_callback: a callable that is passed each chunk of output (stdout and stderr combined) as bytes
+        :param timeout: the maximum amount of time to wait on any one channel operation
+        :return: the result code of the command
+        :raises: RuntimeError if the node is not connected or the command could not be run
+        :raises: yu.ssh.ssh.TimedOutException if the command exceeds the provided timeout
+        """
+        if not self.m_connected:
+            raise RuntimeError("Node session to " + self.location.address + "not connected")
+
+        try:
+            return self.m_sshSession.exec_command_streamed(command, output_callback, timeout=timeout)
+        except RuntimeError:
+            # Output may already have been passed on so the command can't simply be run again
+            self.m_connected = False
+            raise
+
+    def command_with_input(self, command, input_data, timeout=None):
+        """
+        Performs a command on this node, streaming input_data into its stdin
+
+        :param command: the command, as a string, to perform on the remote node
+        :param input_data: the data to send to the command; bytes, a file-like object, an iterable of bytes or a
+                           callable that will be passed a writable file-like object connected to the command's stdin
+        :param timeout: the maximum amount of time to wait on any one channel operation
+        :return: a tuple of result code and result string (stdout and stderr combined)
+        :raises: yu.ssh.ssh.TimedOutException if the command exceeds the provided timeout
+        """
+        if not self.m_connected:
+            return 1, "Node session to " + self.location.address + "not connected"
+
+        try:
+            return self.m_sshSession.exec_command_with_input(command, input_data, timeout=timeout)
+        except RuntimeError as e:
+            if not isinstance(input_data, bytes):
+                # The input may have been partly consumed so it can't be sent again
+                raise e
+            self.m_connected = False
+            # Have one go at reconnecting
+            self.reconnect()
+            return self.m_sshSession.exec_command_with_input(command, input_data, timeout=timeout)
+
+    def enable_artifact_cache(self, cache_dir=DEFAULT_REMOTE_CACHE_DIR, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        """
+        Route file copies to this node through a content-addressed cache held on the node.
+        Files whose content the node already holds are copied out of the cache rather than transferred
+        again. See yu.network.ArtifactCache for details.
+
+        :param cache_dir: the directory on this node to keep the cache in
+                          (optional) default = /var/tmp/yu-artifact-cache
+        :param max_size_bytes: the size the cache is kept under by evicting least recently used entries
+                               (optional) default = 10GiB
+        :return: the yu.network.ArtifactCache.ArtifactCache object in use
+        """
+        self.artifact_cache = ArtifactCache(self, cache_dir, max_size_bytes)
+        return self.artifact_cache
+
+    def disable_artifact_cache(self):
+        self.artifact_cache = None
+
+    def copy_file_to(self, path_to_file_to_copy, destination_filename=None, destination_dir=None,
+                     use_artifact_cache=True):
         """
         Copy a file to this node from the local node
         You can optionally choose a new filename for the file and what directory the file will be copied to
         The file will be copied to the home directory of the connection (root by default) and use the filename
         of the original file
+        If an artifact cache has been enabled with enable_artifact_cache the transfer is skipped when this node
+        already holds the file's content
 
         :param path_to_file_to_copy:  The file to copy
         :param destination_filename:  The name to give the file on the remote node (Optional)
                                       Will default to the original filename provided by path_to_file_to_copy
         :param destination_dir:       The destination on the remote node to copy to (Optional)
                                       Will default the home dir of the user if omitted
+        :param use_artifact_cache:    Set to False to bypass an enabled artifact cache (Optional)
         :raises RuntimeError if the copy fails
         """
         if not self.m_connected:
             raise RuntimeError("Node session to " + self.location.address + "not connected")
 
+        if self.artifact_cache is not None and use_artifact_cache:
+            filenames = None if destination_filename is None else [destination_filename]
+            self.artifact_cache.copy_files_to([path_to_file_to_copy], destination_dir, filenames)
+            return
+
         try:
             self.m_sshSession.copy_file_to(path_to_file_to_copy, destination_filename, destination_dir)
         except RuntimeError as e:
@@ -108,6 +236,26 @@ class RemoteNode(object):
             self.reconnect()
             self.m_sshSession.copy_file_to(path_to_file_to_copy, destination_filename, destination_dir)
 
+    def copy_files_to(self, paths_to_files_to_copy, destination_dir=None):
+        """
+        Copy several files to the same directory on this node from the local node
+        When an artifact cache is enabled the node is asked which of the files it already holds in one batched
+        check and only the missing content is transferred
+
+        :param paths_to_files_to_copy: The files to copy
+        :param destination_dir:        The destination on the remote node to copy to (Optional)
+                                       Will default the home dir of the user if omitted
+        :raises RuntimeError if the copy fails
+        """
+        if self.artifact_cache is not None:
+            if not self.m_connected:
+                raise RuntimeError("Node session to " + self.location.address + "not connected")
+            self.artifact_cache.copy_files_to(paths_to_files_to_copy, destination_dir)
+            return
+
+        for path in paths_to_files_to_copy:
+            self.copy_file_to(path, destination_dir=destination_dir)
+
     def copy_dir_to(self, local_dir_to_copy, destination_dir=None):
         """
         Copy a directory to this RTDB node from the local node
@@ -176,6 +324,97 @@ class RemoteNode(object):
             self.reconnect()
             self.m_sshSession.copy_dir_from(path_to_dir_on_remote, destination_dir)
 
+    def open(self, remote_path, mode='rb', read_ahead=ssh.RemoteFile.DEFAULT_READ_AHEAD):
+        """
+        Open a file on this node and return a buffered file-like object for it.
+        Data is read on demand rather than copying the whole file locally, so seeking around or reading parts of
+        very large files only transfers the data that is actually used.
+
+        :param remote_path: the path of the file on this node
+        :param mode: the mode to open the file in, as for the builtin open. Data is always returned as bytes
+                     (optional) default = 'rb'
+        :param read_ahead: the minimum number of bytes to fetch whenever the read buffer needs refilling
+                           (optional) default = 1MiB
+        :return: a yu.ssh.ssh.RemoteFile object; it can be used as a context manager
+        :raises RuntimeError if the file could not be opened
+        :raises IOError if the file does not exist (when opening for reading)
+        """
+        if not self.m_connected:
+            raise RuntimeError("Node session to " + self.location.address + "not connected")
+
+        try:
+            return self.m_sshSession.open(remote_path, mode, read_ahead)
+        except RuntimeError as e:
+            self.m_connected = False
+            # Have one go at reconnecting
+            self.reconnect()
+            return self.m_sshSession.open(remote_path, mode, read_ahead)
+
+    def tail(self, remote_path, follow=True, lines=10, poll_interval=1.0, encoding='utf-8'):
+        """
+        Generator yielding the last lines of a file on this node and, optionally, any lines appended to it afterwards.
+        Only the end of the file is transferred and memory use does not depend on the size of the file.
+        If the file shrinks while being followed (e.g. it was truncated by log rotation) reading restarts from the
+        beginning of the file.
+
+        :param remote_path: the path of the file on this node
+        :param follow: when True keep waiting for new lines to be appended (like `tail -f`); when False stop once
+                       the current end of the file has been reached
+                       (optional) default = True
+        :param lines: the number of existing lines to yield before following (optional) default = 10
+        :param poll_interval: the number of seconds to wait between checks for new data (optional) default = 1.0
+        :param encoding: the encoding used to decode each line (optional) default = 'utf-8'
+        :return: a generator of lines (without the trailing newline)
+        :raises RuntimeError if the file could not be opened
+        :raises IOError if the file does not exist
+        """
+        with self.open(remote_path, 'rb', read_ahead=64 * 1024) as remote_file:
+            remote_file.seek(self._find_tail_start(remote_file, lines))
+            partial_line = b''
+            while True:
+                data = remote_file.read(64 * 1024)
+                if data:
+                    complete_lines = (partial_line + data).split(b'\n')
+                    partial_line = complete_lines.pop()
+                    for line in complete_lines:
+                        yield line.decode(encoding, 'replace')
+                    continue
+
+                if not follow:
+                    if partial_line:
+                        yield partial_line.decode(encoding, 'replace')
+                    return
+
+                time.sleep(poll_interval)
+                if remote_file.size(refresh=True) < remote_file.tell():
+                    # Nothing read before the truncation can be served from the buffer again
+                    remote_file.discard_buffer()
+                    remote_file.seek(0)
+                    partial_line = b''
+
+    @staticmethod
+    def _find_tail_start(remote_file, lines, block_size=8192):
+        end = remote_file.size(refresh=True)
+        if lines <= 0 or end == 0:
+            return end
+
+        # A trailing newline terminates the last line rather than starting a new one
+        newlines_needed = lines + 1 if remote_file.read_range(end - 1, 1) == b'\n' else lines
+        position = end
+        while position > 0:
+            block_start = max(0, position - block_size)
+            block = remote_file.read_range(block_start, position - block_start)
+            index = len(block)
+            while True:
+                index = block.rfind(b'\n', 0, index)
+                if index == -1:
+                    break
+                newlines_needed -= 1
+                if newlines_needed == 0:
+                    return block_start + index + 1
+            position = block_start
+        return 0
+
     def delete_file(self, remote_path, error_if_not_exists=True):
         """
         Delete the provided file from this node
@@ -319,7 +558,210 @@ class RemoteNode(object):
         :raises: RuntimeError if the extract fails
         """
         directory, filename = os.path.split(path_to_tar)
-        self.perform_command_on_host("cd " + directory + "; tar -xvzf " + filename)
+        result_code, result_string = self.command("cd " + directory + "; tar -xvzf " + filename)
+        if result_code != 0:
+            raise RuntimeError("Failed to extract " + path_to_tar + " on " + self.location.address + ": " +
+                               str(result_string))
+
+    def push_and_extract(self, local_source, destination_dir=None, compression=None, timeout=None):
+        """
+        Stream a tar archive from the local node straight into `tar -x` on this node.
+        The archive is never written to disk on this node and extraction starts while data is still arriving.
+
+        local_source can be:
+         - the path to a local tarball; it is sent as-is and the compression is detected from the file extension
+           (.tar.gz/.tgz, .tar.bz2/.tbz2, .tar.xz/.txz or .tar) unless compression is provided
+         - the path to a local directory or file, or a list of such paths; a tar is generated on the fly and each
+           path is extracted under destination_dir using its basename
+           e.g. pushing the directory "lab_results" with destination_dir="/home/ignaz" results in
+                /home/ignaz/lab_results on this node
+
+        :param local_source: the tarball, path or list of paths to push
+        :param destination_dir: the directory on this node to extract into; it will be created if it doesn't exist
+                                Will default the home dir of the user if omitted
+        :param compression: the compression to use for the stream; one of None, 'gz', 'bz2' or 'xz'
+                            (optional) default = detected for tarballs; uncompressed for generated archives
+        :param timeout: the maximum amount of time to wait on any one channel operation (optional)
+        :raises RuntimeError if the transfer or the extract fails
+        :raises IOError if a local path does not exist
+        """
+        if not self.m_connected:
+            raise RuntimeError("Node session to " + self.location.address + "not connected")
+
+        sources = list(local_source) if isinstance(local_source, (list, tuple)) else [local_source]
+        for source in sources:
+            if not os.path.exists(source):
+                raise IOError(source + " does not exist")
+
+        is_tarball = len(sources) == 1 and os.path.isfile(sources[0]) and tarfile.is_tarfile(sources[0])
+        if is_tarball and compression is None:
+            compression = _tar_compression_from_name(sources[0])
+        if compression not in _TAR_COMPRESSION_FLAGS:
+            raise RuntimeError("Unsupported compression: " + str(compression))
+
+        if destination_dir is None:
+            destination_dir = "."
+        extract_command = ("mkdir -p " + destination_dir + " && tar -x" + _TAR_COMPRESSION_FLAGS[compression] +
+                           "f - -C " + destination_dir)
+
+        def stream_archive():
+            if is_tarball:
+                return open(sources[0], 'rb')
+            return _tar_writer(sources, compression)
+
+        try:
+            result_code, result_string = self._push(extract_command, stream_archive, timeout)
+        except RuntimeError as e:
+            self.m_connected = False
+            # Have one go at reconnecting
+            self.reconnect()
+            result_code, result_string = self._push(extract_command, stream_archive, timeout)
+
+        if result_code != 0:
+            raise RuntimeError("Failed to extract the pushed archive into " + destination_dir + " on " +
+                               self.location.address + ": " + result_string)
+
+    def _push(self, command, input_factory, timeout=None):
+        input_data = input_factory()
+        try:
+            return self.m_sshSession.exec_command_with_input(command, input_data, timeout=timeout)
+        finally:
+            if hasattr(input_data, 'close'):
+                input_data.close()
+
+    def benchmark_link(self, payload_bytes=16 * 1024 * 1024, rtt_samples=10, remote_scratch_dir="/tmp",
+                       history_file=LINK_BENCHMARK_HISTORY_FILE):
+        """
+        Measure what the link to this node can do over the existing SSH connection:
+         - rtt: the network round trip time, measured with keepalive global requests
+         - exec_latency: how long running a trivial command takes
+         - exec_upload_bps / exec_download_bps: throughput of data streamed through a command's stdin/stdout
+         - sftp_upload_bps / sftp_download_bps: throughput of SFTP transfers
+        The faster of exec streaming and SFTP (averaged over both directions) is reported as
+        recommended_transfer_mode, and the result is appended to history_file for comparing over time.
+
+        :param payload_bytes: the amount of synthetic data to send in each direction for each transfer mode
+                              (optional) default = 16MiB
+        :param rtt_samples: the number of round trips to time (optional) default = 10
+        :param remote_scratch_dir: a writable directory on this node for the SFTP test file (optional) default = /tmp
+        :param history_file: the JSON lines file to append the result to; None to not record it
+                             (optional) default = ~/.yu/link_benchmarks.jsonl
+        :return: a dictionary of the results; latencies are in seconds and throughputs in bytes per second
+        :raises RuntimeError if any part of the benchmark fails
+        """
+        if not self.m_connected:
+            raise RuntimeError("Node session to " + self.location.address + "not connected")
+
+        session = self.m_sshSession
+        round_trips = [session.global_request_round_trip() for _ in range(rtt_samples)]
+
+        exec_latencies = []
+        for _ in range(max(1, rtt_samples // 2)):
+            start = time.time()
+            result_code, result_string = session.exec_command("true")
+            exec_latencies.append(time.time() - start)
+            if result_code != 0:
+                raise RuntimeError("Failed to run a command on " + self.location.address + ": " + result_string)
+
+        start = time.time()
+        result_code, result_string = session.exec_command_with_input("cat > /dev/null", _SyntheticData(payload_bytes))
+        exec_upload_time = time.time() - start
+        if result_code != 0:
+            raise RuntimeError("Failed to stream data to " + self.location.address + ": " + result_string)
+
+        received = _ByteCounter()
+        start = time.time()
+        result_code = session.exec_command_streamed("head -c " + str(payload_bytes) + " /dev/zero", received)
+        exec_download_time = time.time() - start
+        if result_code != 0 or received.count != payload_bytes:
+            raise RuntimeError("Failed to stream data from " + self.location.address)
+
+        scratch_path = os.path.join(remote_scratch_dir, ".yu-link-benchmark-" + str(os.getpid()))
+        try:
+            start = time.time()
+            session.put_stream(_SyntheticData(payload_bytes), scratch_path)
+            sftp_upload_time = time.time() - start
+
+            received = _ByteCounter()
+            start = time.time()
+            session.get_stream(scratch_path, received)
+            sftp_download_time = time.time() - start
+        finally:
+            self.delete_file(scratch_path, error_if_not_exists=False)
+
+        results = {
+            'host': self.location.address,
+            'time': time.time(),
+            'payload_bytes': payload_bytes,
+            'rtt': {'min': min(round_trips), 'avg': sum(round_trips) / len(round_trips), 'max': max(round_trips)}
+            if round_trips else None,
+            'exec_latency': sum(exec_latencies) / len(exec_latencies),
+            'exec_upload_bps': payload_bytes / max(exec_upload_time, 1e-9),
+            'exec_download_bps': payload_bytes / max(exec_download_time, 1e-9),
+            'sftp_upload_bps': payload_bytes / max(sftp_upload_time, 1e-9),
+            'sftp_download_bps': payload_bytes / max(sftp_download_time, 1e-9),
+        }
+        exec_throughput = (results['exec_upload_bps'] + results['exec_download_bps']) / 2
+        sftp_throughput = (results['sftp_upload_bps'] + results['sftp_download_bps']) / 2
+        results['recommended_transfer_mode'] = \
+            TRANSFER_MODE_EXEC if exec_throughput >= sftp_throughput else TRANSFER_MODE_SFTP
+
+        if history_file is not None:
+            history_dir = os.path.dirname(history_file)
+            if history_dir and not os.path.isdir(history_dir):
+                os.makedirs(history_dir)
+            with open(history_file, 'a') as f:
+                f.write(json.dumps(results, sort_keys=True) + "\n")
+        return results
+
+    def get_link_benchmark_history(self, history_file=LINK_BENCHMARK_HISTORY_FILE):
+        """
+        Get the benchmark_link results previously recorded for this node, oldest first
+
+        :param history_file: the JSON lines file the results were recorded in
+                             (optional) default = ~/.yu/link_benchmarks.jsonl
+        :return: a list of result dictionaries as returned by benchmark_link
+        """
+        if not os.path.isfile(history_file):
+            return []
+        history = []
+        with open(history_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                if entry.get('host') == self.location.address:
+                    history.append(entry)
+        return history
+
+    def start_reverse_forward(self, remote_port, local_port, local_host="127.0.0.1"):
+        """
+        Make a port on the local node reachable from this node: connections to 127.0.0.1:remote_port on this node
+        are forwarded over the SSH connection to local_host:local_port, like `ssh -R`.
+        The forward lasts until stop_reverse_forward is called or the connection closes.
+
+        :param remote_port: the port to listen on on this node; 0 to have one picked
+        :param local_port: the local port to forward connections to
+        :param local_host: the local host to forward connections to (optional) default = 127.0.0.1
+        :return: the port this node is listening on
+        :raises RuntimeError if the node isn't connected or the forward was refused
+        """
+        if not self.m_connected:
+            raise RuntimeError("Node session to " + self.location.address + "not connected")
+        return self.m_sshSession.start_reverse_forward(remote_port, local_port, local_host)
+
+    def stop_reverse_forward(self, remote_port):
+        """
+        Stop a forward started with start_reverse_forward
+
+        :param remote_port: the port returned by start_reverse_forward
+        """
+        if self.m_connected:
+            self.m_sshSession.stop_reverse_forward(remote_port)
+
+    def is_connected(self):
+        return self.m_connected
 
     def is_connected_as_root(self):
         return self.m_connected_as_root
@@ -341,8 +783,8 @@ class RemoteNode(object):
             return self.configured_hostname
 
         cat_command = 'cat /proc/sys/kernel/hostname'
-        result_code, result_string = self.perform_command_on_host(cat_command)
-        if result_code is not 0:
+        result_code, result_string = self.command(cat_command)
+        if result_code != 0:
             # TODO raise an exception
             return None
 
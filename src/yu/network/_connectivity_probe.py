@@ -0,0 +1,133 @@
+"""
+Self-contained connectivity probe that is piped to remote nodes by
+yu.network.connectivity.check_connectivity_on_nodes and run with whichever python the node has.
+
+It must only use the standard library and run under both python 2 and 3. The probe settings are passed as a single
+base64 encoded JSON argument and the results are printed as JSON on a line starting with RESULT_MARKER.
+"""
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import struct
+import threading
+
+try:
+    import urllib.request as urllib_request
+except ImportError:
+    import urllib2 as urllib_request
+
+RESULT_MARKER = "YU-CONNECTIVITY-RESULT:"
+
+
+def get_configured_dns_servers():
+    servers = []
+    try:
+        with open("/etc/resolv.conf", 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == 'nameserver':
+                    servers.append(fields[1])
+    except IOError:
+        pass
+    return servers
+
+
+def can_reach_external_ip(timeout):
+    try:
+        socket.create_connection(("8.8.8.8", 53), timeout=timeout).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+def dns_query_latency(server, name, timeout):
+    query_id = random.randint(0, 0xffff)
+    query = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    for label in name.strip(".").split("."):
+        query += struct.pack("!B", len(label)) + label.encode("ascii")
+    query += b'\x00' + struct.pack("!HH", 1, 1)
+
+    sock = socket.socket(socket.getaddrinfo(server, 53, 0, socket.SOCK_DGRAM)[0][0], socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect((server, 53))
+        start = time.time()
+        sock.send(query)
+        while True:
+            response = sock.recv(4096)
+            if len(response) < 12:
+                continue
+            response_id, flags, _, answer_count = struct.unpack("!HHHH", response[:8])
+            if response_id != query_id:
+                continue
+            if flags & 0x000f == 0 and answer_count > 0:
+                return time.time() - start
+            return None
+    except (socket.error, socket.timeout):
+        return None
+    finally:
+        sock.close()
+
+
+def can_access_web_address(address, proxy, timeout):
+    handlers = []
+    if proxy:
+        handlers.append(urllib_request.ProxyHandler({'http': proxy, 'https': proxy}))
+    try:
+        response = urllib_request.build_opener(*handlers).open(address, timeout=timeout)
+        response.read(1)
+        response.close()
+        return True
+    except Exception:
+        return False
+
+
+_results_lock = threading.Lock()
+
+
+def timed(results, name, function, *args):
+    start = time.time()
+    result = function(*args)
+    with _results_lock:
+        results[name] = result
+        results[name + "_latency"] = time.time() - start
+
+
+def probe_dns(results, server, name, timeout):
+    latency = dns_query_latency(server, name, timeout)
+    with _results_lock:
+        results['dns_latencies'][server] = latency
+
+
+def main(encoded_settings):
+    settings = json.loads(base64.b64decode(encoded_settings.encode("ascii")).decode("utf-8"))
+    deadline = settings['deadline']
+    probe_timeout = min(3.0, deadline)
+    start = time.time()
+
+    results = {'dns_list': get_configured_dns_servers(), 'dns_latencies': {}}
+    threads = [threading.Thread(target=timed, args=(results, 'external_ip', can_reach_external_ip, probe_timeout)),
+               threading.Thread(target=timed, args=(results, 'external_url', can_access_web_address,
+                                                    settings['web_address'], settings['proxy'], deadline))]
+    for server in results['dns_list']:
+        threads.append(threading.Thread(target=probe_dns, args=(results, server, settings['dns_address'],
+                                                                probe_timeout)))
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(0.0, start + deadline - time.time()))
+
+    with _results_lock:
+        results['duration'] = time.time() - start
+        output = json.dumps(results)
+    sys.stdout.write(RESULT_MARKER + output + "\n")
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
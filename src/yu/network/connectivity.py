@@ -1,9 +1,52 @@
+import os
+import json
+import time
+import base64
+import errno
 import socket
-import subprocess
+import struct
+import selectors
+import threading
+import concurrent.futures
 import requests
 
+from yu.network import dns
+from yu.network import httpclient
+from yu.network import _connectivity_probe
+
 GLOBAL_WORKING_EXTERNAL_PROXY = None
 
+# How long a check_connectivity result is reused for before the probes are run again
+CONNECTIVITY_CACHE_TTL = 60.0
+DEFAULT_CONNECTIVITY_DEADLINE = 10.0
+DEFAULT_DNS_CHECK_ADDRESS = "google.com"
+DEFAULT_WEB_CHECK_ADDRESS = "http://www.google.com"
+
+# How long a proxy chosen by discover_working_proxy is trusted before the candidates are tested again
+PROXY_CACHE_TTL = 300.0
+PROXY_ENVIRONMENT_VARIABLES = ('https_proxy', 'HTTPS_PROXY', 'http_proxy', 'HTTP_PROXY', 'all_proxy', 'ALL_PROXY')
+
+PROBE_METHOD_AUTO = "auto"
+PROBE_METHOD_ICMP = "icmp"
+PROBE_METHOD_TCP = "tcp"
+
+# Ports tried when probing with TCP connects. A refused connection proves the host is up just as well as an
+# accepted one, so these only need to be ports that are unlikely to be silently filtered
+DEFAULT_TCP_PROBE_PORTS = (22, 80, 443)
+# The maximum number of host names probe_hosts resolves at once
+MAX_CONCURRENT_RESOLVES = 32
+_RESOLVE_POLL_INTERVAL = 0.05
+
+_ICMP_ECHO_REQUEST = 8
+_ICMP_ECHO_REPLY = 0
+_TCP_HOST_DOWN_ERRORS = (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EHOSTDOWN)
+
+_connectivity_cache_lock = threading.Lock()
+_cached_connectivity_status = None
+
+_proxy_cache_lock = threading.Lock()
+_proxy_discovered_at = None
+
 
 class _ConnectivityStatus(object):
     def __init__(self):
@@ -11,14 +54,23 @@ class _ConnectivityStatus(object):
 
         self.dns_list = []
         self.working_dns = None
+        self.dns_latencies = {}
         self.can_name_resolve_address = False
 
         self.can_access_external_url = False
 
+        # Seconds each probe took keyed on probe name; None for probes that didn't finish before the deadline
+        self.probe_latencies = {}
+        self.checked_at = None
+        self.duration = None
+
     def __str__(self):
         return_str = "DNS servers configured in /etc/resolv.conf:\n"
-        for dns in self.dns_list:
-            return_str += " " + (str(dns) + "\n")
+        for server in self.dns_list:
+            return_str += " " + str(server)
+            if self.dns_latencies.get(server) is not None:
+                return_str += " (resolved in " + str(round(self.dns_latencies[server] * 1000, 2)) + "ms)"
+            return_str += "\n"
 
         if self.working_dns is None:
             return_str += "No working DNS found\n\n"
@@ -35,30 +87,308 @@ class _ConnectivityStatus(object):
         else:
             return_str += "Can't access external URLs\n"
 
+        if self.probe_latencies:
+            return_str += "\nProbe timings:\n"
+            for probe_name in sorted(self.probe_latencies):
+                latency = self.probe_latencies[probe_name]
+                if latency is None:
+                    return_str += " " + probe_name + ": did not complete\n"
+                else:
+                    return_str += " " + probe_name + ": " + str(round(latency * 1000, 2)) + "ms\n"
+
         return return_str
 
 
-def can_name_resolve_address(address_to_check):
+class _ProbeResult(object):
+    def __init__(self, host):
+        self.host = host
+        self.reachable = False
+        self.latency = None
+        self.method = None
+        self.error = None
+
+    def __bool__(self):
+        return self.reachable
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        if self.reachable:
+            return "<" + self.host + " reachable via " + self.method + " in " + \
+                   str(round(self.latency * 1000, 2)) + "ms>"
+        return "<" + self.host + " unreachable: " + str(self.error) + ">"
+
+
+class _HostProbe(object):
+    def __init__(self, result, address, method, ports, start_time, probe_timeout):
+        self.result = result
+        self.address = address
+        self.method = method
+        self.start_time = start_time
+        self.expiry = start_time + probe_timeout
+        self.resend_interval = max(probe_timeout / 4.0, 0.2)
+        self.next_send = start_time
+        self.sequence = 0
+        self.sockets = []
+        # pending_ports shrinks as connects fail, so the ports probed are kept for the error message
+        self.ports = list(ports)
+        self.pending_ports = list(ports)
+
+    def finish(self, selector, reachable, error=None):
+        self.result.reachable = reachable
+        self.result.method = self.method
+        if reachable:
+            self.result.latency = time.time() - self.start_time
+        else:
+            self.result.error = error
+        for sock in self.sockets:
+            selector.unregister(sock)
+            sock.close()
+        self.sockets = []
+
+
+def _icmp_checksum(packet):
+    if len(packet) % 2:
+        packet += b'\x00'
+    total = sum(struct.unpack("!" + str(len(packet) // 2) + "H", packet))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _icmp_echo_request(sequence):
+    # The kernel rewrites the identifier of unprivileged ICMP sockets so it's left as 0
+    header = struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0, 0, 0, sequence)
+    payload = b'yu-probe'
+    checksum = _icmp_checksum(header + payload)
+    return struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0, checksum, 0, sequence) + payload
+
+
+def _open_icmp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    sock.setblocking(False)
+    return sock
+
+
+def _icmp_available():
+    try:
+        _open_icmp_socket().close()
+        return True
+    except (OSError, socket.error):
+        return False
+
+
+def _start_probe(selector, probe):
+    if probe.method == PROBE_METHOD_ICMP:
+        sock = _open_icmp_socket()
+        probe.sockets.append(sock)
+        selector.register(sock, selectors.EVENT_READ, probe)
+        return
+
+    for port in list(probe.pending_ports):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex((probe.address, port))
+        if error in (0, errno.ECONNREFUSED):
+            sock.close()
+            probe.finish(selector, True)
+            return
+        if error not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            sock.close()
+            probe.pending_ports.remove(port)
+            continue
+        probe.sockets.append(sock)
+        selector.register(sock, selectors.EVENT_WRITE, (probe, port))
+
+    if not probe.sockets:
+        probe.finish(selector, False, "No TCP probe could be started")
+
+
+def _handle_event(selector, key):
+    probe = key.data if isinstance(key.data, _HostProbe) else key.data[0]
+    if key.fileobj not in probe.sockets:
+        # The probe already finished from an earlier event in the same batch
+        return
+
+    if probe.method == PROBE_METHOD_ICMP:
+        try:
+            reply = key.fileobj.recv(1024)
+        except (OSError, socket.error):
+            return
+        if len(reply) >= 8 and struct.unpack("!B", reply[:1])[0] == _ICMP_ECHO_REPLY:
+            probe.finish(selector, True)
+        return
+
+    port = key.data[1]
+    error = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error in (0, errno.ECONNREFUSED):
+        probe.finish(selector, True)
+        return
+
+    selector.unregister(key.fileobj)
+    key.fileobj.close()
+    probe.sockets.remove(key.fileobj)
+    probe.pending_ports.remove(port)
+    if error in _TCP_HOST_DOWN_ERRORS:
+        probe.finish(selector, False, os.strerror(error))
+    elif not probe.sockets:
+        probe.finish(selector, False, "No response on ports " + ", ".join(str(p) for p in probe.ports) +
+                     " (" + os.strerror(error) + ")")
+
+
+def probe_hosts(host_list, method=PROBE_METHOD_AUTO, probe_timeout=3.0, deadline=None,
+                tcp_ports=DEFAULT_TCP_PROBE_PORTS, max_concurrent_probes=256):
+    """
+    Concurrently check whether each of the provided hosts is reachable, without spawning any processes.
+
+    Hosts are probed with unprivileged ICMP echo requests (resent a few times within probe_timeout) or with
+    non-blocking TCP connects to tcp_ports, where either an accepted or refused connection counts as reachable.
+    All probes are driven from a single selector so checking many hosts takes about as long as the slowest one.
+
+    :param host_list: A list of hosts to check
+    :param method: PROBE_METHOD_ICMP, PROBE_METHOD_TCP or PROBE_METHOD_AUTO
+                   Auto uses ICMP when this process is allowed to open unprivileged ICMP sockets
+                   (see net.ipv4.ping_group_range) and falls back to TCP otherwise
+                   (optional) default = PROBE_METHOD_AUTO
+    :param probe_timeout: the number of seconds to wait for each host to respond (optional) default = 3.0
+    :param deadline: the maximum number of seconds the whole check may take, including resolving the host names;
+                     hosts still outstanding at the deadline are reported as unreachable
+                     (optional) default = no overall deadline
+    :param tcp_ports: the ports to try when probing with TCP (optional) default = DEFAULT_TCP_PROBE_PORTS
+    :param max_concurrent_probes: the maximum number of hosts probed at once (optional) default = 256
+    :return: a dictionary of results for each host where the key will be the host and the value an object
+             with reachable (True/False), latency (seconds, or None) and error attributes.
+             The result objects are truthy when the host was reachable.
+    :raises RuntimeError if ICMP was requested but this process isn't allowed to send it
+    """
+    if method == PROBE_METHOD_AUTO:
+        method = PROBE_METHOD_ICMP if _icmp_available() else PROBE_METHOD_TCP
+    elif method == PROBE_METHOD_ICMP and not _icmp_available():
+        raise RuntimeError("Unprivileged ICMP sockets are not permitted for this process")
+
+    start = time.time()
+    end_time = None if deadline is None else start + deadline
+    results = dict((host, _ProbeResult(host)) for host in host_list)
+    deadline_error = "Overall deadline of " + str(deadline) + " seconds reached"
+
+    # Names are resolved concurrently and each host is probed as soon as it resolves, so a slow resolver neither
+    # serialises the check nor holds up the other hosts
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_RESOLVES, len(results))))
+    resolving = dict((executor.submit(socket.gethostbyname, host), host) for host in results)
+    waiting = []
+    selector = selectors.DefaultSelector()
+    in_flight = []
+    try:
+        while resolving or waiting or in_flight:
+            for future in [future for future in resolving if future.done()]:
+                host = resolving.pop(future)
+                if future.exception() is not None:
+                    results[host].error = "Could not resolve " + host + ": " + str(future.exception())
+                else:
+                    waiting.append((host, future.result()))
+
+            now = time.time()
+            while waiting and len(in_flight) < max_concurrent_probes:
+                host, address = waiting.pop(0)
+                probe = _HostProbe(results[host], address, method, tcp_ports, now, probe_timeout)
+                in_flight.append(probe)
+                try:
+                    _start_probe(selector, probe)
+                except (OSError, socket.error) as e:
+                    probe.finish(selector, False, str(e))
+
+            if end_time is not None and now >= end_time:
+                for probe in in_flight:
+                    if probe.sockets:
+                        probe.finish(selector, False, deadline_error)
+                for host, _ in waiting:
+                    results[host].error = deadline_error
+                for host in resolving.values():
+                    results[host].error = deadline_error + " resolving " + host
+                break
+
+            wake_time = end_time
+            for probe in in_flight:
+                if probe.sockets and now >= probe.expiry:
+                    probe.finish(selector, False, "Timed out after " + str(probe_timeout) + " seconds")
+                    continue
+                if probe.sockets and probe.method == PROBE_METHOD_ICMP and now >= probe.next_send:
+                    probe.sequence += 1
+                    probe.next_send = now + probe.resend_interval
+                    try:
+                        probe.sockets[0].sendto(_icmp_echo_request(probe.sequence), (probe.address, 0))
+                    except (OSError, socket.error) as e:
+                        probe.finish(selector, False, str(e))
+                        continue
+                if probe.sockets:
+                    next_event = probe.expiry
+                    if probe.method == PROBE_METHOD_ICMP:
+                        next_event = min(next_event, probe.next_send)
+                    wake_time = next_event if wake_time is None else min(wake_time, next_event)
+            in_flight = [probe for probe in in_flight if probe.sockets]
+            if resolving:
+                # Check back regularly for newly resolved hosts
+                wake_time = min(now + _RESOLVE_POLL_INTERVAL, wake_time or now + _RESOLVE_POLL_INTERVAL)
+                if not in_flight:
+                    concurrent.futures.wait(list(resolving), timeout=max(0.0, wake_time - time.time()),
+                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                    continue
+            if not in_flight:
+                continue
+
+            for key, _ in selector.select(max(0.0, wake_time - time.time())):
+                _handle_event(selector, key)
+            in_flight = [probe for probe in in_flight if probe.sockets]
+    finally:
+        for probe in in_flight:
+            if probe.sockets:
+                probe.finish(selector, False, "Probe aborted")
+        selector.close()
+        # Don't wait for lookups that missed the deadline
+        executor.shutdown(wait=False)
+
+    return results
+
+
+def check_dns_servers(address_to_check='google.com', dns_servers=None, timeout=3.0):
+    """
+    Ask each DNS server to resolve the given address, concurrently and without spawning any processes
+
+    :param address_to_check: the address to attempt to do a DNS lookup for (optional) default = google.com
+    :param dns_servers: the servers to query (optional) default = the servers configured in /etc/resolv.conf
+    :param timeout: the number of seconds to wait for each server to answer (optional) default = 3.0
+    :return: a dictionary keyed on server; see yu.network.dns.query_servers for the values
+    """
+    if dns_servers is None:
+        dns_servers = get_configured_dns_servers()
+    return dns.query_servers(address_to_check, dns_servers, timeout=timeout)
+
+
+def can_name_resolve_address(address_to_check, dns_server=None, timeout=3.0):
     """
     Check whether a DNS lookup is successful for the given address
 
     :param address_to_check: the address to attempt to do a DNS lookup for
+    :param dns_server: the DNS server to query (optional)
+                       by default every server in /etc/resolv.conf is queried and any success counts
+    :param timeout: the number of seconds to wait for an answer (optional) default = 3.0
     :return: True is DNS lookup was successful; False otherwise
     """
+    servers = None if dns_server is None else [dns_server]
     try:
-        subprocess.check_output(['dig', "+time=3", "+retry=2", address_to_check])
-        return True
-    except:
+        results = check_dns_servers(address_to_check, servers, timeout)
+    except IOError:
         return False
+    return any(result.resolved for result in results.values())
 
 
-def can_name_resolve_external_address(address_to_check='google.com'):
+def can_name_resolve_external_address(address_to_check='google.com', dns_server=None):
     """
     Check whether we can do a dns lookup on an external address
 
     :return:  True is DNS lookup was successful; False otherwise
     """
-    return can_name_resolve_address(address_to_check)
+    return can_name_resolve_address(address_to_check, dns_server)
 
 
 def get_configured_dns_servers():
@@ -75,101 +405,345 @@ def get_configured_dns_servers():
     return configured_dns_list
 
 
-def check_ping(host):
+def check_ping(host, timeout=5):
     """
     Check whether or not the provided host can be pinged
 
     :param host: the host to check
+    :param timeout: the number of seconds to wait for a response (optional) default = 5
     :return: True if the host could be pinged or False otherwise.
     """
-    try:
-        subprocess.check_output(['ping', host, '-i', '0.5', '-c', '5', '-w', '5'])
-        return True
-    except:
-        return False
+    return probe_hosts([host], probe_timeout=timeout)[host].reachable
 
 
-def check_ping_list(host_list_to_check):
+def check_ping_list(host_list_to_check, timeout=5, deadline=None):
     """
-    Check whether or not the provided hosts can be pinged
+    Check whether or not the provided hosts can be pinged.
+    All hosts are checked concurrently; see probe_hosts for the details and for latency information.
 
     :param host_list_to_check: A list of hosts to check
+    :param timeout: the number of seconds to wait for each host to respond (optional) default = 5
+    :param deadline: the maximum number of seconds the whole check may take (optional)
     :return: a dictionary of results for each host where the key will be the host and the value will
              be True if it could be pinged or False otherwise. dict[host] = True/False
     """
-    results = {}
-    for host in host_list_to_check:
-        results[host] = check_ping(host)
-    return results
+    results = probe_hosts(host_list_to_check, probe_timeout=timeout, deadline=deadline)
+    return dict((host, result.reachable) for host, result in results.items())
 
 
-def can_access_web_address(address="http://www.google.com", proxy=None):
+def can_access_web_address(address="http://www.google.com", proxy=None, timeout=DEFAULT_CONNECTIVITY_DEADLINE):
     """
-    Check if we can access the provided address by sending a HTTP GET request
+    Check if we can access the provided address by sending a HTTP HEAD request (falling back to a single byte
+    ranged GET for servers that don't support HEAD) over yu's pooled HTTP session
 
     :param address the web address to check (optional)
             by default this is http://www.google.com
     :param proxy the proxy to use when making the check (optional)
+    :param timeout the number of seconds to wait to connect and for each read (optional) default = 10
     :return: True is we can; False otherwise
     """
     try:
-        proxy_dict = dict()
-        if proxy is not None:
-            proxy_dict['http'] = proxy
-            proxy_dict['https'] = proxy
-
-        r = requests.get(address, proxies=proxy_dict)
-        if not r.ok:
-            r.raise_for_status()
-
-        return True
-    except requests.HTTPError:
+        return httpclient.probe(address, proxy=proxy, timeout=timeout) < 400
+    except requests.RequestException:
         return False
 
 
-def can_reach_external_ip():
+def can_reach_external_ip(timeout=3.0):
     """
     Check if we can get to the google dns server via ip
     Host: 8.8.8.8 (google-public-dns-a.google.com)
     OpenPort: 53/tcp
     Service: domain (DNS/TCP)
 
+    :param timeout: the number of seconds to wait for the connection (optional) default = 3
     :return: True is we can; False otherwise
     """
     try:
-        socket.setdefaulttimeout(3)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(("8.8.8.8", 53))
+        socket.create_connection(("8.8.8.8", 53), timeout=timeout).close()
         return True
-    except Exception as ex:
+    except (socket.error, socket.timeout):
         return False
 
 
-def check_connectivity():
+def _timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def clear_connectivity_cache():
+    """
+    Forget the cached check_connectivity result so the next call runs the probes again
+    """
+    global _cached_connectivity_status
+    with _connectivity_cache_lock:
+        _cached_connectivity_status = None
+
+
+def check_connectivity(deadline=DEFAULT_CONNECTIVITY_DEADLINE, use_cache=True, cache_ttl=None,
+                       dns_address=DEFAULT_DNS_CHECK_ADDRESS, web_address=DEFAULT_WEB_CHECK_ADDRESS, proxy=None):
     """
     Get the connectivity status of the node and populate the values it within a
     yu.network.connectivity.ConnectivityStatus object.
 
-    Gets the configured DNS clients from /etc/resolv.conf and checks whether they are accessible and whether name
-    resolution using them is possible for external urls.
-    The first dns in the configured list that successfully name resolves an external address will be set as the
-    working_external_dns. If none were successful then working_external_dns will be set
+    Gets the configured DNS clients from /etc/resolv.conf and queries each of them directly to check whether name
+    resolution using them is possible for external urls, recording how long each took in dns_latencies.
+    The fastest dns that successfully name resolves an external address will be set as the
+    working_dns. If none were successful then working_dns will be set
     to None.
 
+    The external IP, DNS and external URL probes all run concurrently and the whole check is bounded by deadline;
+    any probe that hasn't finished by then is treated as having failed. How long each probe took is recorded in
+    probe_latencies.
+    The result of a check with the default addresses and proxy is cached and returned to later callers until it is
+    older than cache_ttl.
+
+    :param deadline: the maximum number of seconds the check may take (optional) default = 10
+    :param use_cache: set to False to always run the probes (the fresh result is still cached)
+                      (optional) default = True
+    :param cache_ttl: the maximum age in seconds of a cached result that may be returned
+                      (optional) default = CONNECTIVITY_CACHE_TTL
+    :param dns_address: the address each DNS server is asked to resolve (optional) default = google.com
+    :param web_address: the web address to fetch (optional) default = http://www.google.com
+    :param proxy: the proxy to use for the web check (optional) default = GLOBAL_WORKING_EXTERNAL_PROXY
     :return: yu.network.connectivity.ConnectivityStatus object with the status
     """
-    status = _ConnectivityStatus()
-    status.can_access_external_ip = can_reach_external_ip()
+    global _cached_connectivity_status
+    if cache_ttl is None:
+        cache_ttl = CONNECTIVITY_CACHE_TTL
+    # The cache only holds the result of the default check
+    is_default_check = dns_address == DEFAULT_DNS_CHECK_ADDRESS and web_address == DEFAULT_WEB_CHECK_ADDRESS and \
+        proxy is None
+    if proxy is None:
+        proxy = GLOBAL_WORKING_EXTERNAL_PROXY
+    if use_cache and is_default_check:
+        with _connectivity_cache_lock:
+            cached = _cached_connectivity_status
+        if cached is not None and time.time() - cached.checked_at < cache_ttl:
+            return cached
 
+    status = _ConnectivityStatus()
+    status.checked_at = time.time()
     status.dns_list = get_configured_dns_servers()
-    for dns in status.dns_list:
-        if check_ping(dns) is True:
-            if can_name_resolve_external_address() is True and status.working_dns is None:
-                status.working_dns = dns
-                status.can_name_resolve_address = True
-                break
 
-    if status.working_dns is False:
-        return status
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+    try:
+        probes = {
+            'external_ip': executor.submit(_timed, can_reach_external_ip, min(3.0, deadline)),
+            'dns': executor.submit(_timed, check_dns_servers, address_to_check=dns_address,
+                                   dns_servers=status.dns_list, timeout=min(3.0, deadline)),
+            'external_url': executor.submit(_timed, can_access_web_address, address=web_address, proxy=proxy,
+                                            timeout=deadline),
+        }
+        concurrent.futures.wait(probes.values(), timeout=max(0.0, status.checked_at + deadline - time.time()))
+    finally:
+        # Don't wait for stragglers; each probe is bounded by its own timeout
+        executor.shutdown(wait=False)
 
-    status.can_access_external_url = can_access_web_address()
+    results = {}
+    for probe_name, future in probes.items():
+        if future.done() and future.exception() is None:
+            results[probe_name], status.probe_latencies[probe_name] = future.result()
+        else:
+            results[probe_name], status.probe_latencies[probe_name] = None, None
+
+    status.can_access_external_ip = results['external_ip'] is True
+    status.can_access_external_url = results['external_url'] is True
+    if results['dns'] is not None:
+        for server, result in results['dns'].items():
+            status.dns_latencies[server] = result.latency if result.resolved else None
+        status.working_dns = dns.fastest_server(results['dns'])
+    status.can_name_resolve_address = status.working_dns is not None
+    status.duration = time.time() - status.checked_at
+
+    if is_default_check:
+        with _connectivity_cache_lock:
+            _cached_connectivity_status = status
+    return status
+
+
+def _status_from_probe_output(output):
+    for line in output.splitlines():
+        if line.startswith(_connectivity_probe.RESULT_MARKER):
+            results = json.loads(line[len(_connectivity_probe.RESULT_MARKER):])
+            break
+    else:
+        raise RuntimeError("The connectivity probe didn't produce a result: " + output)
+
+    status = _ConnectivityStatus()
+    status.checked_at = time.time()
+    status.duration = results.get('duration')
+    status.dns_list = results.get('dns_list', [])
+    status.dns_latencies = results.get('dns_latencies', {})
+    working = [server for server in status.dns_list if status.dns_latencies.get(server) is not None]
+    if working:
+        status.working_dns = min(working, key=lambda server: status.dns_latencies[server])
+    status.can_name_resolve_address = status.working_dns is not None
+    status.can_access_external_ip = results.get('external_ip') is True
+    status.can_access_external_url = results.get('external_url') is True
+    for probe_name in ('external_ip', 'external_url'):
+        status.probe_latencies[probe_name] = results.get(probe_name + "_latency")
     return status
+
+
+def check_connectivity_on_node(node, deadline=DEFAULT_CONNECTIVITY_DEADLINE, dns_address=DEFAULT_DNS_CHECK_ADDRESS,
+                               web_address=DEFAULT_WEB_CHECK_ADDRESS, proxy=None):
+    """
+    Run the check_connectivity probes on the provided node and store the result in its connectivity_status.
+    A single self-contained probe script is piped to whichever python interpreter the node has, so nothing needs
+    to be installed on the node.
+
+    :param node: the yu.network.RemoteNode to check
+    :param deadline: the maximum number of seconds the probes may take on the node (optional) default = 10
+    :param dns_address: the address each DNS server is asked to resolve (optional) default = google.com
+    :param web_address: the web address to fetch (optional) default = http://www.google.com
+    :param proxy: the proxy to use for the web check (optional) default = GLOBAL_WORKING_EXTERNAL_PROXY
+    :return: yu.network.connectivity.ConnectivityStatus object with the status
+    :raises RuntimeError if the probe could not be run on the node
+    """
+    if node.get_location().is_local():
+        status = check_connectivity(deadline=deadline, dns_address=dns_address, web_address=web_address, proxy=proxy)
+    else:
+        if proxy is None:
+            proxy = GLOBAL_WORKING_EXTERNAL_PROXY
+        settings = {'deadline': deadline, 'dns_address': dns_address, 'web_address': web_address, 'proxy': proxy}
+        encoded_settings = base64.b64encode(json.dumps(settings).encode("utf-8")).decode("ascii")
+        with open(os.path.splitext(_connectivity_probe.__file__)[0] + ".py", 'rb') as f:
+            probe_script = f.read()
+
+        probe_command = ("PYTHON=$(command -v python3 || command -v python || command -v python2) && "
+                         "$PYTHON - " + encoded_settings)
+        result_code, result_string = node.command_with_input(probe_command, probe_script, timeout=deadline + 30)
+        if result_code != 0:
+            raise RuntimeError("Failed to run the connectivity probe on " + node.get_host_to_connect_to() + ": " +
+                               str(result_string))
+        status = _status_from_probe_output(result_string)
+
+    node.connectivity_status = status
+    return status
+
+
+def check_connectivity_on_nodes(node_list, deadline=DEFAULT_CONNECTIVITY_DEADLINE, max_concurrent_nodes=32,
+                                dns_address=DEFAULT_DNS_CHECK_ADDRESS, web_address=DEFAULT_WEB_CHECK_ADDRESS,
+                                proxy=None):
+    """
+    Run check_connectivity_on_node on many nodes concurrently, so checking a whole site takes about as long as
+    the slowest node.
+
+    :param node_list: the yu.network.RemoteNode objects to check
+    :param deadline: the maximum number of seconds the probes may take on each node (optional) default = 10
+    :param max_concurrent_nodes: the maximum number of nodes checked at once (optional) default = 32
+    :param dns_address: the address each DNS server is asked to resolve (optional) default = google.com
+    :param web_address: the web address to fetch (optional) default = http://www.google.com
+    :param proxy: the proxy to use for the web check (optional) default = GLOBAL_WORKING_EXTERNAL_PROXY
+    :return: a dictionary keyed on the host of each node whose values are the ConnectivityStatus for that node,
+             or the exception raised if the node couldn't be checked
+    """
+    results = {}
+    if not node_list:
+        return results
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrent_nodes, len(node_list)))
+    try:
+        futures = dict((executor.submit(check_connectivity_on_node, node, deadline, dns_address, web_address, proxy),
+                        node) for node in node_list)
+        for future in concurrent.futures.as_completed(futures):
+            host = futures[future].get_host_to_connect_to()
+            try:
+                results[host] = future.result()
+            except Exception as e:
+                results[host] = e
+    finally:
+        executor.shutdown(wait=True)
+    return results
+
+
+def get_candidate_proxies(extra_candidates=None):
+    """
+    Gather the proxies that might be usable from this node, in order of preference:
+     - the extra candidates provided
+     - the current GLOBAL_WORKING_EXTERNAL_PROXY
+     - the proxy environment variables (https_proxy, http_proxy, all_proxy and their upper case forms)
+     - the proxy configured in /etc/yum.conf
+
+    :param extra_candidates: a list of additional proxies to consider first (optional)
+    :return: a list of unique proxy URLs
+    """
+    from yu.packageManagement import yum
+
+    candidates = list(extra_candidates or [])
+    candidates.append(GLOBAL_WORKING_EXTERNAL_PROXY)
+    candidates.extend(os.environ.get(variable) for variable in PROXY_ENVIRONMENT_VARIABLES)
+    try:
+        candidates.append(yum.get_system_proxy())
+    except IOError:
+        pass
+
+    unique_candidates = []
+    for proxy in candidates:
+        if not proxy:
+            continue
+        proxy = proxy.strip()
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        if proxy not in unique_candidates:
+            unique_candidates.append(proxy)
+    return unique_candidates
+
+
+def rank_proxies(candidates, test_address="http://www.google.com", timeout=3.0, max_concurrent_checks=16):
+    """
+    Test each proxy concurrently by fetching test_address through it
+
+    :param candidates: the proxies to test
+    :param test_address: the web address to fetch through each proxy (optional) default = http://www.google.com
+    :param timeout: the number of seconds to allow each proxy (optional) default = 3
+    :param max_concurrent_checks: the maximum number of proxies tested at once (optional) default = 16
+    :return: a list of (proxy, latency in seconds) tuples for the working proxies, fastest first
+    """
+    if not candidates:
+        return []
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrent_checks, len(candidates)))
+    try:
+        futures = dict((executor.submit(_timed, can_access_web_address, test_address, proxy, timeout), proxy)
+                       for proxy in candidates)
+        working = []
+        for future in concurrent.futures.as_completed(futures):
+            reachable, latency = future.result()
+            if reachable:
+                working.append((futures[future], latency))
+    finally:
+        executor.shutdown(wait=True)
+    return sorted(working, key=lambda proxy_result: proxy_result[1])
+
+
+def discover_working_proxy(candidates=None, test_address="http://www.google.com", timeout=3.0, use_cache=True,
+                           cache_ttl=None):
+    """
+    Find the fastest working proxy and store it in GLOBAL_WORKING_EXTERNAL_PROXY, where the connectivity checks and
+    the yum and pip helpers will pick it up.
+    All candidates (see get_candidate_proxies) are tested in parallel with a short timeout so dead proxies are
+    weeded out quickly. The result is reused until it is older than cache_ttl.
+
+    :param candidates: additional proxies to consider (optional)
+    :param test_address: the web address to fetch through each proxy (optional) default = http://www.google.com
+    :param timeout: the number of seconds to allow each proxy (optional) default = 3
+    :param use_cache: set to False to always test the candidates (optional) default = True
+    :param cache_ttl: the maximum age in seconds of a previously discovered proxy that may be returned
+                      (optional) default = PROXY_CACHE_TTL
+    :return: the fastest working proxy; None if none of the candidates worked
+    """
+    global GLOBAL_WORKING_EXTERNAL_PROXY, _proxy_discovered_at
+    if cache_ttl is None:
+        cache_ttl = PROXY_CACHE_TTL
+    if use_cache:
+        with _proxy_cache_lock:
+            if _proxy_discovered_at is not None and time.time() - _proxy_discovered_at < cache_ttl:
+                return GLOBAL_WORKING_EXTERNAL_PROXY
+
+    ranked = rank_proxies(get_candidate_proxies(candidates), test_address, timeout)
+    with _proxy_cache_lock:
+        GLOBAL_WORKING_EXTERNAL_PROXY = ranked[0][0] if ranked else None
+        _proxy_discovered_at = time.time()
+        return GLOBAL_WORKING_EXTERNAL_PROXY
@@ -0,0 +1,225 @@
+import time
+import random
+import socket
+import struct
+import selectors
+
+
+DNS_PORT = 53
+
+QUERY_TYPE_A = 1
+QUERY_TYPE_AAAA = 28
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+_HEADER_FORMAT = "!HHHHHH"
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_FLAG_RESPONSE = 0x8000
+_FLAG_RECURSION_DESIRED = 0x0100
+_CLASS_IN = 1
+
+
+class _DnsQueryResult(object):
+    def __init__(self, server):
+        self.server = server
+        self.responded = False
+        self.resolved = False
+        self.rcode = None
+        self.addresses = []
+        self.latency = None
+        self.error = None
+
+    def __bool__(self):
+        return self.resolved
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        if self.resolved:
+            return "<" + self.server + " resolved " + ", ".join(self.addresses) + " in " + \
+                   str(round(self.latency * 1000, 2)) + "ms>"
+        return "<" + self.server + " failed: " + str(self.error) + ">"
+
+
+def build_query(name, query_id, query_type=QUERY_TYPE_A):
+    """
+    Build a recursive DNS query packet
+
+    :param name: the name to look up
+    :param query_id: the 16 bit id to give the query
+    :param query_type: the record type to ask for (optional) default = QUERY_TYPE_A
+    :return: the query packet as bytes
+    """
+    packet = struct.pack(_HEADER_FORMAT, query_id, _FLAG_RECURSION_DESIRED, 1, 0, 0, 0)
+    for label in name.strip(".").split("."):
+        encoded = label.encode("idna")
+        if not 0 < len(encoded) < 64:
+            raise ValueError("Invalid DNS name: " + name)
+        packet += struct.pack("!B", len(encoded)) + encoded
+    return packet + b'\x00' + struct.pack("!HH", query_type, _CLASS_IN)
+
+
+def _skip_name(data, offset):
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated DNS name")
+        length = struct.unpack("!B", data[offset:offset + 1])[0]
+        if length & 0xc0 == 0xc0:
+            # A compression pointer always ends the name
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def parse_response(data, query_id, query_type=QUERY_TYPE_A):
+    """
+    Parse a DNS response packet
+
+    :param data: the response packet
+    :param query_id: the id of the query the response should be for
+    :param query_type: the record type that was asked for (optional) default = QUERY_TYPE_A
+    :return: a tuple of the response code and the list of addresses of the requested type in the answer
+    :raises ValueError if the packet is malformed or isn't a response to the query
+    """
+    if len(data) < _HEADER_SIZE:
+        raise ValueError("Truncated DNS header")
+    response_id, flags, question_count, answer_count, _, _ = struct.unpack(_HEADER_FORMAT, data[:_HEADER_SIZE])
+    if response_id != query_id or not flags & _FLAG_RESPONSE:
+        raise ValueError("Not a response to query " + str(query_id))
+
+    offset = _HEADER_SIZE
+    for _ in range(question_count):
+        offset = _skip_name(data, offset) + 4
+
+    addresses = []
+    for _ in range(answer_count):
+        offset = _skip_name(data, offset)
+        if offset + 10 > len(data):
+            raise ValueError("Truncated DNS answer")
+        record_type, _, _, data_length = struct.unpack("!HHIH", data[offset:offset + 10])
+        offset += 10
+        record_data = data[offset:offset + data_length]
+        if len(record_data) != data_length:
+            raise ValueError("Truncated DNS answer")
+        offset += data_length
+
+        if record_type == query_type == QUERY_TYPE_A and data_length == 4:
+            addresses.append(socket.inet_ntop(socket.AF_INET, record_data))
+        elif record_type == query_type == QUERY_TYPE_AAAA and data_length == 16:
+            addresses.append(socket.inet_ntop(socket.AF_INET6, record_data))
+
+    return flags & 0x000f, addresses
+
+
+def query_servers(name, servers, query_type=QUERY_TYPE_A, timeout=3.0, attempts=2, port=DNS_PORT):
+    """
+    Send the same query to each of the provided nameservers concurrently and time how long each takes to resolve it.
+    Queries are sent over UDP from a single selector, so the whole check takes about as long as the slowest server;
+    a query that hasn't been answered is resent up to attempts times within the timeout.
+
+    :param name: the name to resolve
+    :param servers: the list of nameserver addresses to query
+    :param query_type: the record type to ask for (optional) default = QUERY_TYPE_A
+    :param timeout: the number of seconds to wait for each server to answer (optional) default = 3.0
+    :param attempts: the number of times the query may be sent to each server (optional) default = 2
+    :param port: the port the nameservers listen on (optional) default = 53
+    :return: a dictionary keyed on server whose values have responded, resolved, rcode, addresses, latency
+             (seconds, or None) and error attributes. The values are truthy when the server resolved the name.
+    """
+    results = {}
+    pending = {}
+    selector = selectors.DefaultSelector()
+    start = time.time()
+    resend_interval = timeout / float(max(1, attempts))
+
+    # Every socket is connected to a single server, so the same query (and id) can be sent to all of them
+    query_id = random.getrandbits(16)
+    try:
+        query = build_query(name, query_id, query_type)
+    except (ValueError, UnicodeError) as e:
+        for server in servers:
+            results[server] = _DnsQueryResult(server)
+            results[server].error = str(e)
+        selector.close()
+        return results
+
+    try:
+        for server in servers:
+            result = _DnsQueryResult(server)
+            results[server] = result
+            sock = None
+            try:
+                family, sock_type, proto, _, address = socket.getaddrinfo(server, port, 0, socket.SOCK_DGRAM)[0]
+                sock = socket.socket(family, sock_type, proto)
+                sock.setblocking(False)
+                # Connecting the socket filters out packets from anyone else and surfaces ICMP port unreachable
+                sock.connect(address)
+                selector.register(sock, selectors.EVENT_READ, (result, query_id))
+            except (socket.error, ValueError) as e:
+                result.error = str(e)
+                if sock is not None:
+                    sock.close()
+                continue
+            pending[sock] = [query, 0, start]
+
+        while pending:
+            now = time.time()
+            if now >= start + timeout:
+                for sock in pending:
+                    selector.get_key(sock).data[0].error = "Timed out after " + str(timeout) + " seconds"
+                break
+
+            for sock, state in pending.items():
+                if state[1] < attempts and now >= state[2]:
+                    try:
+                        sock.send(state[0])
+                    except socket.error:
+                        pass
+                    state[1] += 1
+                    state[2] = now + resend_interval
+
+            wake_time = min([start + timeout] + [state[2] for state in pending.values() if state[1] < attempts])
+            for key, _ in selector.select(max(0.0, wake_time - time.time())):
+                result, query_id = key.data
+                try:
+                    rcode, addresses = parse_response(key.fileobj.recv(4096), query_id, query_type)
+                except ValueError:
+                    # Not our answer; keep waiting
+                    continue
+                except socket.error as e:
+                    result.error = str(e)
+                else:
+                    result.responded = True
+                    result.rcode = rcode
+                    result.addresses = addresses
+                    result.latency = time.time() - start
+                    result.resolved = rcode == RCODE_NOERROR and len(addresses) > 0
+                    if not result.resolved:
+                        result.error = "No " + ("A" if query_type == QUERY_TYPE_A else "matching") + \
+                                       " records returned (rcode " + str(rcode) + ")"
+                selector.unregister(key.fileobj)
+                del pending[key.fileobj]
+                key.fileobj.close()
+    finally:
+        for sock in pending:
+            selector.unregister(sock)
+            sock.close()
+        selector.close()
+
+    return results
+
+
+def fastest_server(results):
+    """
+    Pick the server that resolved the name fastest
+
+    :param results: the results from query_servers
+    :return: the fastest server that resolved the name; None if none did
+    """
+    working = [result for result in results.values() if result.resolved]
+    if not working:
+        return None
+    return min(working, key=lambda result: result.latency).server
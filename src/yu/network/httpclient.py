@@ -0,0 +1,102 @@
+import os
+import threading
+import requests
+import requests.adapters
+
+
+# (connect, read) timeouts in seconds applied to every request that doesn't provide its own
+DEFAULT_TIMEOUT = (3.05, 30)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 32
+
+_session_lock = threading.Lock()
+_session = None
+
+
+def get_session():
+    """
+    Get the HTTP session shared by yu. Connections are kept alive and pooled per host so repeated requests to the
+    same servers don't pay for new TCP and TLS handshakes.
+
+    :return: the shared requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def close_session():
+    """
+    Close the shared session and all of its pooled connections. A new session is created on next use
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _proxies(proxy):
+    if proxy is None:
+        return None
+    return {'http': proxy, 'https': proxy}
+
+
+def probe(address, proxy=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Check whether a web address responds without transferring its body.
+    A HEAD request is sent and, for servers that don't support HEAD, a GET for just the first byte.
+
+    :param address: the web address to probe
+    :param proxy: the proxy to send the request through (optional)
+    :param timeout: the connect and read timeouts in seconds; a single number or a (connect, read) tuple
+                    (optional) default = DEFAULT_TIMEOUT
+    :return: the HTTP status code of the response
+    :raises requests.RequestException if no response was received
+    """
+    session = get_session()
+    response = session.head(address, proxies=_proxies(proxy), timeout=timeout, allow_redirects=True)
+    response.close()
+    if response.status_code not in (405, 501):
+        return response.status_code
+
+    response = session.get(address, proxies=_proxies(proxy), timeout=timeout, headers={'Range': "bytes=0-0"},
+                           stream=True)
+    response.close()
+    return response.status_code
+
+
+def download(url, destination_path, proxy=None, timeout=DEFAULT_TIMEOUT, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Stream the body of url to a local file in chunks, so memory use doesn't depend on the size of the download.
+    The data is written to a temporary file next to destination_path that is renamed into place once complete.
+
+    :param url: the address to download
+    :param destination_path: the file to write the download to
+    :param proxy: the proxy to send the request through (optional)
+    :param timeout: the connect and read timeouts in seconds; a single number or a (connect, read) tuple
+                    (optional) default = DEFAULT_TIMEOUT
+    :param chunk_size: the number of bytes to read at a time (optional) default = 64KiB
+    :return: destination_path
+    :raises requests.RequestException if the download failed
+    """
+    temporary_path = destination_path + ".part"
+    response = get_session().get(url, proxies=_proxies(proxy), timeout=timeout, stream=True)
+    try:
+        response.raise_for_status()
+        with open(temporary_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+        os.replace(temporary_path, destination_path)
+    finally:
+        response.close()
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return destination_path
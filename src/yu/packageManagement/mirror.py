@@ -0,0 +1,275 @@
+import os
+import shutil
+import threading
+import subprocess
+import http.server
+import socketserver
+
+from yu.packageManagement import yum
+
+
+ATTACH_FORWARD = "forward"
+ATTACH_SYNC = "sync"
+
+DEFAULT_REPO_ID = "yu-mirror"
+DEFAULT_REMOTE_SYNC_DIR = "/var/tmp/yu-mirror"
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _RepoRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Set on the subclass made for each mirror
+    repo_dir = None
+
+    def translate_path(self, path):
+        path = super(_RepoRequestHandler, self).translate_path(path)
+        return os.path.join(self.repo_dir, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class YumMirror(object):
+    """
+    A local yum repository of downloaded rpms that can be attached to remote nodes without internet access, so they
+    can do normal dependency resolving installs from it, e.g.
+
+        mirror = YumMirror("/srv/yu-mirror")
+        mirror.populate(["gcc", "cmake"])
+        mirror.attach(node)
+        yum.install_package_on(node, package_name="gcc", repo_id=mirror.repo_id)
+        mirror.detach(node)
+
+    The repo metadata is built with createrepo_c (or createrepo) and updated incrementally as packages are added.
+    A node is attached either by forwarding a port on the node back to an HTTP server for the repo over its SSH
+    connection (ATTACH_FORWARD), or by copying the packages the node doesn't already have to it in one streamed
+    transfer (ATTACH_SYNC); either way a temporary .repo file pointing at the mirror is added on the node.
+    """
+    def __init__(self, repo_dir, repo_id=DEFAULT_REPO_ID, repo_name=None):
+        """
+        :param repo_dir: the local directory to keep the repo in; it is created if it doesn't exist
+        :param repo_id: the id the repo is given on nodes it is attached to (optional) default = yu-mirror
+        :param repo_name: the name the repo is given on nodes it is attached to (optional) default = repo_id
+        """
+        self.repo_dir = os.path.abspath(repo_dir)
+        self.repo_id = repo_id
+        self.repo_name = repo_name or repo_id
+
+        self.m_lock = threading.Lock()
+        self.m_server = None
+        self.m_server_thread = None
+        self.m_attached = {}
+        self.m_metadata_stale = not os.path.isfile(os.path.join(self.repo_dir, "repodata", "repomd.xml"))
+
+        if not os.path.isdir(self.repo_dir):
+            os.makedirs(self.repo_dir)
+
+    def get_packages(self):
+        """
+        :return: the filenames of the rpms in the repo
+        """
+        return sorted(filename for filename in os.listdir(self.repo_dir) if filename.endswith(".rpm"))
+
+    def populate(self, package_list):
+        """
+        Download packages and their whole dependency closure into the repo, including dependencies this node already
+        has installed, skipping those already in it, and update the repo metadata.
+        See yu.packageManagement.yum.download_packages
+
+        :param package_list: the packages to add
+        :return: the paths of the rpms for the requested packages
+        :raises RuntimeError if a download or the metadata update failed
+        """
+        before = set(self.get_packages())
+        # Nodes installing from the mirror may have none of the dependencies this node has
+        paths = yum.download_packages(package_list, self.repo_dir, all_dependencies=True)
+        if set(self.get_packages()) != before:
+            self.m_metadata_stale = True
+        self.update_metadata()
+        return paths
+
+    def add_packages(self, package_paths):
+        """
+        Add already downloaded rpms to the repo and update the repo metadata.
+        Files are hard linked into the repo where possible rather than copied.
+
+        :param package_paths: the paths of the rpm files to add
+        :raises RuntimeError if the metadata update failed
+        """
+        for package_path in package_paths:
+            destination = os.path.join(self.repo_dir, os.path.basename(package_path))
+            if os.path.exists(destination) and os.path.samefile(package_path, destination):
+                continue
+            try:
+                if os.path.exists(destination):
+                    os.remove(destination)
+                os.link(package_path, destination)
+            except OSError:
+                shutil.copy2(package_path, destination)
+            self.m_metadata_stale = True
+        self.update_metadata()
+
+    def update_metadata(self, force=False):
+        """
+        Bring the repodata up to date with the packages in the repo. Only packages that have changed since the last
+        update are read, using createrepo's --update
+
+        :param force: set to True to update the metadata even if no packages have been added through this object
+                      (optional) default = False
+        :raises RuntimeError if neither createrepo_c nor createrepo could be run or the update failed
+        """
+        with self.m_lock:
+            if not force and not self.m_metadata_stale:
+                return
+            error = None
+            for createrepo in ("createrepo_c", "createrepo"):
+                try:
+                    _ = subprocess.check_output([createrepo, "--update", "--quiet", self.repo_dir],
+                                                stderr=subprocess.STDOUT)
+                    self.m_metadata_stale = False
+                    return
+                except OSError as e:
+                    error = e
+                except subprocess.CalledProcessError as e:
+                    text = "Couldn't update the repo metadata in " + self.repo_dir + ". Encountered an error: " + \
+                           str(e)
+                    if e.output is not None:
+                        text += "\n" + str(e.output)
+                    raise RuntimeError(text)
+            raise RuntimeError("Couldn't run createrepo_c or createrepo: " + str(error))
+
+    def start_server(self, port=0, host="127.0.0.1"):
+        """
+        Serve the repo over HTTP from this node. attach starts the server when needed
+
+        :param port: the port to listen on; 0 to pick a free one (optional) default = 0
+        :param host: the address to listen on (optional) default = 127.0.0.1
+        :return: the port the server is listening on
+        """
+        with self.m_lock:
+            if self.m_server is None:
+                handler = type("_MirrorRequestHandler", (_RepoRequestHandler,), {'repo_dir': self.repo_dir})
+                self.m_server = _ThreadingHTTPServer((host, port), handler)
+                self.m_server_thread = threading.Thread(target=self.m_server.serve_forever,
+                                                        name="yu-yum-mirror-" + self.repo_id)
+                self.m_server_thread.daemon = True
+                self.m_server_thread.start()
+            return self.m_server.server_address[1]
+
+    def stop_server(self):
+        with self.m_lock:
+            if self.m_server is not None:
+                self.m_server.shutdown()
+                self.m_server.server_close()
+                self.m_server_thread.join()
+                self.m_server = None
+                self.m_server_thread = None
+
+    def sync_to(self, node, remote_dir=DEFAULT_REMOTE_SYNC_DIR):
+        """
+        Make remote_dir on the node a copy of the repo. The packages the node already has (same name and size) aren't
+        sent again; the rest and the repodata are streamed across in a single transfer, and packages no longer in
+        the repo are removed from the node.
+
+        :param node: the yu.network.RemoteNode to copy the repo to
+        :param remote_dir: the directory on the node to copy the repo into (optional) default = /var/tmp/yu-mirror
+        :raises RuntimeError if the copy failed
+        """
+        self.update_metadata()
+        result_code, result_string = node.command("mkdir -p " + remote_dir + " && cd " + remote_dir +
+                                                  " && find . -maxdepth 1 -name '*.rpm' -printf '%f\\t%s\\n'")
+        if result_code != 0:
+            raise RuntimeError("Couldn't list the packages in " + remote_dir + " on " + node.get_location().address +
+                               ": " + result_string)
+        remote_packages = {}
+        for line in result_string.splitlines():
+            fields = line.split("\t")
+            if len(fields) == 2 and fields[1].isdigit():
+                remote_packages[fields[0]] = int(fields[1])
+
+        local_packages = self.get_packages()
+        to_send = [os.path.join(self.repo_dir, filename) for filename in local_packages
+                   if remote_packages.get(filename) != os.path.getsize(os.path.join(self.repo_dir, filename))]
+        to_remove = [filename for filename in remote_packages if filename not in local_packages]
+
+        # The old repodata is replaced wholesale as createrepo gives its files new names on every update
+        clean_command = "rm -rf " + os.path.join(remote_dir, "repodata")
+        if to_remove:
+            clean_command += " && cd " + remote_dir + " && rm -f " + " ".join("'" + filename + "'"
+                                                                                 for filename in to_remove)
+        result_code, result_string = node.command(clean_command)
+        if result_code != 0:
+            raise RuntimeError("Couldn't clean " + remote_dir + " on " + node.get_location().address + ": " +
+                               result_string)
+        node.push_and_extract(to_send + [os.path.join(self.repo_dir, "repodata")], remote_dir)
+
+    def attach(self, node, method=ATTACH_FORWARD, remote_port=0, remote_dir=DEFAULT_REMOTE_SYNC_DIR):
+        """
+        Make the repo available to a node and add a .repo file for it there
+
+        :param node: the yu.network.RemoteNode to attach the repo to
+        :param method: ATTACH_FORWARD to serve the repo to the node over a port forwarded across its SSH connection,
+                       or ATTACH_SYNC to copy the repo to the node with sync_to (optional) default = ATTACH_FORWARD
+        :param remote_port: the port on the node to forward, for ATTACH_FORWARD; 0 to have one picked
+                            (optional) default = 0
+        :param remote_dir: the directory on the node to copy the repo into, for ATTACH_SYNC
+                           (optional) default = /var/tmp/yu-mirror
+        :return: the base url of the repo on the node
+        :raises RuntimeError if the repo couldn't be attached
+        """
+        self.detach(node)
+        self.update_metadata()
+        if method == ATTACH_FORWARD:
+            local_port = self.start_server()
+            forwarded_port = node.start_reverse_forward(remote_port, local_port)
+            base_url = "http://127.0.0.1:" + str(forwarded_port) + "/"
+        elif method == ATTACH_SYNC:
+            self.sync_to(node, remote_dir)
+            forwarded_port = None
+            base_url = "file://" + remote_dir
+        else:
+            raise RuntimeError("Unknown attach method: " + str(method))
+
+        try:
+            # The metadata is never cached so packages added to the mirror are seen straight away
+            yum.add_repo(self.repo_id, self.repo_name, base_url, node=node,
+                         options={'metadata_expire': "0", 'skip_if_unavailable': "1"})
+        except RuntimeError:
+            if forwarded_port is not None:
+                node.stop_reverse_forward(forwarded_port)
+            raise
+        with self.m_lock:
+            self.m_attached[node] = forwarded_port
+        return base_url
+
+    def detach(self, node):
+        """
+        Remove the repo's .repo file from a node and stop any port forward to it. A synced copy of the repo is left
+        in place so the next sync only sends what has changed
+
+        :param node: the yu.network.RemoteNode to detach the repo from
+        """
+        with self.m_lock:
+            if node not in self.m_attached:
+                return
+            forwarded_port = self.m_attached.pop(node)
+        try:
+            yum.remove_repo(self.repo_id, node=node)
+        finally:
+            if forwarded_port is not None:
+                node.stop_reverse_forward(forwarded_port)
+
+    def close(self):
+        """
+        Detach the repo from every node and stop the HTTP server
+        """
+        with self.m_lock:
+            nodes = list(self.m_attached)
+        for node in nodes:
+            try:
+                self.detach(node)
+            except RuntimeError:
+                pass
+        self.stop_server()
@@ -1,9 +1,12 @@
 import os
 import sys
-import requests
+import shutil
 import subprocess
 import posixpath
 
+from yu.network import connectivity
+from yu.network import httpclient
+
 
 GET_PIP_SCRIPT_LOCATION = "https://bootstrap.pypa.io/"
 GET_PIP_SCRIPT_NAME = 'get-pip.py'
@@ -11,23 +14,36 @@ GET_PIP_SCRIPT_NAME = 'get-pip.py'
 PIP_COMMAND_LIST = [sys.executable, "-m", "pip"]
 
 
+def use_working_proxy(candidates=None):
+    """
+    Find the fastest working proxy with yu.network.connectivity.discover_working_proxy so the pip helpers in this
+    module use it
+
+    :param candidates: additional proxies to consider (optional)
+    :return: the proxy chosen; None if none of the candidates worked
+    """
+    return connectivity.discover_working_proxy(candidates)
+
+
 def download_get_pip_script(destination_dir):
     """
-    Download the script that allows you install pip on a machine
-    :param destination_dir:
-    :return:
+    Download the script that allows you install pip on a machine.
+    The script is streamed to disk through yu's pooled HTTP session
+
+    :param destination_dir: the directory to download the script to
+    :return: the path of the downloaded script
+    :raises requests.RequestException if the download failed
     """
-    r = requests.get(posixpath.join(GET_PIP_SCRIPT_LOCATION, GET_PIP_SCRIPT_NAME))
-    if not r.ok:
-        r.raise_for_status()
     file_location = os.path.join(destination_dir, GET_PIP_SCRIPT_NAME)
-    open(file_location, 'wb').write(r.content)
-    return file_location
+    return httpclient.download(posixpath.join(GET_PIP_SCRIPT_LOCATION, GET_PIP_SCRIPT_NAME), file_location,
+                               proxy=connectivity.GLOBAL_WORKING_EXTERNAL_PROXY)
 
 
 def _run_local_pip_command(args_list):
     command_list = list(PIP_COMMAND_LIST)
     command_list.extend(args_list)
+    if connectivity.GLOBAL_WORKING_EXTERNAL_PROXY is not None:
+        command_list.extend(["--proxy", connectivity.GLOBAL_WORKING_EXTERNAL_PROXY])
     return subprocess.check_output(command_list, stderr=subprocess.STDOUT)
 
 
@@ -51,17 +67,49 @@ def download_package(package_name, target_dir=None):
         raise RuntimeError(text)
 
 
-def download_packages(package_list, target_dir=None):
+def download_packages(package_list, target_dir=None, wheelhouse=None):
     """
-    Download the each package in the provided list using pip and put it in the target directory provided.
-    If no directory is provided then it will be downloaded into the current working directory
-
-    :param package_list:
-    :param target_dir:
+    Download the packages in the provided list, and their dependencies, using a single pip invocation and put them in
+    the target directory provided.
+    If no directory is provided then they will be downloaded into the current working directory
+
+    :param package_list: The packages to download
+    :param target_dir: The directory to download the packages to
+    :param wheelhouse: a yu.packageManagement.wheelhouse.Wheelhouse to fetch the packages through, so only those it
+                       doesn't already hold are downloaded; they are then copied into target_dir (optional)
+    :return: the paths of the files in target_dir for the packages and their dependencies, including those that had
+             already been downloaded there
     :raises: RuntimeError if any of the packages failed to downloaded
     """
-    for package in package_list:
-        download_package(package, target_dir)
+    if target_dir is None:
+        target_dir = os.getcwd()
+    if wheelhouse is not None:
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        paths = []
+        for wheel_path in wheelhouse.fetch(package_list):
+            paths.append(os.path.abspath(os.path.join(target_dir, os.path.basename(wheel_path))))
+            shutil.copyfile(wheel_path, paths[-1])
+        return paths
+
+    try:
+        output = _run_local_pip_command(['download', '-d', target_dir] + list(package_list))
+    except subprocess.CalledProcessError as e:
+        text = "Couldn't download " + " ".join(package_list) + ". Encountered an error: " + str(e)
+        if e.output is not None:
+            text += "\n" + str(e.output)
+        raise RuntimeError(text)
+
+    # pip reports each file as either "Saved <path>" or "File was already downloaded <path>"
+    paths = []
+    for line in output.decode('utf-8', 'replace').splitlines():
+        line = line.strip()
+        for prefix in ("Saved ", "File was already downloaded "):
+            if line.startswith(prefix):
+                path = os.path.abspath(line[len(prefix):])
+                if path not in paths:
+                    paths.append(path)
+    return paths
 
 
 def is_package_installed(package_name):
@@ -89,7 +137,7 @@ def is_package_installed_on(node, package_name):
     if node.get_location().is_local():
         return is_package_installed(package_name)
 
-    result_code, _, = node.perform_command_on_host("pip show " + package_name)
+    result_code, _, = node.command("pip show " + package_name)
     if result_code == 0:
         return True
     return False
@@ -161,14 +209,14 @@ def install_package_on(node, package=None, wheel_file=None):
         print("Copying wheel to " + node.get_location().address)
         node.copy_file_to(wheel_file)
         print("pip installing")
-        result_code, result_string = node.perform_command_on_host("python -m pip install --no-index " +
-                                                                  os.path.basename(wheel_file))
+        result_code, result_string = node.command("python -m pip install --no-index " +
+                                                  os.path.basename(wheel_file))
         if result_code != 0:
             print("Failed")
             raise RuntimeError("Couldn't install " + package_arg + " on " + node.get_location().address + ": " +
                                result_string)
     else:
-        result_code, result_string = node.perform_command_on_host("python -m pip install --no-index " + package)
+        result_code, result_string = node.command("python -m pip install --no-index " + package)
         if result_code != 0:
             print("Failed")
             raise RuntimeError("Couldn't install " + package + " on " + node.get_location().address + ": " +
@@ -220,7 +268,7 @@ def uninstall_package_from(node, package_name):
         uninstall_package(package_name)
         return
 
-    result_code, result_string = node.perform_command_on_host("pip uninstall --yes " + package_name)
+    result_code, result_string = node.command("pip uninstall --yes " + package_name)
     if result_code != 0:
         raise RuntimeError("Couldn't uninstall " + package_name + " from " + node.get_location().address + ": " +
                            result_string)
@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import posixpath
+import concurrent.futures
+import urllib.parse
+
+from yu.network import connectivity
+from yu.network import httpclient
+from yu.packageManagement import pip
+
+
+DEFAULT_WHEELHOUSE_DIR = os.path.join(os.path.expanduser("~"), ".yu", "wheelhouse")
+DEFAULT_MAX_SIZE_BYTES = 5 * 1024 * 1024 * 1024
+DEFAULT_MAX_AGE_SECONDS = 90 * 24 * 60 * 60
+
+_INDEX_FILENAME = "index.json"
+_INDEX_LOCK_FILENAME = "index.lock"
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Wheelhouse(object):
+    """
+    A local, content-addressed cache of the distributions (wheels and sdists) pip installs, laid out so it can be
+    used directly as a pip --find-links directory.
+
+    Each distribution is stored once under objects/ by its sha256 and linked into the flat wheels/ directory by
+    filename. fetch resolves a whole requirement set with a single pip invocation and downloads what isn't already
+    cached in parallel; requirement sets that are fully cached are resolved against wheels/ with no network access.
+    Entries are evicted by age since last use and then least recently used first to keep the cache within its size.
+    The index is re-read and updated under a file lock, so several processes can share a wheelhouse.
+    """
+    def __init__(self, root=DEFAULT_WHEELHOUSE_DIR, max_size_bytes=DEFAULT_MAX_SIZE_BYTES,
+                 max_age_seconds=DEFAULT_MAX_AGE_SECONDS):
+        """
+        :param root: the directory to keep the wheelhouse in (optional) default = ~/.yu/wheelhouse
+        :param max_size_bytes: the size the wheelhouse is trimmed back to after each fetch (optional) default = 5GiB
+        :param max_age_seconds: entries not used for this long are evicted (optional) default = 90 days
+        """
+        self.root = os.path.abspath(root)
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.wheels_dir = os.path.join(self.root, "wheels")
+        self.objects_dir = os.path.join(self.root, "objects")
+
+        self.m_lock = threading.Lock()
+        for directory in (self.wheels_dir, self.objects_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.m_index = {}
+
+    def _lock_index(self):
+        """
+        Take the in-process lock and the wheelhouse's file lock, and bring m_index up to date with the index file.
+        Every change to the index is made while holding both, then saved with _save_index before _unlock_index
+
+        :return: the open lock file to pass to _unlock_index
+        """
+        self.m_lock.acquire()
+        lock_file = None
+        try:
+            lock_file = open(os.path.join(self.root, _INDEX_LOCK_FILENAME), 'a')
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self.m_index = self._load_index()
+            return lock_file
+        except BaseException:
+            if lock_file is not None:
+                lock_file.close()
+            self.m_lock.release()
+            raise
+
+    def _unlock_index(self, lock_file):
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+        finally:
+            self.m_lock.release()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.root, _INDEX_FILENAME), 'r') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        # Drop entries whose files have gone
+        return dict((filename, entry) for filename, entry in index.items()
+                    if os.path.isfile(os.path.join(self.wheels_dir, filename)))
+
+    def _save_index(self):
+        index_path = os.path.join(self.root, _INDEX_FILENAME)
+        temporary_path = index_path + ".tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(self.m_index, f, indent=1, sort_keys=True)
+        os.replace(temporary_path, index_path)
+
+    def _object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def get_entries(self):
+        """
+        :return: a dictionary of filename to a dictionary with sha256, size, name, version and last_used keys for
+                 each distribution in the wheelhouse
+        """
+        lock_file = self._lock_index()
+        try:
+            return dict((filename, dict(entry)) for filename, entry in self.m_index.items())
+        finally:
+            self._unlock_index(lock_file)
+
+    def resolve(self, requirements, offline=False):
+        """
+        Resolve the full set of distributions needed to install requirements with a single
+        `pip install --dry-run --report` (pip 22.2 or later), without downloading or installing anything
+
+        :param requirements: the requirement specifiers, e.g. ["requests>=2", "paramiko"]
+        :param offline: set to True to resolve only against the wheelhouse, with no network access
+                        (optional) default = False
+        :return: a list of dictionaries with name, version, url, filename and sha256 (None if the index didn't
+                 provide one) keys
+        :raises RuntimeError if the requirements couldn't be resolved
+        """
+        file_descriptor, report_path = tempfile.mkstemp(suffix=".json")
+        os.close(file_descriptor)
+        arguments = ['install', '--dry-run', '--ignore-installed', '--quiet', '--report', report_path]
+        if offline:
+            arguments += ['--no-index', '--find-links', self.wheels_dir]
+        try:
+            pip._run_local_pip_command(arguments + list(requirements))
+            with open(report_path, 'r') as f:
+                report = json.load(f)
+        except subprocess.CalledProcessError as e:
+            text = "Couldn't resolve " + " ".join(requirements) + ". Encountered an error: " + str(e)
+            if e.output is not None:
+                text += "\n" + str(e.output)
+            raise RuntimeError(text)
+        except ValueError as e:
+            raise RuntimeError("Couldn't read pip's installation report: " + str(e))
+        finally:
+            os.remove(report_path)
+
+        resolved = []
+        for item in report.get('install', []):
+            download_info = item.get('download_info', {})
+            archive_info = download_info.get('archive_info', {})
+            sha256 = archive_info.get('hashes', {}).get('sha256')
+            if sha256 is None and archive_info.get('hash', "").startswith("sha256="):
+                sha256 = archive_info['hash'][len("sha256="):]
+            url = download_info.get('url', "")
+            filename = urllib.parse.unquote(posixpath.basename(url.split("#", 1)[0]))
+            resolved.append({'name': item['metadata']['name'], 'version': item['metadata']['version'], 'url': url,
+                             'filename': filename, 'sha256': sha256})
+        return resolved
+
+    def _download(self, item, timeout):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".partial")
+        os.close(file_descriptor)
+        try:
+            if item['url'].startswith("file://"):
+                shutil.copyfile(urllib.parse.unquote(item['url'][len("file://"):]), temporary_path)
+            else:
+                httpclient.download(item['url'], temporary_path, proxy=connectivity.GLOBAL_WORKING_EXTERNAL_PROXY,
+                                    timeout=timeout)
+            sha256 = _file_sha256(temporary_path)
+            if item['sha256'] is not None and sha256 != item['sha256']:
+                raise RuntimeError("The download of " + item['url'] + " doesn't match its sha256 " + item['sha256'])
+            object_path = self._object_path(sha256)
+            if not os.path.isdir(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path))
+            os.replace(temporary_path, object_path)
+            return sha256
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _link(self, filename, sha256):
+        wheel_path = os.path.join(self.wheels_dir, filename)
+        if os.path.exists(wheel_path):
+            os.remove(wheel_path)
+        try:
+            os.link(self._object_path(sha256), wheel_path)
+        except OSError:
+            shutil.copyfile(self._object_path(sha256), wheel_path)
+        return wheel_path
+
+    def fetch(self, requirements, max_concurrent_downloads=8, timeout=httpclient.DEFAULT_TIMEOUT):
+        """
+        Make sure every distribution needed to install requirements is in the wheelhouse.
+        The wheelhouse is tried first with no network access; if it can't satisfy the requirements they are resolved
+        once against the package index and the distributions not already held (by sha256) are downloaded in
+        parallel through yu's pooled HTTP session.
+
+        :param requirements: the requirement specifiers, e.g. ["requests>=2", "paramiko"]
+        :param max_concurrent_downloads: the maximum number of downloads at once (optional) default = 8
+        :param timeout: the connect and read timeouts of each download (optional) default = httpclient's default
+        :return: the paths in wheels_dir of the distributions needed, in the order pip would install them
+        :raises RuntimeError if the requirements couldn't be resolved or a download failed
+        """
+        try:
+            resolved = self.resolve(requirements, offline=True)
+            offline = True
+        except RuntimeError:
+            resolved = self.resolve(requirements)
+            offline = False
+
+        to_download = []
+        lock_file = self._lock_index()
+        try:
+            for item in resolved:
+                entry = self.m_index.get(item['filename'])
+                if entry is not None and (item['sha256'] is None or offline):
+                    # Local files and some indexes don't come with a hash; trust the one recorded when it was stored
+                    item['sha256'] = entry['sha256']
+                if item['sha256'] is None or not os.path.isfile(self._object_path(item['sha256'])):
+                    to_download.append(item)
+        finally:
+            self._unlock_index(lock_file)
+
+        if to_download:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrent_downloads,
+                                                                             len(to_download)))
+            try:
+                futures = dict((executor.submit(self._download, item, timeout), item) for item in to_download)
+                for future in concurrent.futures.as_completed(futures):
+                    futures[future]['sha256'] = future.result()
+            finally:
+                executor.shutdown(wait=True)
+
+        now = time.time()
+        paths = []
+        lock_file = self._lock_index()
+        try:
+            for item in resolved:
+                wheel_path = os.path.join(self.wheels_dir, item['filename'])
+                entry = self.m_index.get(item['filename'])
+                if entry is None or entry['sha256'] != item['sha256'] or not os.path.isfile(wheel_path):
+                    wheel_path = self._link(item['filename'], item['sha256'])
+                    entry = {'sha256': item['sha256'], 'size': os.path.getsize(wheel_path), 'name': item['name'],
+                             'version': item['version']}
+                    self.m_index[item['filename']] = entry
+                entry['last_used'] = now
+                paths.append(wheel_path)
+            self._save_index()
+        finally:
+            self._unlock_index(lock_file)
+        # The distributions just fetched are kept even if they alone exceed the size limit, as the caller uses them
+        self.evict(keep=[item['filename'] for item in resolved])
+        return paths
+
+    def install(self, requirements, extra_arguments=None):
+        """
+        Install requirements on this node from the wheelhouse alone, with no network access.
+        Use fetch first to make sure the wheelhouse holds everything needed
+
+        :param requirements: the requirement specifiers
+        :param extra_arguments: further arguments for pip install, e.g. ["--user"] (optional)
+        :raises RuntimeError if the install failed
+        """
+        try:
+            pip._run_local_pip_command(['install', '--no-index', '--find-links', self.wheels_dir] +
+                                       list(extra_arguments or []) + list(requirements))
+        except subprocess.CalledProcessError as e:
+            text = "Couldn't install " + " ".join(requirements) + " from " + self.wheels_dir + \
+                   ". Encountered an error: " + str(e)
+            if e.output is not None:
+                text += "\n" + str(e.output)
+            raise RuntimeError(text)
+
+    def evict(self, max_size_bytes=None, max_age_seconds=None, keep=None):
+        """
+        Remove entries that haven't been used for max_age_seconds, then the least recently used entries until the
+        wheelhouse fits within max_size_bytes. Stored objects are removed once no entry links to them.
+
+        :param max_size_bytes: the size to trim to (optional) default = the wheelhouse's max_size_bytes
+        :param max_age_seconds: the age to evict from (optional) default = the wheelhouse's max_age_seconds
+        :param keep: filenames of entries that mustn't be removed; they still count towards the size (optional)
+        :return: the filenames of the entries removed
+        """
+        if max_size_bytes is None:
+            max_size_bytes = self.max_size_bytes
+        if max_age_seconds is None:
+            max_age_seconds = self.max_age_seconds
+
+        keep = set(keep or [])
+        oldest_allowed = time.time() - max_age_seconds
+        removed = []
+        lock_file = self._lock_index()
+        try:
+            # Entries to keep are counted first so the others are trimmed to fit around them
+            entries = sorted(self.m_index.items(),
+                             key=lambda item: (item[0] in keep, item[1].get('last_used', 0)), reverse=True)
+            kept_size = 0
+            kept_objects = set()
+            for filename, entry in entries:
+                # Entries sharing an object only count its size once
+                object_size = 0 if entry['sha256'] in kept_objects else entry['size']
+                if filename in keep or (entry.get('last_used', 0) >= oldest_allowed and
+                                        kept_size + object_size <= max_size_bytes):
+                    kept_size += object_size
+                    kept_objects.add(entry['sha256'])
+                    continue
+                removed.append(filename)
+
+            for filename in removed:
+                entry = self.m_index.pop(filename)
+                wheel_path = os.path.join(self.wheels_dir, filename)
+                if os.path.exists(wheel_path):
+                    os.remove(wheel_path)
+                if entry['sha256'] not in kept_objects and os.path.exists(self._object_path(entry['sha256'])):
+                    os.remove(self._object_path(entry['sha256']))
+            if removed:
+                self._save_index()
+        finally:
+            self._unlock_index(lock_file)
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry from the wheelhouse
+        """
+        self.evict(0, 0)
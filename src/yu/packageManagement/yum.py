@@ -1,13 +1,53 @@
 import os
+import re
+import json
+import time
+import tempfile
+import configparser
+import hashlib
+import threading
+import concurrent.futures
 import subprocess
 import fileinput
 
+from yu.network import connectivity
+
 
 YUM_CONFIG_FILE = '/etc/yum.conf'
 YUM_REPO_DIR = "/etc/yum.repos.d"
 
 PROXY_CONFIG_MARKER = '# Proxy settings added by yu.packageManagement.yum'
 
+# rpm expands the \t and \n escapes itself, so the format is passed through the remote shell unchanged
+_PACKAGE_INDEX_QUERY_FORMAT = r"%{NAME}\t%{EPOCH}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\n"
+# The installed packages of each node, keyed on address (None for the local node); see get_installed_package_index
+_package_indexes = {}
+_package_index_lock = threading.Lock()
+
+# The parsed .repo files of the local node keyed on filename, with the mtime and size they were parsed at
+_local_repo_files = {}
+# The repos configured on each remote node keyed on address; see get_repo_index
+_remote_repo_indexes = {}
+_repo_index_lock = threading.Lock()
+_REPO_FILE_MARKER = "==> yu repo file: "
+
+# Prints the time on the node followed by the modification time and directory of every cached repomd.xml, for
+# both yum (/var/cache/yum/<arch>/<release>/<repo>/repomd.xml) and dnf (/var/cache/dnf/<repo>-<hash>/repodata/)
+_CACHE_FRESHNESS_COMMAND = ("date +%s; find /var/cache/yum /var/cache/dnf -name repomd.xml -printf '%T@ %h\\n' "
+                            "2>/dev/null; true")
+
+# The file in a download directory recording the checksum and header of each package in it; see download_packages
+DOWNLOAD_INDEX_FILENAME = ".yu-download-index.json"
+
+# A package with a version constraint, e.g. "gcc >= 4.8.5" or "kernel<3.10.0-1160"
+_VERSION_CONSTRAINT_PATTERN = re.compile(r"^\s*([^\s<>=]+)\s*(<=|>=|==|=|<|>)\s*(\S+)\s*$")
+
+
+def _proxy_options():
+    if connectivity.GLOBAL_WORKING_EXTERNAL_PROXY is None:
+        return []
+    return ["--setopt=proxy=" + connectivity.GLOBAL_WORKING_EXTERNAL_PROXY]
+
 
 def _set_system_proxy_local(proxy):
     line_found = False
@@ -42,52 +82,393 @@ def set_system_proxy(proxy):
     return _set_system_proxy_local(proxy)
 
 
-def repo_is_configured(repo_name):
+def get_system_proxy():
+    """
+    Get the proxy yum is configured to use in the /etc/yum.conf file
+
+    :return: the proxy; None if no proxy is configured
+    :raises IOError if /etc/yum.conf can't be read
+    """
+    with open(YUM_CONFIG_FILE, 'r') as f:
+        for line in f:
+            if line.startswith("proxy="):
+                proxy = line[len("proxy="):].strip()
+                if proxy and proxy != "_none_":
+                    return proxy
+    return None
+
+
+def use_working_proxy(candidates=None, configure_system=False):
+    """
+    Find the fastest working proxy with yu.network.connectivity.discover_working_proxy so the yum helpers in this
+    module use it for the commands that need the network
+
+    :param candidates: additional proxies to consider (optional)
+    :param configure_system: set to True to also write the proxy to /etc/yum.conf (optional) default = False
+    :return: the proxy chosen; None if none of the candidates worked
+    """
+    proxy = connectivity.discover_working_proxy(candidates)
+    if proxy is not None and configure_system:
+        set_system_proxy(proxy)
+    return proxy
+
+
+class _RepoConfig(object):
+    def __init__(self, repo_id, repo_file, options):
+        self.repo_id = repo_id
+        self.repo_file = repo_file
+        self.options = options
+
+    def get_name(self):
+        return self.options.get('name', self.repo_id)
+
+    def get_baseurl(self):
+        return self.options.get('baseurl')
+
+    def is_enabled(self):
+        return self.options.get('enabled', "1").strip().lower() not in ("0", "no", "false", "off")
+
+    def __repr__(self):
+        return "<" + self.repo_id + (" enabled" if self.is_enabled() else " disabled") + ">"
+
+
+def _parse_repo_file(repo_file, repo_data):
+    """
+    :return: a list of _RepoConfig for each section of the file
+    :raises configparser.Error if the file isn't well formed
+    """
+    parser = configparser.RawConfigParser(strict=False)
+    parser.read_string(repo_data, source=repo_file)
+    return [_RepoConfig(section, repo_file, dict(parser.items(section))) for section in parser.sections()]
+
+
+def _read_local_repo_index():
     try:
-        repo_list = subprocess.check_output(['yum', '-q', "repolist"]).strip().split("\n")[1:]
-        for repo_line in repo_list:
-            repo_line = repo_line[:repo_line.find(" ")]
-            if repo_line.find(repo_name) != -1:
-                return True
-        return False
-    except subprocess.CalledProcessError as e:
-        text = "Couldn't get yum repolist. Encountered an error: " + str(e)
-        if e.output is not None:
-            text += "\n" + str(e.output)
-        raise RuntimeError(text)
+        filenames = [filename for filename in os.listdir(YUM_REPO_DIR) if filename.endswith(".repo")]
+    except OSError:
+        filenames = []
+
+    repos = {}
+    with _repo_index_lock:
+        for filename in list(_local_repo_files):
+            if filename not in filenames:
+                del _local_repo_files[filename]
+        for filename in sorted(filenames):
+            repo_file = os.path.join(YUM_REPO_DIR, filename)
+            try:
+                file_stat = os.stat(repo_file)
+            except OSError:
+                continue
+            cached = _local_repo_files.get(filename)
+            if cached is None or cached[0] != (file_stat.st_mtime, file_stat.st_size):
+                try:
+                    with open(repo_file, 'r') as f:
+                        file_repos = _parse_repo_file(repo_file, f.read())
+                except (IOError, configparser.Error):
+                    # yum skips files it can't parse too
+                    file_repos = []
+                cached = ((file_stat.st_mtime, file_stat.st_size), file_repos)
+                _local_repo_files[filename] = cached
+            for repo in cached[1]:
+                repos.setdefault(repo.repo_id, repo)
+    return repos
+
+
+def _read_remote_repo_index(node):
+    # Every repo file is read in a single command, each prefixed by a marker line with its name
+    read_command = "for f in " + YUM_REPO_DIR + "/*.repo; do [ -f \"$f\" ] && echo \"" + _REPO_FILE_MARKER + \
+                   "$f\" && cat \"$f\" && echo; done; true"
+    result_code, result_string = node.command(read_command)
+    if result_code != 0:
+        raise RuntimeError("Couldn't read the repo files on " + node.get_location().address + ": " + result_string)
+
+    repos = {}
+    files = []
+    for line in result_string.splitlines():
+        if line.startswith(_REPO_FILE_MARKER):
+            files.append((line[len(_REPO_FILE_MARKER):].strip(), []))
+        elif files:
+            files[-1][1].append(line)
+    for repo_file, lines in files:
+        try:
+            file_repos = _parse_repo_file(repo_file, "\n".join(lines))
+        except configparser.Error:
+            continue
+        for repo in file_repos:
+            repos.setdefault(repo.repo_id, repo)
+    return repos
+
+
+def get_repo_index(node=None, refresh=False):
+    """
+    Get the yum repos configured in the .repo files of /etc/yum.repos.d, without running yum.
+    On the local node the files are re-read only when their modification time or size changes. The files on a
+    remote node are all read in one command and kept in memory until add_repo, add_repo_with_raw_data or
+    remove_repo change them or refresh is set.
+
+    :param node: the yu.network.RemoteNode to read the repos of (optional) default = the local node
+    :param refresh: set to True to re-read a remote node's repo files (optional) default = False
+    :return: a dictionary of repo id to a repo object with repo_id, repo_file and options (a dictionary of the
+             repo's settings) attributes and get_name, get_baseurl and is_enabled methods
+    :raises RuntimeError if the repo files on a remote node couldn't be read
+    """
+    key = _index_key(node)
+    if key is None:
+        return _read_local_repo_index()
+
+    with _repo_index_lock:
+        if not refresh and key in _remote_repo_indexes:
+            return _remote_repo_indexes[key]
+    repos = _read_remote_repo_index(node)
+    with _repo_index_lock:
+        _remote_repo_indexes[key] = repos
+    return repos
+
+
+def invalidate_repo_index(node=None):
+    """
+    Forget the repos read from a node so the next query reads its repo files again
+
+    :param node: the yu.network.RemoteNode whose repos to forget (optional) default = the local node
+    """
+    key = _index_key(node)
+    with _repo_index_lock:
+        if key is None:
+            _local_repo_files.clear()
+        else:
+            _remote_repo_indexes.pop(key, None)
+
+
+def get_configured_repos(node=None, enabled_only=True):
+    """
+    :param node: the yu.network.RemoteNode to get the repos of (optional) default = the local node
+    :param enabled_only: set to False to include disabled repos (optional) default = True
+    :return: the sorted ids of the repos configured on the node
+    """
+    return sorted(repo_id for repo_id, repo in get_repo_index(node).items() if repo.is_enabled() or not enabled_only)
+
+
+def repo_is_configured(repo_name, node=None, enabled_only=True):
+    """
+    Check whether a repo is configured, from the repo files rather than `yum repolist`
+
+    :param repo_name: the id of the repo; it has to match exactly
+    :param node: the yu.network.RemoteNode to check (optional) default = the local node
+    :param enabled_only: set to False to also count disabled repos (optional) default = True
+    :return: True if the repo is configured; False otherwise
+    :raises RuntimeError if the repo files on a remote node couldn't be read
+    """
+    repo = get_repo_index(node).get(repo_name)
+    return repo is not None and (repo.is_enabled() or not enabled_only)
+
+
+def _repo_file_path(repo_id):
+    return os.path.join(YUM_REPO_DIR, repo_id + ".repo")
+
+
+def add_repo(repo_id, repo_name, repo_baseurl, gpgcheck="0", node=None, options=None):
+    """
+    Add a yum repo by writing /etc/yum.repos.d/<repo_id>.repo
+
+    :param repo_id: the id of the repo, used for its section and filename
+    :param repo_name: the human readable name of the repo
+    :param repo_baseurl: the url of the repo
+    :param gpgcheck: whether to check the packages' gpg signatures; "0" or "1" (optional) default = "0"
+    :param node: the yu.network.RemoteNode to add the repo on (optional) default = the local node
+    :param options: a dictionary of additional options for the repo, e.g. {'metadata_expire': "0"} (optional)
+    :raises RuntimeError if the repo file couldn't be written on the node
+    """
+    repo_data = "[" + repo_id + "]\n"
+    repo_data += "name=" + repo_name + "\n"
+    repo_data += "baseurl=" + repo_baseurl + "\n"
+    repo_data += "enabled=1\n"
+    repo_data += "gpgcheck=" + str(gpgcheck) + "\n"
+    for option in sorted(options or {}):
+        repo_data += option + "=" + str(options[option]) + "\n"
+    add_repo_with_raw_data(repo_id, repo_data, node)
+
+
+def add_repo_with_raw_data(repo_id, repo_data, node=None):
+    """
+    Add a yum repo by writing repo_data to /etc/yum.repos.d/<repo_id>.repo.
+    The file is replaced atomically so yum never sees it partly written.
+
+    :param repo_id: the id of the repo, used for the filename
+    :param repo_data: the contents of the repo file
+    :param node: the yu.network.RemoteNode to add the repo on (optional) default = the local node
+    :raises RuntimeError if repo_data isn't a well formed repo file or it couldn't be written on the node
+    """
+    repo_file = _repo_file_path(repo_id)
+    try:
+        if not _parse_repo_file(repo_file, repo_data):
+            raise RuntimeError("The repo data for " + repo_id + " has no repo sections")
+    except configparser.Error as e:
+        raise RuntimeError("The repo data for " + repo_id + " isn't a well formed repo file: " + str(e))
+
+    if node is None or node.get_location().is_local():
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=YUM_REPO_DIR, prefix="." + repo_id, suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                f.write(repo_data)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, repo_file)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return
+
+    try:
+        result_code, result_string = node.command_with_input("cat > " + repo_file + ".tmp && mv -f " + repo_file +
+                                                             ".tmp " + repo_file, repo_data.encode("utf-8"))
+    finally:
+        invalidate_repo_index(node)
+    if result_code != 0:
+        raise RuntimeError("Couldn't add the " + repo_id + " repo on " + node.get_location().address + ": " +
+                           result_string)
+
+
+def remove_repo(repo_id, node=None):
+    """
+    Remove a repo added with add_repo. Nothing happens if the repo file doesn't exist
+
+    :param repo_id: the id of the repo
+    :param node: the yu.network.RemoteNode to remove the repo from (optional) default = the local node
+    :raises RuntimeError if the repo file couldn't be removed from the node
+    """
+    repo_file = _repo_file_path(repo_id)
+    if node is None or node.get_location().is_local():
+        if os.path.exists(repo_file):
+            os.remove(repo_file)
+        return
+
+    result_code, result_string = node.command("rm -f " + repo_file)
+    invalidate_repo_index(node)
+    if result_code != 0:
+        raise RuntimeError("Couldn't remove the " + repo_id + " repo from " + node.get_location().address + ": " +
+                           result_string)
 
 
-def add_repo(repo_id, repo_name, repo_baseurl, gpgcheck="0"):
-    with open(os.path.join(YUM_REPO_DIR, repo_id + ".repo"), "w+") as f:
-        f.write("name=" + repo_name)
-        f.write("baseurl=" + repo_baseurl)
-        f.write("enabled=1")
-        f.write("gpgcheck=" + gpgcheck)
+class _RpmPackage(object):
+    def __init__(self, name, epoch, version, release, arch):
+        self.name = name
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+        self.arch = arch
 
+    def get_nevra(self):
+        epoch = "" if self.epoch is None else self.epoch + ":"
+        return self.name + "-" + epoch + self.version + "-" + self.release + "." + self.arch
 
-def add_repo_with_raw_data(repo_id, repo_data):
-    with open(os.path.join(YUM_REPO_DIR, repo_id + ".repo"), "w+") as f:
-        f.write(repo_data)
+    def __repr__(self):
+        return "<" + self.get_nevra() + ">"
+
+
+def _index_key(node):
+    if node is None or node.get_location().is_local():
+        return None
+    return node.get_location().address
+
+
+def _package_keys(package):
+    # Every form of name yum accepts, so lookups are a single dictionary access
+    name_version = package.name + "-" + package.version
+    return set([package.name, package.name + "." + package.arch, name_version, name_version + "-" + package.release,
+                name_version + "-" + package.release + "." + package.arch, package.get_nevra()])
+
+
+def _parse_package_index(rpm_output):
+    index = {}
+    for line in rpm_output.splitlines():
+        fields = line.split("\t")
+        if len(fields) != 5:
+            continue
+        name, epoch, version, release, arch = fields
+        package = _RpmPackage(name, None if epoch == "(none)" else epoch, version, release, arch)
+        for key in _package_keys(package):
+            index.setdefault(key, []).append(package)
+    return index
+
+
+def get_installed_package_index(node=None, refresh=False):
+    """
+    Get the index of the packages installed on a node. The index is built from a single `rpm -qa` query and kept
+    in memory until the install and remove functions in this module change the node's packages, or refresh is set.
+
+    :param node: the yu.network.RemoteNode to get the index of (optional) default = the local node
+    :param refresh: set to True to rebuild the index from rpm (optional) default = False
+    :return: a dictionary of package name (or name.arch, name-version, name-version-release,
+             name-version-release.arch or name-epoch:version-release.arch) to the list of matching installed
+             packages, each with name, epoch, version, release and arch attributes
+    :raises RuntimeError if the installed packages couldn't be queried
+    """
+    key = _index_key(node)
+    with _package_index_lock:
+        if not refresh and key in _package_indexes:
+            return _package_indexes[key]
+
+    if key is None:
+        try:
+            rpm_output = subprocess.check_output(['rpm', '-qa', '--queryformat', _PACKAGE_INDEX_QUERY_FORMAT],
+                                                 stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+        except (OSError, subprocess.CalledProcessError) as e:
+            text = "Couldn't query the installed packages. Encountered an error: " + str(e)
+            if getattr(e, 'output', None) is not None:
+                text += "\n" + str(e.output)
+            raise RuntimeError(text)
+    else:
+        result_code, rpm_output = node.command("rpm -qa --queryformat '" + _PACKAGE_INDEX_QUERY_FORMAT + "'")
+        if result_code != 0:
+            raise RuntimeError("Couldn't query the installed packages on " + key + ": " + rpm_output)
+
+    index = _parse_package_index(rpm_output)
+    with _package_index_lock:
+        _package_indexes[key] = index
+    return index
+
+
+def invalidate_package_index(node=None):
+    """
+    Forget the installed package index of a node so the next lookup queries rpm again.
+    Call this after changing the node's packages other than through this module.
+
+    :param node: the yu.network.RemoteNode whose index to drop (optional) default = the local node
+    """
+    with _package_index_lock:
+        _package_indexes.pop(_index_key(node), None)
+
+
+def are_installed(package_names, node=None):
+    """
+    Look up which of the packages are installed on a node, using the installed package index
+
+    :param package_names: the packages to look up; each can be a name or any of the forms yum accepts, such as
+                          name.arch or name-version-release
+    :param node: the yu.network.RemoteNode to check (optional) default = the local node
+    :return: a dictionary of each package name to the list of installed packages that match it, with name, epoch,
+             version, release and arch attributes; the list is empty if the package isn't installed
+    :raises RuntimeError if the installed packages couldn't be queried
+    """
+    index = get_installed_package_index(node)
+    return dict((package_name, list(index.get(package_name, []))) for package_name in package_names)
 
 
 def is_package_installed(package_name):
     """
-    Equivalent of `yum list installed <package>`
+    Equivalent of `yum list installed <package>`, answered from the installed package index
 
     :param package_name: Package to install
     :return: True if package is installed; otherwise False
     """
     try:
-        _ = subprocess.check_output(['yum', '-q', "list", 'installed', package_name],
-                                    stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError as e:
+        return package_name in get_installed_package_index()
+    except RuntimeError:
         return False
 
 
 def is_package_installed_on(node, package_name):
     """
-    Check whether package name is installed on the node provided
+    Check whether package name is installed on the node provided, using the node's installed package index
 
     :param node: A yu.network.RemoteNode object to check
     :param package_name: Package to check
@@ -96,10 +477,10 @@ def is_package_installed_on(node, package_name):
     if node.get_location().is_local():
         return is_package_installed(package_name)
 
-    result_code, _, = node.perform_command_on_host("yum -q --disablerepo=* list installed " + package_name)
-    if result_code == 0:
-        return True
-    return False
+    try:
+        return package_name in get_installed_package_index(node)
+    except RuntimeError:
+        return False
 
 
 def install_local_package(package_location):
@@ -112,6 +493,7 @@ def install_local_package(package_location):
     try:
         _ = subprocess.check_output(['yum', "localinstall", '-y', '-q', "--disablerepo=*", package_location],
                                     stderr=subprocess.STDOUT)
+        invalidate_package_index()
     except subprocess.CalledProcessError as e:
         text = "Couldn't install " + package_location + " package. Encountered an error: " + str(e)
         if e.output is not None:
@@ -119,6 +501,25 @@ def install_local_package(package_location):
         raise RuntimeError(text)
 
 
+def install_local_packages(package_locations):
+    """
+    Equivalent of `yum localinstall <package_1> <package_2> ... <package_N>`, installing all the packages in a single
+    transaction
+
+    :param package_locations: the paths to the packages to install
+    :raises RuntimeError if the install failed
+    """
+    try:
+        _ = subprocess.check_output(['yum', "localinstall", '-y', '-q', "--disablerepo=*"] + list(package_locations),
+                                    stderr=subprocess.STDOUT)
+        invalidate_package_index()
+    except subprocess.CalledProcessError as e:
+        text = "Couldn't install the packages " + " ".join(package_locations) + ". Encountered an error: " + str(e)
+        if e.output is not None:
+            text += "\n" + str(e.output)
+        raise RuntimeError(text)
+
+
 def install_package(package_name):
     """
     Equivalent of `yum install <package_name>`
@@ -127,8 +528,9 @@ def install_package(package_name):
     :raises Runtime error if the install failed
     """
     try:
-        _ = subprocess.check_output(['yum', '-y', '-q', "install", package_name],
+        _ = subprocess.check_output(['yum', '-y', '-q'] + _proxy_options() + ["install", package_name],
                                     stderr=subprocess.STDOUT)
+        invalidate_package_index()
     except subprocess.CalledProcessError as e:
         text = "Couldn't install " + package_name + " package. Encountered an error: " + str(e)
         if e.output is not None:
@@ -143,10 +545,11 @@ def install_packages(package_list):
     :raises: RuntimeError if the install fails
     """
     try:
-        command_list = ['yum', '-y', '-q', "install"]
+        command_list = ['yum', '-y', '-q'] + _proxy_options() + ["install"]
         command_list.extend(package_list)
 
         _ = subprocess.check_output(command_list, stderr=subprocess.STDOUT)
+        invalidate_package_index()
     except subprocess.CalledProcessError as e:
         text = "Couldn't install " + " ".join(package_list) + " packages. Encountered an error: " + str(e)
         if e.output is not None:
@@ -154,7 +557,7 @@ def install_packages(package_list):
         raise RuntimeError(text)
 
 
-def install_package_on(node, package_name=None, package_location=None):
+def install_package_on(node, package_name=None, package_location=None, repo_id=None):
     """
     Install the provided package on the provided node. One of package_name or package_location must be
     provided.
@@ -166,6 +569,8 @@ def install_package_on(node, package_name=None, package_location=None):
     :param node: the node to install on
     :param package_name: the name of the package to install (optional)
     :param package_location: the location to an already downloaded package to install
+    :param repo_id: only look the package up in this repo when installing by name on a remote node, e.g. the repo
+                    of a yu.packageManagement.mirror.YumMirror (optional) default = all the node's enabled repos
     :return:
     """
     package_arg = None
@@ -182,31 +587,304 @@ def install_package_on(node, package_name=None, package_location=None):
         return
 
     if package_location is not None:
-        print("Copying package to " + node.get_location().address)
-        node.copy_file_to(package_location)
-
-        print("yum installing")
-        result_code, result_string = node.perform_command_on_host("yum localinstall -y --disablerepo=* " +
-                                                                  os.path.basename(package_location))
+        print("Copying package to " + node.get_location().address + " and yum installing")
+        try:
+            install_packages_on(node, [package_location])
+        except RuntimeError:
+            print("Failed")
+            raise
+    else:
+        # The node resolves the package and its dependencies from its own repos, such as an attached mirror
+        print("yum installing " + package_name + " on " + node.get_location().address)
+        repo_options = ""
+        if repo_id is not None:
+            repo_options = "--disablerepo=* --enablerepo=" + repo_id + " "
+        result_code, result_string = node.command("yum -y -q " + repo_options + "install " + package_name)
+        invalidate_package_index(node)
         if result_code != 0:
             print("Failed")
-            raise RuntimeError("Couldn't install " + package_location + " on " + node.get_location().address + ": " +
+            raise RuntimeError("Couldn't install " + package_name + " on " + node.get_location().address + ": " +
                                result_string)
-
-        print("Tidying up copied package")
-        node.delete_file(package_location)
-    else:
-        # TODO Check if the internet is accessible and have a go
-        print("Failed")
-        raise RuntimeError("Couldn't install " + package_name + " on " + node.get_location().address + ": " +
-                           "Attempting to install remotely without a package")
     print("Success")
 
 
+def install_packages_on(node, package_locations, timeout=None):
+    """
+    Install a set of already downloaded packages on the node provided in a single yum transaction.
+    The packages are copied into a temporary directory on the node, installed together with `yum localinstall` and
+    the directory is removed afterwards whether or not the install succeeded.
+    If the node has an artifact cache enabled the packages are staged through it, so only those the node doesn't
+    already hold are transferred; otherwise they are streamed to the node in one transfer.
+
+    :param node: the yu.network.RemoteNode to install on
+    :param package_locations: the local paths of the .rpm files to install
+    :param timeout: the maximum amount of time to wait on any one channel operation of the streamed transfer
+                    (optional)
+    :raises RuntimeError if the transfer or the install failed
+    :raises IOError if a package doesn't exist
+    """
+    package_locations = list(package_locations)
+    if not package_locations:
+        return
+    for package_location in package_locations:
+        if not package_location.endswith(".rpm"):
+            raise RuntimeError("Not an rpm package: " + package_location)
+
+    if node.get_location().is_local():
+        install_local_packages(package_locations)
+        return
+
+    result_code, staging_dir = node.command("mktemp -d /tmp/yu-packages.XXXXXX")
+    staging_dir = staging_dir.strip()
+    if result_code != 0 or not staging_dir:
+        raise RuntimeError("Couldn't create a directory for the packages on " + node.get_location().address + ": " +
+                           staging_dir)
+
+    try:
+        if node.artifact_cache is not None:
+            node.copy_files_to(package_locations, staging_dir)
+        else:
+            node.push_and_extract(package_locations, staging_dir, timeout=timeout)
+        result_code, result_string = node.command("yum localinstall -y -q --disablerepo=* " + staging_dir + "/*.rpm")
+    finally:
+        node.command("rm -rf " + staging_dir)
+    invalidate_package_index(node)
+    if result_code != 0:
+        raise RuntimeError("Couldn't install " + ", ".join(os.path.basename(package_location)
+                                                           for package_location in package_locations) +
+                           " on " + node.get_location().address + ": " + result_string)
+
+
+def install_packages_on_nodes(node_list, package_locations, max_concurrent_nodes=8, timeout=None):
+    """
+    Run install_packages_on for many nodes concurrently
+
+    :param node_list: the yu.network.RemoteNode objects to install on
+    :param package_locations: the local paths of the .rpm files to install
+    :param max_concurrent_nodes: the maximum number of nodes installed on at once (optional) default = 8
+    :param timeout: see install_packages_on (optional)
+    :return: a dictionary keyed on the host of each node whose values are None if the install succeeded or the
+             exception raised if it failed
+    """
+    results = {}
+    if not node_list:
+        return results
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrent_nodes, len(node_list)))
+    try:
+        futures = dict((executor.submit(install_packages_on, node, package_locations, timeout), node)
+                       for node in node_list)
+        for future in concurrent.futures.as_completed(futures):
+            host = futures[future].get_host_to_connect_to()
+            try:
+                results[host] = future.result()
+            except Exception as e:
+                results[host] = e
+    finally:
+        executor.shutdown(wait=True)
+    return results
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_package_headers(package_paths):
+    """
+    Read the name, epoch, version, release and arch from the headers of rpm files with as few rpm processes as
+    possible; every file is queried in one process unless some of them can't be read
+
+    :return: a dictionary of path to _RpmPackage for the files that could be read
+    """
+    def query(paths):
+        process = subprocess.Popen(['rpm', '-qp', '--nosignature', '--queryformat', _PACKAGE_INDEX_QUERY_FORMAT] +
+                                   list(paths), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, _ = process.communicate()
+        return [line.split("\t") for line in output.decode('utf-8', 'replace').splitlines()]
+
+    headers = {}
+    if not package_paths:
+        return headers
+    try:
+        rows = query(package_paths)
+        if len(rows) != len(package_paths):
+            # rpm skips the files it can't read, so the output can only be matched up file by file
+            rows = [(query([path]) or [None])[0] for path in package_paths]
+    except OSError as e:
+        raise RuntimeError("Couldn't run rpm to read the package headers: " + str(e))
+
+    for path, row in zip(package_paths, rows):
+        if row is not None and len(row) == 5:
+            name, epoch, version, release, arch = row
+            headers[path] = _RpmPackage(name, None if epoch == "(none)" else epoch, version, release, arch)
+    return headers
+
+
+def _check_package_digests(package_paths):
+    """
+    Check the header and payload digests of rpm files with a single `rpm -K`, so truncated or corrupt downloads
+    aren't mistaken for good ones. Signatures aren't checked
+
+    :return: the set of paths whose digests are OK
+    """
+    if not package_paths:
+        return set()
+    try:
+        process = subprocess.Popen(['rpm', '-K', '--nosignature'] + list(package_paths), stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+    except OSError as e:
+        raise RuntimeError("Couldn't run rpm to check the package digests: " + str(e))
+
+    # Each file gets a line such as "<path>: digests OK" or "<path>: DIGESTS NOT OK" ("sha1 md5 OK" on older rpm)
+    checked = set()
+    for line in output.decode('utf-8', 'replace').splitlines():
+        path, _, result = line.rpartition(": ")
+        if result.strip().endswith("OK") and "NOT OK" not in result.upper():
+            checked.add(path)
+    return set(path for path in package_paths if path in checked)
+
+
+def _compare_version_strings(first, second):
+    # rpm's rpmvercmp: alternating runs of digits and letters are compared, digits numerically, and a "~" sorts
+    # before anything, including the end of the string
+    first_segments = re.findall(r"~|\d+|[a-zA-Z]+", first)
+    second_segments = re.findall(r"~|\d+|[a-zA-Z]+", second)
+    for first_segment, second_segment in zip(first_segments, second_segments):
+        if first_segment == second_segment:
+            continue
+        if first_segment == "~" or second_segment == "~":
+            return -1 if first_segment == "~" else 1
+        if first_segment.isdigit() != second_segment.isdigit():
+            # A numeric segment is newer than an alphabetic one
+            return 1 if first_segment.isdigit() else -1
+        if first_segment.isdigit():
+            first_number, second_number = int(first_segment), int(second_segment)
+            return (first_number > second_number) - (first_number < second_number)
+        return (first_segment > second_segment) - (first_segment < second_segment)
+
+    first_rest = first_segments[len(second_segments):]
+    second_rest = second_segments[len(first_segments):]
+    if first_rest:
+        return -1 if first_rest[0] == "~" else 1
+    if second_rest:
+        return 1 if second_rest[0] == "~" else -1
+    return 0
+
+
+def _satisfies_constraint(package, operator, constraint):
+    epoch = "0"
+    if ":" in constraint:
+        epoch, constraint = constraint.split(":", 1)
+    version, _, release = constraint.partition("-")
+
+    result = _compare_version_strings(package.epoch or "0", epoch)
+    if result == 0:
+        result = _compare_version_strings(package.version, version)
+    if result == 0 and release:
+        # A constraint without a release matches every release of the version
+        result = _compare_version_strings(package.release, release)
+    return {'<': result < 0, '<=': result <= 0, '=': result == 0, '==': result == 0, '>=': result >= 0,
+            '>': result > 0}[operator]
+
+
+def get_download_index(download_dir):
+    """
+    Get the checksum index of the rpm files in a download directory, updating it first.
+    Files are only hashed, digest checked with `rpm -K` and have their headers read when they are new or their size
+    or modification time has changed since the index was last updated.
+
+    :param download_dir: the directory holding the rpm files
+    :return: a dictionary of filename to a dictionary with sha256, size, mtime, verified (whether the file passed
+             its digest check), name, epoch, version, release and arch keys
+    :raises RuntimeError if rpm couldn't be run to read new packages
+    """
+    index_path = os.path.join(download_dir, DOWNLOAD_INDEX_FILENAME)
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        index = {}
+
+    updated = {}
+    changed_paths = []
+    for filename in os.listdir(download_dir):
+        if not filename.endswith(".rpm"):
+            continue
+        file_stat = os.stat(os.path.join(download_dir, filename))
+        entry = index.get(filename)
+        if entry is not None and entry['size'] == file_stat.st_size and entry['mtime'] == file_stat.st_mtime and \
+                'verified' in entry:
+            updated[filename] = entry
+        else:
+            changed_paths.append(os.path.join(download_dir, filename))
+
+    headers = _read_package_headers(changed_paths)
+    verified_paths = _check_package_digests(list(headers))
+    for path, package in headers.items():
+        file_stat = os.stat(path)
+        updated[os.path.basename(path)] = {'sha256': _file_sha256(path), 'size': file_stat.st_size,
+                                           'mtime': file_stat.st_mtime, 'verified': path in verified_paths,
+                                           'name': package.name, 'epoch': package.epoch, 'version': package.version,
+                                           'release': package.release, 'arch': package.arch}
+
+    if updated != index:
+        temporary_path = index_path + ".tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(updated, f, indent=1, sort_keys=True)
+        os.replace(temporary_path, index_path)
+    return updated
+
+
+def _find_downloaded(download_index, download_dir, package_names):
+    """
+    Match the requested packages to files in the download directory. Only files that passed their digest check and
+    still have the checksum they were indexed with are used, and a file must meet any version constraint of the
+    request, e.g. "gcc >= 4.8.5"
+
+    :return: a tuple of a dictionary of package name to the path of its file (None if there isn't a usable one) and
+             the list of paths of files that failed their digest check or no longer match their checksum
+    """
+    unusable = []
+    by_key = {}
+    # The most recently downloaded file is tried first when several versions of a package are present
+    for filename in sorted(download_index, key=lambda filename: download_index[filename]['mtime'], reverse=True):
+        entry = download_index[filename]
+        if not entry.get('verified'):
+            unusable.append(os.path.join(download_dir, filename))
+            continue
+        package = _RpmPackage(entry['name'], entry['epoch'], entry['version'], entry['release'], entry['arch'])
+        for key in _package_keys(package):
+            by_key.setdefault(key, []).append((filename, package))
+
+    found = {}
+    checked = {}
+    for package_name in package_names:
+        found[package_name] = None
+        match = _VERSION_CONSTRAINT_PATTERN.match(package_name)
+        for filename, package in by_key.get(match.group(1) if match else package_name, []):
+            if match and not _satisfies_constraint(package, match.group(2), match.group(3)):
+                continue
+            entry = download_index[filename]
+            if filename not in checked:
+                # The index is only refreshed when a file's size or modification time changes, so the content is
+                # checked again before the file is used in place of a download
+                path = os.path.join(download_dir, filename)
+                checked[filename] = os.path.isfile(path) and _file_sha256(path) == entry['sha256']
+            if checked[filename]:
+                found[package_name] = os.path.join(download_dir, filename)
+                break
+    return found, unusable + [os.path.join(download_dir, filename) for filename in checked if not checked[filename]]
+
+
 def download_package(package_name, download_directory=None):
     """
     Python api equivalent of yum install --downloadonly --downloaddir=<download_directory> <package_name>
-    Will return the path of the downloaded file.
+    Will return the path of the downloaded file. See download_packages
 
     :param package_name:  The package to download
     :param download_directory: The directory to download the package to
@@ -214,37 +892,97 @@ def download_package(package_name, download_directory=None):
     """
     if download_directory is None:
         download_directory = os.getcwd()
-    try:
-        _ = subprocess.check_output(['yum', '-q', '--downloadonly', '--downloaddir=' + download_directory,
-                                     "reinstall", package_name], stderr=subprocess.STDOUT)
-        potential_downloaded_files = []
-        for f in os.listdir(download_directory):
-            if f.startswith(package_name):
-                potential_downloaded_files.append(os.path.join(download_directory, f))
-        if len(potential_downloaded_files) < 1:
-            raise RuntimeError("Couldn't find the downloaded package for " + package_name)
-        # TODO not fool-proof but much quicker to implement than parsing the yum command output and probably
-        # TODO good enough
-        return max(potential_downloaded_files, key=os.path.getctime)
-    except subprocess.CalledProcessError as e:
-        text = "Couldn't download " + package_name + " package. Encountered an error: " + str(e)
-        if e.output is not None:
-            text += "\n" + str(e.output)
-        raise RuntimeError(text)
+    return download_packages([package_name], download_directory)[0]
+
 
+def _download_dependency_closure(package_list, download_dir):
+    # yum --downloadonly leaves out whatever is already installed here, so the closure is resolved as if nothing were
+    # installed. dnf download and the yumdownloader that wraps it on newer systems do this with --alldeps;
+    # repotrack does it on older yum-utils
+    proxy_options = _proxy_options()
+    error = None
+    for command in (['dnf', '-q', 'download', '--resolve', '--alldeps', '--destdir=' + download_dir] +
+                    proxy_options + package_list,
+                    ['repotrack', '-p', download_dir] + package_list,
+                    ['yumdownloader', '-q', '--resolve', '--alldeps', '--destdir=' + download_dir] +
+                    proxy_options + package_list):
+        try:
+            _ = subprocess.check_output(command, stderr=subprocess.STDOUT)
+            return
+        except OSError as e:
+            error = e
+        except subprocess.CalledProcessError as e:
+            text = "Couldn't download the packages " + " ".join(package_list) + " and all their dependencies. " + \
+                   "Encountered an error: " + str(e)
+            if e.output is not None:
+                text += "\n" + str(e.output)
+            raise RuntimeError(text)
+    raise RuntimeError("Couldn't run dnf, repotrack or yumdownloader: " + str(error))
 
-def download_packages(package_list, download_dir):
+
+def download_packages(package_list, download_dir, all_dependencies=False):
     """
-    Download multiple packages through yum
+    Download multiple packages, and the dependencies this node doesn't have, through a single yum invocation
+    (two if some of the packages are already installed, as those have to be downloaded with `yum reinstall`).
+    With all_dependencies set the whole dependency closure is downloaded, including what this node already has
+    installed, so the directory can serve installs on nodes that have nothing installed.
+
+    The downloaded files are matched to the requested packages by reading their rpm headers, and the download
+    directory keeps a checksum index of its packages (see get_download_index) so packages already in the directory
+    aren't downloaded again. A file is only reused if it passed its digest check, still matches its indexed
+    checksum and meets any version constraint of the request; files that fail either check are removed so they are
+    downloaded again.
 
-    :param package_list: The packages to install
+    :param package_list: The packages to download; each can be a name or any of the forms yum accepts, such as
+                         name.arch, name-version-release or "name >= version"
     :param download_dir: The directory to download the packages to
+    :param all_dependencies: set to True to download every dependency, not only those missing on this node; this
+                             needs dnf, repotrack or a yumdownloader that supports --alldeps (optional)
+                             default = False
+    :return: the paths of the downloaded files, in the order of package_list
     :raises RuntimeError if any downloads fail
     """
-    downloaded_packages = []
-    for package in package_list:
-        downloaded_packages.append(download_package(package, download_dir))
-    return downloaded_packages
+    if not os.path.isdir(download_dir):
+        os.makedirs(download_dir)
+
+    downloaded, unusable_paths = _find_downloaded(get_download_index(download_dir), download_dir, package_list)
+    for path in unusable_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    missing = [package for package in package_list if downloaded[package] is None]
+    if all_dependencies:
+        # The dependencies of packages already in the directory may not be, so the closure is always resolved;
+        # files already present aren't downloaded again
+        _download_dependency_closure(list(package_list), download_dir)
+        downloaded, _ = _find_downloaded(get_download_index(download_dir), download_dir, package_list)
+    elif missing:
+        installed_index = get_installed_package_index()
+        installed = {}
+        for package in missing:
+            match = _VERSION_CONSTRAINT_PATTERN.match(package)
+            if match is None:
+                installed[package] = bool(installed_index.get(package))
+            else:
+                installed[package] = any(_satisfies_constraint(installed_package, match.group(2), match.group(3))
+                                         for installed_package in installed_index.get(match.group(1), []))
+        for action, packages in (("install", [package for package in missing if not installed[package]]),
+                                 ("reinstall", [package for package in missing if installed[package]])):
+            if not packages:
+                continue
+            try:
+                _ = subprocess.check_output(['yum', '-q', '-y', '--downloadonly', '--downloaddir=' + download_dir] +
+                                            _proxy_options() + [action] + packages, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                text = "Couldn't download the packages " + " ".join(packages) + ". Encountered an error: " + str(e)
+                if e.output is not None:
+                    text += "\n" + str(e.output)
+                raise RuntimeError(text)
+        downloaded, _ = _find_downloaded(get_download_index(download_dir), download_dir, package_list)
+
+    not_found = [package for package in package_list if downloaded[package] is None]
+    if not_found:
+        raise RuntimeError("Couldn't find the downloaded packages for " + ", ".join(not_found))
+    return [downloaded[package] for package in package_list]
 
 
 def remove_package(package_name):
@@ -257,6 +995,7 @@ def remove_package(package_name):
     try:
         _ = subprocess.check_output(['yum', '-y', '-q', '--disablerepo=*', "remove", package_name],
                                     stderr=subprocess.STDOUT)
+        invalidate_package_index()
     except subprocess.CalledProcessError as e:
         text = "Couldn't delete " + package_name + " package. Encountered an error: " + str(e)
         if e.output is not None:
@@ -276,7 +1015,122 @@ def remove_package_from(node, package_name):
         remove_package(package_name)
         return
 
-    result_code, result_string = node.perform_command_on_host("yum -y -q --disablerepo=* remove " + package_name)
+    result_code, result_string = node.command("yum -y -q --disablerepo=* remove " + package_name)
     if result_code != 0:
         raise RuntimeError("Couldn't remove " + package_name + " from " + node.get_location().address + ": " +
                            result_string)
+    invalidate_package_index(node)
+
+
+class _MetadataCacheStatus(object):
+    def __init__(self, host):
+        self.host = host
+        self.warmed = False
+        self.error = None
+        self.duration = None
+        # The age in seconds of the cached metadata of each repo
+        self.repo_ages = {}
+
+    def get_oldest_age(self):
+        return max(self.repo_ages.values()) if self.repo_ages else None
+
+    def __bool__(self):
+        return self.warmed
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        if not self.warmed:
+            return "<" + self.host + " not warmed: " + str(self.error) + ">"
+        return "<" + self.host + " warmed in " + str(round(self.duration, 1)) + "s, " + str(len(self.repo_ages)) + \
+               " repos cached>"
+
+
+def _run_shell(node, command, timeout=None):
+    if node is None or node.get_location().is_local():
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        return process.returncode, output.decode('utf-8', 'replace')
+    return node.command(command, timeout=timeout)
+
+
+def get_metadata_cache_freshness(node=None):
+    """
+    Get how old the yum (or dnf) metadata cached on a node is for each repo, measured by the node's clock
+
+    :param node: the yu.network.RemoteNode to check (optional) default = the local node
+    :return: a dictionary of repo id to the age of its cached metadata in seconds; repos with no cached metadata
+             are left out
+    :raises RuntimeError if the cache couldn't be checked
+    """
+    result_code, result_string = _run_shell(node, _CACHE_FRESHNESS_COMMAND)
+    lines = result_string.splitlines()
+    if result_code != 0 or not lines or not lines[0].strip().isdigit():
+        raise RuntimeError("Couldn't check the yum metadata cache: " + result_string)
+
+    now = int(lines[0].strip())
+    repo_ages = {}
+    for line in lines[1:]:
+        fields = line.split(" ", 1)
+        if len(fields) != 2:
+            continue
+        directory = fields[1].rstrip("/")
+        if os.path.basename(directory) == "repodata":
+            # dnf names the directory <repo id>-<hash of the repo's urls>
+            repo_id = os.path.basename(os.path.dirname(directory)).rsplit("-", 1)[0]
+        else:
+            repo_id = os.path.basename(directory)
+        age = max(0.0, now - float(fields[0]))
+        repo_ages[repo_id] = min(age, repo_ages.get(repo_id, age))
+    return repo_ages
+
+
+def warm_metadata_cache_on(node=None, timeout=None):
+    """
+    Download the metadata of the node's enabled repos ahead of time with `yum makecache fast`, so the next install
+    doesn't stall fetching it. Repos whose cached metadata hasn't expired aren't downloaded again.
+
+    :param node: the yu.network.RemoteNode to warm the cache of (optional) default = the local node
+    :param timeout: the maximum amount of time to allow makecache to run on a remote node (optional)
+    :return: a status with warmed, error, duration and repo_ages (the age in seconds of each repo's cached metadata
+             afterwards) attributes; it is truthy if the cache was warmed
+    """
+    status = _MetadataCacheStatus("localhost" if node is None else node.get_host_to_connect_to())
+    start = time.time()
+    try:
+        # dnf doesn't need (or always accept) the "fast" argument yum uses to skip unexpired repos
+        result_code, result_string = _run_shell(node, "yum -q -y makecache fast || yum -q -y makecache", timeout)
+        if result_code != 0:
+            status.error = "makecache failed: " + result_string.strip()
+        else:
+            status.warmed = True
+        status.duration = time.time() - start
+        status.repo_ages = get_metadata_cache_freshness(node)
+    except Exception as e:
+        status.duration = time.time() - start
+        status.error = status.error or str(e)
+    return status
+
+
+def warm_metadata_cache(node_list, max_concurrent_nodes=4, timeout=None):
+    """
+    Run warm_metadata_cache_on for many nodes concurrently, ahead of installing across them.
+    The number of nodes fetching at once is bounded so the repo mirrors aren't overwhelmed.
+
+    :param node_list: the yu.network.RemoteNode objects to warm the cache of
+    :param max_concurrent_nodes: the maximum number of nodes running makecache at once (optional) default = 4
+    :param timeout: see warm_metadata_cache_on (optional)
+    :return: a dictionary keyed on the host of each node whose values are the status from warm_metadata_cache_on
+    """
+    results = {}
+    if not node_list:
+        return results
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrent_nodes, len(node_list)))
+    try:
+        futures = dict((executor.submit(warm_metadata_cache_on, node, timeout), node) for node in node_list)
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future].get_host_to_connect_to()] = future.result()
+    finally:
+        executor.shutdown(wait=True)
+    return results
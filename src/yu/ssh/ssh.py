@@ -4,6 +4,9 @@ import ntpath
 import stat
 import pathlib
 import socket
+import select
+import time
+import threading
 
 
 class NotConnectedException(Exception):
@@ -18,6 +21,251 @@ class TimedOutException(Exception):
     pass
 
 
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def _write_input(stream, input_data, chunk_size=STREAM_CHUNK_SIZE):
+    if callable(input_data):
+        input_data(stream)
+    elif isinstance(input_data, bytes):
+        stream.write(input_data)
+    elif hasattr(input_data, 'read'):
+        while True:
+            chunk = input_data.read(chunk_size)
+            if not chunk:
+                break
+            stream.write(chunk)
+    else:
+        for chunk in input_data:
+            stream.write(chunk)
+
+
+def _drain_channel(channel, output):
+    while True:
+        data = channel.recv(STREAM_CHUNK_SIZE)
+        if not data:
+            return
+        output.append(data)
+
+
+def _forward_channel(channel, local_host, local_port):
+    # Pump data between a forwarded channel and a new connection to the local port until either side closes
+    try:
+        sock = socket.create_connection((local_host, local_port))
+    except socket.error:
+        channel.close()
+        return
+    try:
+        while True:
+            readable, _, _ = select.select([sock, channel], [], [])
+            if sock in readable:
+                data = sock.recv(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                channel.sendall(data)
+            if channel in readable:
+                data = channel.recv(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                sock.sendall(data)
+    except (socket.error, paramiko.SSHException):
+        pass
+    finally:
+        channel.close()
+        sock.close()
+
+
+class RemoteFile(object):
+    """
+    A buffered, seekable file-like object for a file on a remote host, accessed over SFTP.
+
+    Reads are served from a local buffer which is refilled with (at least) read_ahead bytes at a time using
+    pipelined SFTP read requests, so sequential reads of large files only hold one buffer in memory and
+    random access only transfers the ranges that are actually requested.
+    Data is always read and written as bytes.
+    """
+    DEFAULT_READ_AHEAD = 1024 * 1024
+
+    def __init__(self, sftp_client, remote_path, mode='rb', read_ahead=DEFAULT_READ_AHEAD, owns_client=True):
+        self.name = remote_path
+        self.mode = mode
+        self.m_sftp = sftp_client
+        self.m_owns_client = owns_client
+        self.m_file = sftp_client.open(remote_path, mode.replace('b', '').replace('t', ''))
+        self.m_read_ahead = max(1, int(read_ahead))
+        self.m_buffer = b''
+        self.m_buffer_offset = 0
+        self.m_size = self.m_file.stat().st_size
+        self.m_position = 0
+        self.closed = False
+
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            self.m_file.set_pipelined(True)
+        if 'a' in mode:
+            self.m_position = self.m_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def size(self, refresh=False):
+        """
+        Get the size of the remote file
+
+        :param refresh: when True the size is re-read from the remote host rather than using the cached value
+                        (useful for files that are still being written to)
+        :return: the size of the file in bytes
+        """
+        if refresh:
+            self.m_size = self.m_file.stat().st_size
+            if self.m_size < self.m_buffer_offset + len(self.m_buffer):
+                # The file has been truncated so the buffered data may no longer be in it
+                self.discard_buffer()
+        return self.m_size
+
+    def discard_buffer(self):
+        """
+        Drop the read-ahead buffer so the next read fetches its data from the remote file again.
+        Use this when the remote file has been rewritten or truncated by something else
+        """
+        self.m_buffer = b''
+        self.m_buffer_offset = 0
+
+    def tell(self):
+        return self.m_position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.m_position + offset
+        elif whence == os.SEEK_END:
+            position = self.size(refresh=True) + offset
+        else:
+            raise ValueError("Invalid whence (" + str(whence) + ")")
+
+        if position < 0:
+            raise IOError("Cannot seek to a negative position in " + self.name)
+        self.m_position = position
+        return self.m_position
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes from the current position. If size is omitted or negative the rest of the file is read
+
+        :param size: the maximum number of bytes to read
+        :return: the bytes read; an empty bytes object at the end of the file
+        """
+        if size is None or size < 0:
+            size = max(0, self.size(refresh=True) - self.m_position)
+        data = self._read_at(self.m_position, size)
+        self.m_position += len(data)
+        return data
+
+    def readline(self, limit=-1):
+        chunks = []
+        length = 0
+        while limit < 0 or length < limit:
+            if not self._ensure_buffered(self.m_position):
+                break
+            start = self.m_position - self.m_buffer_offset
+            end = self.m_buffer.find(b'\n', start)
+            end = len(self.m_buffer) if end == -1 else end + 1
+            if limit >= 0:
+                end = min(end, start + limit - length)
+            chunk = self.m_buffer[start:end]
+            chunks.append(chunk)
+            length += len(chunk)
+            self.m_position += len(chunk)
+            if chunk.endswith(b'\n'):
+                break
+        return b''.join(chunks)
+
+    def readlines(self):
+        return list(self)
+
+    def read_range(self, offset, length):
+        """
+        Read a range of the file without moving the current position or disturbing the read-ahead buffer
+
+        :param offset: the offset in the file to start reading from
+        :param length: the number of bytes to read
+        :return: the bytes read; this will be shorter than length if the range runs past the end of the file
+        """
+        return self.read_ranges([(offset, length)])[0]
+
+    def read_ranges(self, ranges):
+        """
+        Read several ranges of the file in one pipelined batch of requests
+
+        :param ranges: a list of (offset, length) tuples
+        :return: a list of bytes objects, one for each range in the order they were requested
+        """
+        file_size = self.size(refresh=True)
+        clamped = []
+        for offset, length in ranges:
+            clamped.append((offset, max(0, min(length, file_size - offset))))
+
+        to_fetch = [r for r in clamped if r[1] > 0]
+        fetched = iter(self.m_file.readv(to_fetch)) if to_fetch else iter([])
+        return [next(fetched) if length > 0 else b'' for _, length in clamped]
+
+    def write(self, data):
+        self.m_buffer = b''
+        self.m_file.seek(self.m_position)
+        self.m_file.write(data)
+        self.m_position += len(data)
+        self.m_size = max(self.m_size, self.m_position)
+        return len(data)
+
+    def flush(self):
+        self.m_file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.m_file.close()
+        finally:
+            if self.m_owns_client:
+                self.m_sftp.close()
+
+    def _ensure_buffered(self, offset, size=1):
+        if self.m_buffer_offset <= offset < self.m_buffer_offset + len(self.m_buffer):
+            return True
+
+        file_size = self.size()
+        if offset >= file_size:
+            file_size = self.size(refresh=True)
+            if offset >= file_size:
+                return False
+
+        fetch_size = min(max(size, self.m_read_ahead), file_size - offset)
+        self.m_buffer = b''.join(self.m_file.readv([(offset, fetch_size)]))
+        self.m_buffer_offset = offset
+        return len(self.m_buffer) > 0
+
+    def _read_at(self, offset, size):
+        chunks = []
+        while size > 0 and self._ensure_buffered(offset, size):
+            start = offset - self.m_buffer_offset
+            chunk = self.m_buffer[start:start + size]
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+
 class Session:
     def __init__(self, hostname):
         self.m_hostname = hostname
@@ -222,6 +470,20 @@ class Session:
             if sftp is not None and sftp_session is None:
                 sftp.close()
 
+    def open(self, remote_path, mode='rb', read_ahead=RemoteFile.DEFAULT_READ_AHEAD):
+        sftp = None
+        try:
+            sftp = self.m_sshClient.open_sftp()
+            return RemoteFile(sftp, remote_path, mode, read_ahead)
+        except IOError as e:
+            if sftp is not None:
+                sftp.close()
+            raise e
+        except paramiko.SSHException as e:
+            if sftp is not None:
+                sftp.close()
+            raise RuntimeError("Failed to open " + remote_path + " on " + str(self.m_hostname) + ":\n" + repr(e))
+
     def get_session(self):
         return self.m_sshClient
 
@@ -235,7 +497,7 @@ class Session:
         try:
             stdin, stdout, stderr = self.m_sshClient.exec_command(command, -1, timeout, get_pty=shell)
 
-            result_string = stdout.read()
+            result_string = stdout.read().decode('utf-8', 'replace')
             result_code = stdout.channel.recv_exit_status()
             return result_code, result_string
         except socket.timeout as e:
@@ -249,3 +511,158 @@ class Session:
                                                    + ":" + str(e))
             except EOFError:
                 raise NotConnectedException("SSH connection to " + self.m_hostname + " was lost")
+
+    def exec_command_with_input(self, command, input_data, timeout=None):
+        """
+        Execute a command and stream data into its stdin while it runs.
+        The output of the command is drained concurrently so a chatty command can't stall the upload.
+
+        :param command: the command to execute
+        :param input_data: the data to send; either bytes, a file-like object to read from, an iterable of bytes or
+                           a callable that will be passed a writable file-like object connected to the command's stdin
+        :param timeout: the maximum amount of time to wait on any one channel operation
+        :return: a tuple of result code and result string (stdout and stderr combined)
+        """
+        channel = None
+        try:
+            channel = self.m_sshClient.get_transport().open_session(timeout=timeout)
+            channel.settimeout(timeout)
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+
+            output = []
+            reader = threading.Thread(target=_drain_channel, args=(channel, output))
+            reader.daemon = True
+            reader.start()
+
+            stdin = channel.makefile('wb', STREAM_CHUNK_SIZE)
+            try:
+                _write_input(stdin, input_data)
+                stdin.flush()
+            except (socket.error, EOFError):
+                # The command stopped reading its input early; its exit status will say why
+                pass
+            channel.shutdown_write()
+
+            result_code = channel.recv_exit_status()
+            reader.join()
+            return result_code, b''.join(output).decode('utf-8', 'replace')
+        except socket.timeout as e:
+            raise TimedOutException("Execution of " + command + " on " + str(self.m_hostname) + " timed out (" +
+                                    str(timeout) + " seconds)")
+        except paramiko.SSHException as e:
+            raise RuntimeError("Failed to execute " + command + " on " + str(self.m_hostname) + ":\n" + repr(e))
+        finally:
+            if channel is not None:
+                channel.close()
+
+    def exec_command_streamed(self, command, output_callback, timeout=None):
+        """
+        Execute a command and pass its output to output_callback as it arrives rather than buffering it
+
+        :param command: the command to execute
+        :param output_callback: a callable that is passed each chunk of output (stdout and stderr combined) as bytes
+        :param timeout: the maximum amount of time to wait on any one channel operation
+        :return: the result code of the command
+        """
+        channel = None
+        try:
+            channel = self.m_sshClient.get_transport().open_session(timeout=timeout)
+            channel.settimeout(timeout)
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            while True:
+                data = channel.recv(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                output_callback(data)
+            return channel.recv_exit_status()
+        except socket.timeout as e:
+            raise TimedOutException("Execution of " + command + " on " + str(self.m_hostname) + " timed out (" +
+                                    str(timeout) + " seconds)")
+        except paramiko.SSHException as e:
+            raise RuntimeError("Failed to execute " + command + " on " + str(self.m_hostname) + ":\n" + repr(e))
+        finally:
+            if channel is not None:
+                channel.close()
+
+    def global_request_round_trip(self):
+        """
+        Send a keepalive global request and wait for the server's reply.
+        This is the cheapest round trip the SSH protocol offers, so it measures network latency with minimal server
+        side overhead
+
+        :return: the number of seconds the round trip took
+        """
+        transport = self.m_sshClient.get_transport()
+        start = time.time()
+        transport.global_request("keepalive@openssh.com", wait=True)
+        return time.time() - start
+
+    def put_stream(self, file_object, remote_path):
+        """
+        Upload the contents of a file-like object to remote_path over SFTP
+
+        :param file_object: the object to read the data from
+        :param remote_path: the path to write the data to
+        """
+        sftp = None
+        try:
+            sftp = self.m_sshClient.open_sftp()
+            sftp.putfo(file_object, remote_path, confirm=False)
+        except paramiko.SSHException as e:
+            raise RuntimeError("Failed to upload to " + remote_path + " on " + str(self.m_hostname) + ":\n" + repr(e))
+        finally:
+            if sftp is not None:
+                sftp.close()
+
+    def get_stream(self, remote_path, file_object):
+        """
+        Download remote_path over SFTP, writing its contents to a file-like object
+
+        :param remote_path: the path to read the data from
+        :param file_object: the object to write the data to
+        """
+        sftp = None
+        try:
+            sftp = self.m_sshClient.open_sftp()
+            sftp.getfo(remote_path, file_object)
+        except paramiko.SSHException as e:
+            raise RuntimeError("Failed to download " + remote_path + " from " + str(self.m_hostname) + ":\n" +
+                               repr(e))
+        finally:
+            if sftp is not None:
+                sftp.close()
+
+    def start_reverse_forward(self, remote_port, local_port, local_host="127.0.0.1", remote_host="127.0.0.1"):
+        """
+        Ask the server to listen on remote_host:remote_port and forward every connection made to it back over this
+        session to local_host:local_port, like `ssh -R`
+
+        :param remote_port: the port to listen on on the server; 0 to let the server pick one
+        :param local_port: the port to forward connections to
+        :param local_host: the host to forward connections to (optional) default = 127.0.0.1
+        :param remote_host: the address to listen on on the server (optional) default = 127.0.0.1
+        :return: the port the server is listening on
+        """
+        def handle_channel(channel, origin, server):
+            thread = threading.Thread(target=_forward_channel, args=(channel, local_host, local_port))
+            thread.daemon = True
+            thread.start()
+
+        try:
+            return self.m_sshClient.get_transport().request_port_forward(remote_host, remote_port, handle_channel)
+        except paramiko.SSHException as e:
+            raise RuntimeError("Failed to forward port " + str(remote_port) + " on " + str(self.m_hostname) + ":\n" +
+                               repr(e))
+
+    def stop_reverse_forward(self, remote_port, remote_host="127.0.0.1"):
+        """
+        Stop a forward started with start_reverse_forward
+
+        :param remote_port: the port the server is listening on
+        :param remote_host: the address the server is listening on (optional) default = 127.0.0.1
+        """
+        transport = self.m_sshClient.get_transport()
+        if transport is not None and transport.is_active():
+            transport.cancel_port_forward(remote_host, remote_port)